@@ -0,0 +1,199 @@
+"""Начисление процентов по активным кредитам.
+
+Кредиты читаются блоками по ключу id, новые суммы считаются векторно в NumPy
+и записываются одним ``UPDATE ... FROM (VALUES ...)`` на блок. Проценты
+капитализируются ежедневно по ставке ``interest_rate`` (годовых); за дни
+после ``due_date`` к ставке добавляется штрафная ``penalty_rate``.
+
+Каждый кредит помнит дату последнего начисления (``accrued_on``), поэтому
+повторный запуск в тот же день ничего не начислит дважды. После каждого
+блока в файл контрольной точки пишется последний обработанный id, и
+прерванный запуск продолжается с него.
+
+    python accrual.py                      # URL из alembic.ini, на сегодня
+    python accrual.py --url postgresql://... --date 2024-12-31
+"""
+
+import argparse
+import configparser
+import json
+import os
+import time
+from datetime import date
+
+import numpy as np
+from sqlalchemy import Float, Integer, column, create_engine, select, update, values
+
+from models import Loan
+
+# Два параметра на кредит: блок должен уложиться в лимит 65535 параметров
+# запроса Postgres
+CHUNK_SIZE = 10000
+PENALTY_RATE = 20.0
+DAYS_IN_YEAR = 365
+CHECKPOINT_PATH = "accrual.checkpoint.json"
+
+
+def day_numbers(dates):
+    """Порядковые номера дней; 0 вместо пустых дат."""
+    return np.fromiter(
+        (value.toordinal() if value else 0 for value in dates),
+        dtype="int64",
+        count=len(dates),
+    )
+
+
+def accrue(amounts, rates, accrued_on, due_dates, today, penalty_rate=PENALTY_RATE):
+    """Суммы кредитов на ``today`` с учётом ежедневной капитализации.
+
+    ``accrued_on`` и ``due_dates`` — номера дней из day_numbers; 0 в
+    ``accrued_on`` значит, что начислять ещё нечего, в ``due_dates`` — что
+    срока нет и штраф не начисляется.
+    """
+    today = today.toordinal()
+    days = np.where(accrued_on > 0, np.maximum(today - accrued_on, 0), 0)
+
+    # Просроченные дни — часть периода начисления после due_date
+    overdue = np.where(
+        due_dates > 0,
+        np.clip(today - np.maximum(accrued_on, due_dates), 0, days),
+        0,
+    )
+
+    daily = rates / 100 / DAYS_IN_YEAR
+    penalty = penalty_rate / 100 / DAYS_IN_YEAR
+    factor = np.power(1 + daily, days - overdue) * np.power(
+        1 + daily + penalty, overdue
+    )
+    return np.round(amounts * factor, 2)
+
+
+def fetch_chunk(connection, today, after_id, size):
+    return connection.execute(
+        select(Loan.id, Loan.amount, Loan.interest_rate, Loan.accrued_on, Loan.due_date)
+        .where(
+            Loan.status == "active",
+            Loan.id > after_id,
+            (Loan.accrued_on.is_(None)) | (Loan.accrued_on < today),
+        )
+        .order_by(Loan.id)
+        .limit(size)
+    ).all()
+
+
+def write_chunk(connection, ids, amounts, today):
+    # Кредит, погашенный после fetch_chunk, не перезаписывается начисленной
+    # суммой
+    rows = list(zip(ids.tolist(), amounts.tolist()))
+    if connection.dialect.name == "postgresql":
+        data = values(
+            column("id", Integer), column("amount", Float), name="accrued"
+        ).data(rows)
+        connection.execute(
+            update(Loan)
+            .where(Loan.id == data.c.id, Loan.status == "active")
+            .values(amount=data.c.amount, accrued_on=today)
+        )
+    else:
+        # SQLite не понимает VALUES с именами колонок в FROM; executemany
+        # напрямую в драйвер, даты SQLite хранит строками ISO
+        connection.exec_driver_sql(
+            "UPDATE loans SET amount = ?, accrued_on = ? "
+            "WHERE id = ? AND status = 'active'",
+            [(amount, today.isoformat(), id_) for id_, amount in rows],
+        )
+
+
+def read_checkpoint(path, today):
+    """Последний обработанный id, если контрольная точка от этого же дня."""
+    try:
+        with open(path, encoding="utf-8") as file:
+            checkpoint = json.load(file)
+    except (OSError, ValueError):
+        return 0
+    if checkpoint.get("date") != today.isoformat():
+        return 0
+    return checkpoint.get("last_id", 0)
+
+
+def write_checkpoint(path, today, last_id):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump({"date": today.isoformat(), "last_id": last_id}, file)
+    os.replace(tmp_path, path)
+
+
+def run(
+    engine,
+    today=None,
+    penalty_rate=PENALTY_RATE,
+    chunk_size=CHUNK_SIZE,
+    checkpoint_path=CHECKPOINT_PATH,
+):
+    """Начисляет проценты по всем активным кредитам. Возвращает число
+    обновлённых кредитов."""
+    today = today or date.today()
+    last_id = read_checkpoint(checkpoint_path, today) if checkpoint_path else 0
+    processed = 0
+
+    while True:
+        with engine.begin() as connection:
+            rows = fetch_chunk(connection, today, last_id, chunk_size)
+            if not rows:
+                break
+            ids, amounts, rates, accrued_on, due_dates = zip(*rows)
+            ids = np.array(ids, dtype="int64")
+            new_amounts = accrue(
+                np.array(amounts, dtype="float64"),
+                np.array(rates, dtype="float64"),
+                day_numbers(accrued_on),
+                day_numbers(due_dates),
+                today,
+                penalty_rate,
+            )
+            write_chunk(connection, ids, new_amounts, today)
+
+        last_id = int(ids[-1])
+        processed += len(ids)
+        if checkpoint_path:
+            write_checkpoint(checkpoint_path, today, last_id)
+
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return processed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="URL базы, по умолчанию из alembic.ini")
+    parser.add_argument("--date", type=date.fromisoformat, help="дата начисления")
+    parser.add_argument("--chunk-size", type=int)
+    parser.add_argument("--checkpoint", help="файл контрольной точки")
+    args = parser.parse_args(argv)
+
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    url = args.url
+    if not url:
+        alembic = configparser.ConfigParser()
+        alembic.read("alembic.ini")
+        url = alembic["alembic"]["sqlalchemy.url"]
+
+    engine = create_engine(url)
+    started = time.perf_counter()
+    processed = run(
+        engine,
+        today=args.date,
+        penalty_rate=config.getfloat("accrual", "penalty_rate", fallback=PENALTY_RATE),
+        chunk_size=args.chunk_size
+        or config.getint("accrual", "chunk_size", fallback=CHUNK_SIZE),
+        checkpoint_path=args.checkpoint
+        or config.get("accrual", "checkpoint", fallback=CHECKPOINT_PATH),
+    )
+    engine.dispose()
+    elapsed = time.perf_counter() - started
+    print(f"{processed} loans accrued in {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
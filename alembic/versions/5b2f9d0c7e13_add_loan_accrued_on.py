@@ -0,0 +1,27 @@
+"""Add loan accrued_on
+
+Revision ID: 5b2f9d0c7e13
+Revises: e91f3b7d2c48
+Create Date: 2026-10-18 14:02:37.518204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b2f9d0c7e13'
+down_revision: Union[str, None] = 'e91f3b7d2c48'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Пустое значение: первый запуск accrual.py только проставит дату
+    op.add_column('loans', sa.Column('accrued_on', sa.Date(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('loans', 'accrued_on')
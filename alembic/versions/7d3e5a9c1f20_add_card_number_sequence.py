@@ -0,0 +1,42 @@
+"""Add card number sequence
+
+Revision ID: 7d3e5a9c1f20
+Revises: a1ec7c8e9f2c
+Create Date: 2026-10-18 10:12:41.503118
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7d3e5a9c1f20'
+down_revision: Union[str, None] = 'a1ec7c8e9f2c'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Сколько номеров процесс резервирует за один nextval
+BLOCK_SIZE = 100
+
+
+def upgrade() -> None:
+    op.execute(
+        sa.schema.CreateSequence(
+            sa.Sequence('card_number_seq', start=1, increment=BLOCK_SIZE)
+        )
+    )
+    # Тело нового номера (без контрольной цифры) начинается выше любого
+    # уже выданного номера, чтобы не пересечься со старыми картами. Первые
+    # карты сохранялись с номером вида "0000 0000 0000 None", такие строки
+    # к bigint не приводятся и пропускаются
+    op.execute(
+        "SELECT setval('card_number_seq', "
+        "COALESCE(MAX(REPLACE(card_number, ' ', '')::bigint), 0) / 10 + 1, false) "
+        "FROM cards WHERE card_number ~ '^[0-9 ]+$'"
+    )
+
+
+def downgrade() -> None:
+    op.execute(sa.schema.DropSequence(sa.Sequence('card_number_seq')))
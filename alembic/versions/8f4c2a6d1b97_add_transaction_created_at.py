@@ -0,0 +1,27 @@
+"""Add transaction created_at
+
+Revision ID: 8f4c2a6d1b97
+Revises: 5b2f9d0c7e13
+Create Date: 2026-10-18 14:41:12.903115
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8f4c2a6d1b97'
+down_revision: Union[str, None] = '5b2f9d0c7e13'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # У старых операций времени нет: они попадают только в полную выгрузку
+    op.add_column('transactions', sa.Column('created_at', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('transactions', 'created_at')
@@ -0,0 +1,46 @@
+"""Add hot query indexes
+
+Revision ID: c4b1e8f05a62
+Revises: 7d3e5a9c1f20
+Create Date: 2026-10-18 11:03:27.914256
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4b1e8f05a62'
+down_revision: Union[str, None] = '7d3e5a9c1f20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # CREATE INDEX CONCURRENTLY не блокирует запись в таблицы, но не может
+    # выполняться внутри транзакции
+    with op.get_context().autocommit_block():
+        op.create_index('ix_cards_client_id', 'cards', ['client_id'],
+                        postgresql_concurrently=True, if_not_exists=True)
+        # Обработчики читают только активные кредиты клиента
+        op.create_index('ix_loans_client_id_active', 'loans', ['client_id'],
+                        postgresql_where=sa.text("status = 'active'"),
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_transactions_client_id', 'transactions', ['client_id'],
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_transactions_recipient_id', 'transactions', ['recipient_id'],
+                        postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_transactions_recipient_id', table_name='transactions',
+                      postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_transactions_client_id', table_name='transactions',
+                      postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_loans_client_id_active', table_name='loans',
+                      postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_cards_client_id', table_name='cards',
+                      postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,47 @@
+"""Add transaction history indexes
+
+Revision ID: e91f3b7d2c48
+Revises: c4b1e8f05a62
+Create Date: 2026-10-18 12:26:05.381947
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e91f3b7d2c48'
+down_revision: Union[str, None] = 'c4b1e8f05a62'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Составные индексы под ключ страницы /history (client_id, id) заменяют
+    # одноколоночные: поиск по одному client_id они тоже покрывают
+    with op.get_context().autocommit_block():
+        op.create_index('ix_transactions_client_id_id', 'transactions',
+                        ['client_id', 'id'],
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_transactions_recipient_id_id', 'transactions',
+                        ['recipient_id', 'id'],
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.drop_index('ix_transactions_client_id', table_name='transactions',
+                      postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_transactions_recipient_id', table_name='transactions',
+                      postgresql_concurrently=True, if_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index('ix_transactions_recipient_id', 'transactions',
+                        ['recipient_id'],
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_transactions_client_id', 'transactions',
+                        ['client_id'],
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.drop_index('ix_transactions_recipient_id_id', table_name='transactions',
+                      postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_transactions_client_id_id', table_name='transactions',
+                      postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,638 @@
+"""Асинхронная точка входа бота на AsyncTeleBot и AsyncSession SQLAlchemy.
+
+Без отдельного потока на запрос: и HTTPS-запросы к Bot API, и запросы к базе
+выполняются в одном цикле событий. Поддерживает основные команды main.py:
+/start, /help, /register, /account, /create_card, /delete_card, /loan_pay,
+/top_up и /transfer. Кнопки кодируются тем же CallbackRouter с теми же
+кодами действий, шаги диалогов хранятся в conversations.store, деньги
+списываются и зачисляются функциями transfers.
+
+Основной точкой входа остаётся main.py: только в нём есть /history и
+/statement, очередь исходящих сообщений с лимитами Telegram, кэши,
+метрики и маршрутизация на реплики.
+
+    python async_main.py
+"""
+
+import asyncio
+import configparser
+import re
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import joinedload
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+
+import callbacks
+import card_numbers
+import conversations
+import transfers
+from logger import log_message_info
+from models import Card, Client, Loan
+
+# Драйверы asyncio для синхронных URL из alembic.ini
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+# Config
+config = configparser.ConfigParser()
+config.read("config.ini")
+API_TOKEN = config["telegram"]["token"]
+
+bot = AsyncTeleBot(API_TOKEN)
+
+
+def async_database_url(url):
+    """Переводит URL вида postgresql://... на асинхронный драйвер."""
+    url = make_url(url)
+    drivername = ASYNC_DRIVERS.get(url.get_backend_name())
+    return url.set(drivername=drivername) if drivername else url
+
+
+alembic = configparser.ConfigParser()
+alembic.read("alembic.ini")
+DATABASE_URL = alembic["alembic"]["sqlalchemy.url"]
+engine = create_async_engine(async_database_url(DATABASE_URL))
+Session = async_sessionmaker(engine, expire_on_commit=False)
+
+commands = [
+    types.BotCommand("start", "Начать работу с ботом"),
+    types.BotCommand("help", "Помощь"),
+    types.BotCommand("register", "Регистрация"),
+    types.BotCommand("account", "Управление аккаунтом"),
+    types.BotCommand("create_card", "Создание карты"),
+    types.BotCommand("delete_card", "Удаление карты"),
+    types.BotCommand("loan_pay", "Погасить кредит"),
+    types.BotCommand("top_up", "Пополнить карту"),
+    types.BotCommand("transfer", "Перевод с карты на карту"),
+]
+
+router = callbacks.CallbackRouter()
+
+# AsyncTeleBot не поддерживает register_next_step_handler: шаг диалога по
+# имени лежит в conversations.store. Имена корутин свои, а не
+# conversations.handlers: main.py регистрирует там синхронные шаги с теми
+# же именами
+steps = {}
+
+
+def step(handler):
+    steps[handler.__name__] = handler
+    return handler
+
+
+def register_next_step(message, handler, **kwargs):
+    conversations.store.set(message.chat.id, handler.__name__, **kwargs)
+
+
+async def get_client(session, telegram_id):
+    result = await session.execute(
+        select(Client).where(Client.telegram_id == telegram_id)
+    )
+    return result.scalars().first()
+
+
+async def get_cards(session, client_id):
+    result = await session.execute(select(Card).where(Card.client_id == client_id))
+    return result.scalars().all()
+
+
+# Шаг диалога обрабатывается раньше команд, как и в TeleBot
+@bot.message_handler(
+    func=lambda message: conversations.store.pending(message.chat.id),
+    content_types=["text"],
+)
+async def process_next_step(message):
+    step = conversations.store.pop(message.chat.id)
+    if step is not None:
+        await steps[step.name](message, **step.args)
+
+
+@bot.message_handler(commands=["start"])
+async def send_welcome(message):
+    log_message_info(message)
+    await bot.send_message(message.chat.id, "Привет! Я банковский бот.")
+
+
+@bot.message_handler(commands=["help"])
+async def send_help(message):
+    log_message_info(message)
+    help_text = (
+        "/start - Запустить бота\n"
+        "/help - Получить помощь\n"
+        "/register - Зарегистрироваться\n"
+        "/account - Посмотреть свой аккаунт\n"
+        "/create_card - Создать карту\n"
+        "/loan_pay - Погасить кредит\n"
+        "/top_up - Пополнить карту\n"
+        "/transfer - Перевод с карты на карту"
+    )
+    await bot.send_message(message.chat.id, help_text)
+
+
+@bot.message_handler(commands=["register"])
+async def register(message):
+    log_message_info(message)
+    async with Session() as session:
+        client = await get_client(session, message.from_user.id)
+    if client:
+        await bot.send_message(
+            message.chat.id, f"{client.first_name}, Вы уже зарегистрированы!"
+        )
+        return
+
+    await bot.send_message(
+        message.chat.id, "Пожалуйста, введите вашу фамилию (last name):"
+    )
+    register_next_step(message, process_last_name)
+
+
+@step
+async def process_last_name(message):
+    log_message_info(message)
+    await bot.send_message(message.chat.id, "Введите ваше имя (first name):")
+    register_next_step(message, process_first_name, last_name=message.text)
+
+
+@step
+async def process_first_name(message, last_name):
+    log_message_info(message)
+    await bot.send_message(
+        message.chat.id, "Введите ваше отчество (patronymic, если есть):"
+    )
+    register_next_step(
+        message, process_patronymic, last_name=last_name, first_name=message.text
+    )
+
+
+@step
+async def process_patronymic(message, last_name, first_name):
+    log_message_info(message)
+    await bot.send_message(message.chat.id, "Введите ваш email:")
+    register_next_step(
+        message,
+        process_email,
+        last_name=last_name,
+        first_name=first_name,
+        patronymic=message.text,
+    )
+
+
+@step
+async def process_email(message, last_name, first_name, patronymic):
+    log_message_info(message)
+    email = message.text
+    email_regex = r"^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$"
+    if not re.match(email_regex, email):
+        await bot.send_message(
+            message.chat.id, "Некорректный email. Пожалуйста, попробуйте еще раз."
+        )
+        register_next_step(
+            message,
+            process_email,
+            last_name=last_name,
+            first_name=first_name,
+            patronymic=patronymic,
+        )
+        return
+
+    async with Session() as session:
+        session.add(
+            Client(
+                first_name=first_name,
+                last_name=last_name,
+                patronymic=patronymic,
+                email=email,
+                telegram_id=message.from_user.id,
+            )
+        )
+        await session.commit()
+
+    await bot.send_message(message.chat.id, "Регистрация завершена! Спасибо!")
+
+
+@bot.message_handler(commands=["account"])
+async def account(message):
+    log_message_info(message)
+    async with Session() as session:
+        # Клиент, его карты и активные кредиты одним запросом
+        client_info = (
+            (
+                await session.execute(
+                    select(Client)
+                    .options(
+                        joinedload(Client.cards),
+                        joinedload(Client.loans.and_(Loan.status == "active")),
+                    )
+                    .where(Client.telegram_id == message.from_user.id)
+                )
+            )
+            .unique()
+            .scalars()
+            .first()
+        )
+        if not client_info:
+            await bot.send_message(message.chat.id, "Вы не зарегистрированы!")
+            return
+
+    await bot.send_message(
+        message.chat.id,
+        f"Ваш аккаунт:\n"
+        f"ФИО: {client_info.last_name} {client_info.first_name} {client_info.patronymic}\n"
+        f"Email: {client_info.email}\n"
+        f"Кредиты:\n"
+        + "".join(
+            f"{number}. Сумма: {loan.amount}, Процентная ставка: {loan.interest_rate}%, статус: {loan.status}\n"
+            for number, loan in enumerate(client_info.loans, 1)
+        )
+        + "Карты:\n"
+        + "".join(
+            f"{number}. Номер карты: <code>{card.card_number}</code>, Дата окончания: {card.expiration_date}, Баланс: {card.balance} ₽, Статус: {card.status}\n"
+            for number, card in enumerate(client_info.cards, 1)
+        ),
+        parse_mode="HTML",
+    )
+
+
+@bot.message_handler(commands=["create_card"])
+async def create_card(message):
+    log_message_info(message)
+    async with Session() as session:
+        client = await get_client(session, message.from_user.id)
+        if not client:
+            await bot.send_message(message.chat.id, "Вы не зарегистрированы!")
+            return
+
+        new_card = Card(
+            client_id=client.id,
+            card_number=await card_numbers.allocator.allocate_async(session),
+            expiration_date=datetime.now() + timedelta(days=365),
+        )
+        session.add(new_card)
+        await session.commit()
+
+    await bot.send_message(
+        message.chat.id,
+        f"Карта с номером <code>{new_card.card_number}</code> создана!",
+        parse_mode="HTML",
+    )
+
+
+@bot.message_handler(commands=["delete_card"])
+async def delete_card(message):
+    log_message_info(message)
+    async with Session() as session:
+        client = await get_client(session, message.from_user.id)
+        if not client:
+            await bot.send_message(message.chat.id, "Вы не зарегистрированы!")
+            return
+        cards = await get_cards(session, client.id)
+
+    if not cards:
+        await bot.send_message(message.chat.id, "У вас нет карт!")
+        return
+
+    markup = types.InlineKeyboardMarkup()
+    for card in cards:
+        markup.add(router.button(card.card_number, callback_query_delete_card, card.id))
+    await bot.send_message(
+        message.chat.id, "Выберите карту для удаления", reply_markup=markup
+    )
+
+
+@router.route(1)
+async def callback_query_delete_card(call, card_id):
+    log_message_info(call.message)
+    async with Session() as session:
+        card = await session.get(Card, card_id)
+        if not card:
+            return
+        await session.delete(card)
+        await session.commit()
+
+    await bot.edit_message_text(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text="Карта успешно удалена!",
+    )
+
+
+@bot.message_handler(commands=["loan_pay"])
+async def loan_pay(message):
+    log_message_info(message)
+    async with Session() as session:
+        client = await get_client(session, message.from_user.id)
+        if not client:
+            await bot.send_message(message.chat.id, "Вы не зарегистрированы!")
+            return
+        loans = (
+            (
+                await session.execute(
+                    select(Loan).where(
+                        Loan.client_id == client.id, Loan.status == "active"
+                    )
+                )
+            )
+            .scalars()
+            .all()
+        )
+
+    if not loans:
+        await bot.send_message(message.chat.id, "У вас нет кредитов!")
+        return
+
+    markup = types.InlineKeyboardMarkup()
+    for loan in loans:
+        markup.add(
+            router.button(
+                f"{loan.amount} ₽, {loan.interest_rate}%, до {loan.due_date}",
+                callback_query_loan_pay,
+                loan.id,
+            )
+        )
+    await bot.send_message(
+        message.chat.id, "Выберите кредит для погашения кредита", reply_markup=markup
+    )
+
+
+@router.route(2)
+async def callback_query_loan_pay(call, loan_id):
+    log_message_info(call.message)
+    async with Session() as session:
+        loan = await session.get(Loan, loan_id)
+        cards = await get_cards(session, loan.client_id)
+
+    markup = types.InlineKeyboardMarkup()
+    for card in cards:
+        if card.balance >= loan.amount:
+            markup.add(
+                router.button(
+                    f"{card.card_number}, {card.balance} ₽",
+                    callback_query_loan_pay_card,
+                    loan.id,
+                    card.id,
+                )
+            )
+    if not markup.keyboard:
+        await bot.edit_message_text(
+            chat_id=call.message.chat.id,
+            message_id=call.message.message_id,
+            text="У вас нет карт с достаточным балансом для погашения кредита!",
+        )
+        return
+
+    await bot.delete_message(
+        chat_id=call.message.chat.id, message_id=call.message.message_id
+    )
+    await bot.send_message(
+        call.message.chat.id,
+        f"Выберите карту для погашения кредита {loan.amount} ₽, {loan.interest_rate}%, до {loan.due_date}",
+        reply_markup=markup,
+    )
+
+
+@router.route(3)
+async def callback_query_loan_pay_card(call, loan_id, card_id):
+    log_message_info(call.message)
+    try:
+        async with Session() as session:
+            await transfers.pay_loan_async(session, loan_id, card_id)
+    except (transfers.LoanNotFound, transfers.InsufficientFunds):
+        return
+
+    await bot.edit_message_text(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text="Кредит успешно погашен!",
+    )
+
+
+@bot.message_handler(commands=["top_up"])
+async def top_up(message):
+    log_message_info(message)
+    async with Session() as session:
+        client = await get_client(session, message.from_user.id)
+        if not client:
+            await bot.send_message(message.chat.id, "Вы не зарегистрированы!")
+            return
+        cards = await get_cards(session, client.id)
+
+    markup = types.InlineKeyboardMarkup()
+    for card in cards:
+        markup.add(
+            router.button(
+                f"{card.card_number}, {card.balance} ₽", callback_query_top_up, card.id
+            )
+        )
+    if not markup.keyboard:
+        await bot.send_message(message.chat.id, "У вас нет карт!")
+        return
+
+    await bot.send_message(
+        message.chat.id, "Выберите карту для пополнения баланса", reply_markup=markup
+    )
+
+
+@router.route(4)
+async def callback_query_top_up(call, card_id):
+    log_message_info(call.message)
+    await bot.edit_message_text(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text="Введите сумму пополнения баланса:",
+    )
+    register_next_step(call.message, finish_top_up, card_id=card_id)
+
+
+@step
+async def finish_top_up(message, card_id):
+    log_message_info(message)
+    try:
+        amount = int(message.text)
+    except ValueError:
+        await bot.send_message(
+            message.chat.id, "Сумма пополнения должна быть целым числом!"
+        )
+        register_next_step(message, finish_top_up, card_id=card_id)
+        return
+
+    try:
+        async with Session() as session:
+            result = await transfers.top_up_async(session, card_id, amount)
+    except transfers.CardNotFound:
+        return
+
+    await bot.send_message(
+        message.chat.id,
+        f"Баланс карты <code>{result.card_number}</code> пополнен на {amount} ₽, текущий баланс: {result.balance} ₽",
+        parse_mode="HTML",
+    )
+
+
+@bot.message_handler(commands=["transfer"])
+async def transfer(message):
+    log_message_info(message)
+    async with Session() as session:
+        client = await get_client(session, message.from_user.id)
+        if not client:
+            await bot.send_message(message.chat.id, "Вы не зарегистрированы!")
+            return
+        cards_from = await get_cards(session, client.id)
+
+    markup = types.InlineKeyboardMarkup()
+    for card in cards_from:
+        markup.add(
+            router.button(
+                f"{card.card_number}, {card.balance} ₽", process_card_from, card.id
+            )
+        )
+    if not markup.keyboard:
+        await bot.send_message(message.chat.id, "У вас нет карт!")
+        return
+
+    await bot.send_message(
+        message.chat.id, "Выберите карту отправителя:", reply_markup=markup
+    )
+
+
+@router.route(5)
+async def process_card_from(call, card_id):
+    log_message_info(call.message)
+    async with Session() as session:
+        card_from = await session.get(Card, card_id)
+    if not card_from:
+        await bot.send_message(call.message.chat.id, "Карта не найдена!")
+        return
+
+    await bot.send_message(call.message.chat.id, "Введите номер карты получателя:")
+    register_next_step(call.message, process_transfer, card_from_id=card_from.id)
+
+
+@step
+async def process_transfer(message, card_from_id):
+    log_message_info(message)
+    async with Session() as session:
+        card_to = (
+            await session.execute(select(Card).where(Card.card_number == message.text))
+        ).scalar()
+    if not card_to:
+        await bot.send_message(message.chat.id, "Карта не найдена!")
+        return
+
+    await bot.send_message(message.chat.id, "Введите сумму перевода:")
+    register_next_step(
+        message, finish_transfer, card_from_id=card_from_id, card_to_id=card_to.id
+    )
+
+
+@step
+async def finish_transfer(message, card_from_id, card_to_id):
+    log_message_info(message)
+    try:
+        amount = float(message.text)
+    except ValueError:
+        await bot.send_message(
+            message.chat.id, "Сумма перевода должна быть целым числом!"
+        )
+        register_next_step(
+            message, finish_transfer, card_from_id=card_from_id, card_to_id=card_to_id
+        )
+        return
+    if amount <= 0:
+        await bot.send_message(
+            message.chat.id, "Сумма перевода должна быть больше нуля!"
+        )
+        register_next_step(
+            message, finish_transfer, card_from_id=card_from_id, card_to_id=card_to_id
+        )
+        return
+
+    try:
+        async with Session() as session:
+            result = await transfers.transfer_async(
+                session, card_from_id, card_to_id, amount
+            )
+    except transfers.InsufficientFunds:
+        await bot.send_message(message.chat.id, "Недостаточно средств!")
+        register_next_step(
+            message,
+            finish_transfer,
+            card_from_id=card_from_id,
+            card_to_id=card_to_id,
+        )
+        return
+    except transfers.CardNotFound:
+        await bot.send_message(message.chat.id, "Карта не найдена!")
+        return
+
+    await bot.send_message(
+        message.chat.id,
+        f"Перевод с карты <code>{result.card_from_number}</code> на карту <code>{result.card_to_number}</code> выполнен, текущий баланс: {result.balance} ₽",
+        parse_mode="HTML",
+    )
+
+
+# Все callback-запросы проходят через роутер: обработчик по коду действия
+@bot.callback_query_handler(func=lambda call: True)
+async def route_callback(call):
+    route = router.resolve(call.data or "")
+    if route is None:
+        # Кнопка из старой версии бота
+        await bot.answer_callback_query(
+            call.id, text="Кнопка устарела, повторите команду."
+        )
+        return
+    handler, args = route
+    await handler(call, *args)
+
+
+@bot.message_handler(
+    content_types=[
+        "text",
+        "photo",
+        "document",
+        "audio",
+        "voice",
+        "video",
+        "video_note",
+        "sticker",
+        "location",
+        "contact",
+        "venue",
+        "animation",
+        "poll",
+        "dice",
+    ]
+)
+async def handle_unmatched_message(message):
+    if message.content_type == "text":
+        await bot.send_message(message.chat.id, "Я вас не понимаю, попробуйте ещё раз.")
+    else:
+        await bot.send_message(
+            message.chat.id,
+            "Я пока не могу обработать этот тип сообщения, попробуйте ещё раз.",
+        )
+    log_message_info(message)
+
+
+async def main():
+    conversations.configure(
+        maxsize=config.getint("conversations", "max_size", fallback=10000),
+        ttl=config.getfloat("conversations", "ttl", fallback=900.0),
+        path=config.get("conversations", "path", fallback=None),
+    )
+    await bot.set_my_commands(commands)
+    try:
+        await bot.infinity_polling()
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
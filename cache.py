@@ -0,0 +1,166 @@
+"""Кэши бота, общие для всех обработчиков процесса."""
+
+import itertools
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from models import Client
+
+# Клиент, найденный по telegram_id: достаточно для проверки регистрации
+# и обращения по имени
+ClientRef = namedtuple("ClientRef", ["id", "first_name"])
+
+
+class TTLCache:
+    """Потокобезопасный LRU-кэш с ограничением размера и временем жизни записей."""
+
+    _MISSING = object()
+
+    def __init__(self, maxsize=10000, ttl=300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, self._MISSING)
+            if item is self._MISSING or item[1] <= time.monotonic():
+                if item is not self._MISSING:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# telegram_id -> ClientRef
+clients = TTLCache()
+# client_id -> готовый текст /account
+accounts = TTLCache(ttl=30.0)
+# (client_id, выбор карты, версия карт) -> JSON inline-клавиатуры
+keyboards = TTLCache(ttl=30.0)
+# client_id -> версия карт клиента
+card_versions = TTLCache(ttl=3600.0)
+# Версии берутся из общего счётчика: клиент, чья версия вытеснена из кэша,
+# получает новую и не увидит клавиатуру, построенную по старым картам
+_versions = itertools.count(1)
+# publish(client_ids): передаёт сброс кэшей другим процессам, см. supervisor.py
+_publish = None
+
+
+def configure(
+    client_cache_size=10000,
+    client_cache_ttl=300.0,
+    account_cache_size=10000,
+    account_cache_ttl=30.0,
+    keyboard_cache_size=10000,
+    keyboard_cache_ttl=30.0,
+):
+    global clients, accounts, keyboards, card_versions
+    clients = TTLCache(client_cache_size, client_cache_ttl)
+    accounts = TTLCache(account_cache_size, account_cache_ttl)
+    keyboards = TTLCache(keyboard_cache_size, keyboard_cache_ttl)
+    card_versions = TTLCache(client_cache_size, 3600.0)
+
+
+def resolve_client(session, telegram_id):
+    """Возвращает ClientRef по telegram_id или None, если клиент не зарегистрирован.
+
+    Запрос к базе выполняется только при промахе кэша; незарегистрированные
+    пользователи не кэшируются, чтобы регистрация в другом процессе была видна сразу.
+    """
+    client = clients.get(telegram_id)
+    if client is not None:
+        return client
+
+    row = (
+        session.query(Client.id, Client.first_name)
+        .filter(Client.telegram_id == telegram_id)
+        .first()
+    )
+    if not row:
+        return None
+    client = ClientRef(row.id, row.first_name)
+    clients.set(telegram_id, client)
+    return client
+
+
+def remember_client(telegram_id, client_id, first_name):
+    clients.set(telegram_id, ClientRef(client_id, first_name))
+
+
+def card_version(client_id):
+    version = card_versions.get(client_id)
+    if version is None:
+        version = next(_versions)
+        card_versions.set(client_id, version)
+    return version
+
+
+def card_keyboard(client_id, picker, build):
+    """JSON клавиатуры выбора карты клиента; ``build()`` строит его при промахе.
+
+    Ключ включает версию карт, поэтому клавиатура, построенная одновременно
+    с изменением карт, записывается под старой версией и больше не читается.
+    """
+    key = (client_id, picker, card_version(client_id))
+    keyboard = keyboards.get(key)
+    if keyboard is None:
+        keyboard = build()
+        keyboards.set(key, keyboard)
+    return keyboard
+
+
+def set_publisher(publish):
+    global _publish
+    _publish = publish
+
+
+def invalidate_client(*client_ids):
+    """Сбрасывает закэшированные представления клиентов после изменения их карт,
+    балансов или кредитов.
+
+    Процессы супервизора получают сброс через ``set_publisher``. Изменения
+    из других программ (например, начисление процентов) становятся видны по
+    истечении TTL.
+    """
+    invalidate_local(*client_ids)
+    if _publish is not None and client_ids:
+        _publish(client_ids)
+
+
+def invalidate_local(*client_ids):
+    """Сбрасывает кэши клиентов только в этом процессе."""
+    for client_id in client_ids:
+        accounts.pop(client_id)
+        card_versions.set(client_id, next(_versions))
+
+
+def clear():
+    clients.clear()
+    accounts.clear()
+    keyboards.clear()
+    card_versions.clear()
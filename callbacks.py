@@ -0,0 +1,198 @@
+"""Маршрутизация callback-запросов по компактному callback_data.
+
+Вместо цепочки ``callback_query_handler(func=lambda call: call.data
+.startswith(...))``, где каждый callback проверяется всеми фильтрами по
+очереди, а обработчик заново разбирает строку ``split("_")``, кнопка несёт
+байты ``[версия][код действия][аргументы varint...]`` в base64url без
+выравнивания. Код действия сразу находит обработчик в словаре, аргументы
+приходят в него уже числами. Telegram ограничивает callback_data 64 байтами;
+это 48 байт данных, то есть до четырёх 64-битных id после заголовка.
+
+Кнопки другой версии и старые строковые кнопки из прошлых сообщений не
+разбираются дальше заголовка и отклоняются как устаревшие.
+
+Сравнение с цепочкой фильтров на диспетчеризации telebot:
+
+    python callbacks.py --handlers 5 20 50 100
+"""
+
+import argparse
+import base64
+import binascii
+import inspect
+import time
+
+from telebot import types
+
+# Меняется при несовместимом изменении кодов действий или их аргументов
+VERSION = 1
+
+# Ограничение Telegram на длину callback_data, байт
+MAX_CALLBACK_DATA = 64
+
+
+def _write_varint(value, out):
+    if value < 0:
+        raise ValueError("callback arguments must be non-negative integers")
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varints(raw, position):
+    values = []
+    value = shift = 0
+    for byte in raw[position:]:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        values.append(value)
+        value = shift = 0
+    if shift:
+        raise ValueError("truncated varint")
+    return values
+
+
+class CallbackRouter:
+    def __init__(self, version=VERSION):
+        self.version = version
+        # код действия -> (обработчик, число аргументов)
+        self._handlers = {}
+        # имя обработчика -> код действия
+        self._codes = {}
+        self.stale = 0
+
+    def route(self, code):
+        """Регистрирует обработчик ``handler(call, *args)`` под кодом действия.
+
+        Коды хранятся в уже отправленных кнопках, поэтому коду нельзя давать
+        другой смысл без смены VERSION.
+        """
+        if not 0 <= code <= 0xFF:
+            raise ValueError("action code must fit in one byte")
+
+        def decorator(handler):
+            if code in self._handlers:
+                raise ValueError(f"action code {code} is already taken")
+            arity = len(inspect.signature(handler).parameters) - 1
+            self._handlers[code] = (handler, arity)
+            self._codes[handler.__name__] = code
+            return handler
+
+        return decorator
+
+    def encode(self, handler, *args):
+        """callback_data для кнопки, вызывающей ``handler(call, *args)``."""
+        raw = bytearray((self.version, self._codes[handler.__name__]))
+        for arg in args:
+            _write_varint(int(arg), raw)
+        data = base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+        if len(data) > MAX_CALLBACK_DATA:
+            raise ValueError(f"callback_data is {len(data)} bytes, limit is 64")
+        return data
+
+    def button(self, text, handler, *args):
+        return types.InlineKeyboardButton(
+            text, callback_data=self.encode(handler, *args)
+        )
+
+    def resolve(self, data):
+        """(обработчик, аргументы) для callback_data или None для устаревшей
+        или чужой кнопки."""
+        try:
+            raw = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+        except (binascii.Error, ValueError):
+            raw = b""
+        if len(raw) < 2 or raw[0] != self.version:
+            self.stale += 1
+            return None
+        route = self._handlers.get(raw[1])
+        try:
+            args = _read_varints(raw, 2)
+        except ValueError:
+            args = None
+        if route is None or args is None or len(args) != route[1]:
+            self.stale += 1
+            return None
+        return route[0], args
+
+
+def _fake_call(data):
+    return types.CallbackQuery.de_json(
+        {
+            "id": "1",
+            "from": {"id": 1, "is_bot": False, "first_name": "Bench"},
+            "chat_instance": "1",
+            "data": data,
+        }
+    )
+
+
+def benchmark(handler_counts=(5, 20, 50, 100), calls=20000):
+    """Время диспетчеризации callback в telebot, мкс на вызов.
+
+    Возвращает список (число обработчиков, цепочка фильтров, роутер). Для
+    цепочки нажимается кнопка последнего обработчика — худший случай, как у
+    ``history_`` сейчас.
+    """
+    import telebot
+
+    results = []
+    for count in handler_counts:
+        names = [f"action{number}" for number in range(count)]
+
+        chain = telebot.TeleBot("123456:TEST", threaded=False)
+        for name in names:
+
+            def handler(call):
+                int(call.data.split("_")[-1])
+
+            chain.callback_query_handler(
+                func=lambda call, prefix=name + "_": call.data.startswith(prefix)
+            )(handler)
+
+        routed = telebot.TeleBot("123456:TEST", threaded=False)
+        router = CallbackRouter()
+        for code, name in enumerate(names):
+
+            def handler(call, card_id):
+                pass
+
+            handler.__name__ = name
+            router.route(code)(handler)
+
+        @routed.callback_query_handler(func=lambda call: True)
+        def route_callback(call):
+            route = router.resolve(call.data)
+            if route is not None:
+                route[0](call, *route[1])
+
+        timings = []
+        for bot, data in (
+            (chain, f"{names[-1]}_123456"),
+            (routed, router.encode(router._handlers[count - 1][0], 123456)),
+        ):
+            batch = [_fake_call(data)]
+            started = time.perf_counter()
+            for _ in range(calls):
+                bot.process_new_callback_query(batch)
+            timings.append((time.perf_counter() - started) / calls * 1e6)
+        results.append((count, *timings))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Стоимость маршрутизации callback")
+    parser.add_argument("--handlers", type=int, nargs="+", default=[5, 20, 50, 100])
+    parser.add_argument("--calls", type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    print(f"{'handlers':>8} {'lambda chain':>14} {'router':>10}")
+    for count, chain, routed in benchmark(args.handlers, args.calls):
+        print(f"{count:8} {chain:11.2f} us {routed:7.2f} us")
+
+
+if __name__ == "__main__":
+    main()
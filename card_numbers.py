@@ -0,0 +1,161 @@
+"""Выдача номеров карт без обращения к таблице cards.
+
+Номера берутся блоками из последовательности ``card_number_seq``: один
+``nextval`` резервирует за процессом ``INCREMENT BY`` номеров подряд, и
+следующие карты получают номера из памяти. Номер — 15 цифр из
+последовательности плюс контрольная цифра Луна, в формате XXXX XXXX XXXX XXXX.
+"""
+
+import threading
+from collections import deque
+
+from sqlalchemy import select
+
+from models import CARD_NUMBER_SEQUENCE, Card
+
+BODY_LENGTH = 15
+
+
+def luhn_check_digit(body):
+    total = 0
+    # Справа налево удваивается каждая вторая цифра, начиная с последней
+    # цифры тела: после неё встанет контрольная
+    for position, digit in enumerate(reversed(body)):
+        value = int(digit)
+        if position % 2 == 0:
+            value *= 2
+            if value > 9:
+                value -= 9
+        total += value
+    return str((10 - total % 10) % 10)
+
+
+def is_valid_card_number(card_number):
+    digits = card_number.replace(" ", "")
+    return digits.isdigit() and luhn_check_digit(digits[:-1]) == digits[-1]
+
+
+def is_numeric_card_number(card_number):
+    return card_number.replace(" ", "").isdigit()
+
+
+def format_card_number(value):
+    body = str(value).zfill(BODY_LENGTH)
+    if len(body) > BODY_LENGTH:
+        raise OverflowError("card number sequence exhausted")
+    digits = body + luhn_check_digit(body)
+    return " ".join(digits[i : i + 4] for i in range(0, len(digits), 4))
+
+
+# Номера карт по убыванию; нечисловые номера (старые карты вида
+# "0000 0000 0000 None") пропускаются при переборе, поэтому строки читаются
+# порциями, а не все сразу
+LAST_NUMBERS = (
+    select(Card.card_number)
+    .order_by(Card.card_number.desc())
+    .execution_options(yield_per=100)
+)
+
+
+class CardNumberAllocator:
+    def __init__(self, sequence=CARD_NUMBER_SEQUENCE):
+        self.sequence = sequence
+        self.block_size = sequence.increment or 1
+        self._blocks = deque()
+        self._lock = threading.Lock()
+        # Для баз без последовательностей (SQLite в тестах и разработке)
+        self._fallback_next = None
+        # (номер процесса, число процессов), см. partition
+        self._partition = (0, 1)
+
+    def _take(self):
+        with self._lock:
+            while self._blocks:
+                start, end = self._blocks[0]
+                if start < end:
+                    self._blocks[0] = (start + 1, end)
+                    return start
+                self._blocks.popleft()
+            return None
+
+    def _add_block(self, start):
+        with self._lock:
+            self._blocks.append((start, start + self.block_size))
+
+    def partition(self, index, count):
+        """Без последовательности процессы берут непересекающиеся блоки:
+        процесс ``index`` из ``count`` — каждый ``count``-й блок."""
+        with self._lock:
+            self._partition = (index, count)
+
+    def _fallback_block(self, last_number):
+        with self._lock:
+            index, count = self._partition
+            stride = self.block_size * count
+            if self._fallback_next is None:
+                # Тело следующего номера больше любого уже выданного
+                last = int(last_number.replace(" ", "")) if last_number else 0
+                start = last // 10 + 1
+                if count > 1:
+                    # Блоки процесса начинаются с одного остатка по модулю
+                    # stride и не пересекаются с блоками других процессов
+                    start = -(-start // stride) * stride + index * self.block_size
+                self._fallback_next = start
+            start = self._fallback_next
+            self._fallback_next += stride
+            return start
+
+    @staticmethod
+    def _last_number(session):
+        """Наибольший числовой номер карты или None."""
+        numbers = session.scalars(LAST_NUMBERS)
+        try:
+            return next(filter(is_numeric_card_number, numbers), None)
+        finally:
+            numbers.close()
+
+    @staticmethod
+    async def _last_number_async(session):
+        numbers = await session.stream_scalars(LAST_NUMBERS)
+        try:
+            async for number in numbers:
+                if is_numeric_card_number(number):
+                    return number
+            return None
+        finally:
+            await numbers.close()
+
+    def allocate(self, session):
+        """Возвращает новый отформатированный номер карты."""
+        value = self._take()
+        while value is None:
+            if session.get_bind().dialect.supports_sequences:
+                start = session.execute(select(self.sequence.next_value())).scalar()
+            else:
+                start = self._fallback_block(
+                    None
+                    if self._fallback_next is not None
+                    else self._last_number(session)
+                )
+            self._add_block(start)
+            value = self._take()
+        return format_card_number(value)
+
+    async def allocate_async(self, session):
+        """То же, что allocate, для AsyncSession."""
+        value = self._take()
+        while value is None:
+            if session.get_bind().dialect.supports_sequences:
+                start = await session.scalar(select(self.sequence.next_value()))
+            else:
+                start = self._fallback_block(
+                    None
+                    if self._fallback_next is not None
+                    else await self._last_number_async(session)
+                )
+            self._add_block(start)
+            value = self._take()
+        return format_card_number(value)
+
+
+allocator = CardNumberAllocator()
@@ -0,0 +1,164 @@
+"""Состояние многошаговых диалогов: регистрации, пополнения, перевода.
+
+Для чата хранится только имя следующего шага и его аргументы — id и строки,
+а не замыкания с сессиями и ORM-объектами, как у register_next_step_handler.
+Записи живут ``ttl`` секунд, их число ограничено ``maxsize``. С ``path``
+состояние хранится в SQLite-файле: диалог переживает перезапуск, и его может
+продолжить другой процесс с тем же файлом.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class Step:
+    """Следующий шаг диалога: имя обработчика и его именованные аргументы."""
+
+    __slots__ = ("name", "args", "expires")
+
+    def __init__(self, name, args, expires):
+        self.name = name
+        self.args = args
+        self.expires = expires
+
+    def __repr__(self):
+        return f"<Step({self.name}, {self.args})>"
+
+
+class ConversationStore:
+    """Шаги диалогов в памяти процесса, по записи на чат."""
+
+    def __init__(self, maxsize=10000, ttl=900.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._steps = OrderedDict()
+        self._lock = threading.Lock()
+
+    def set(self, chat_id, name, **args):
+        with self._lock:
+            self._steps[chat_id] = Step(name, args, time.time() + self.ttl)
+            self._steps.move_to_end(chat_id)
+            # Брошенные диалоги вытесняются первыми
+            while len(self._steps) > self.maxsize:
+                self._steps.popitem(last=False)
+
+    def pending(self, chat_id):
+        with self._lock:
+            step = self._steps.get(chat_id)
+            if step is not None and step.expires <= time.time():
+                del self._steps[chat_id]
+                step = None
+            return step is not None
+
+    def pop(self, chat_id):
+        """Забирает шаг чата; None, если его нет или он истёк."""
+        with self._lock:
+            step = self._steps.pop(chat_id, None)
+        if step is None or step.expires <= time.time():
+            return None
+        return step
+
+    def clear(self):
+        with self._lock:
+            self._steps.clear()
+
+    def __len__(self):
+        return len(self._steps)
+
+
+class SQLiteConversationStore(ConversationStore):
+    """Шаги диалогов в SQLite-файле, общем для процессов бота."""
+
+    # Как часто (в записях) удалять истёкшие и лишние шаги
+    PURGE_EVERY = 100
+
+    def __init__(self, path, maxsize=10000, ttl=900.0):
+        super().__init__(maxsize, ttl)
+        self.path = path
+        self._connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "chat_id INTEGER PRIMARY KEY, step TEXT NOT NULL, "
+            "args TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS ix_conversations_expires "
+            "ON conversations (expires)"
+        )
+        self._writes = 0
+
+    def set(self, chat_id, name, **args):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?)",
+                (chat_id, name, json.dumps(args), time.time() + self.ttl),
+            )
+            self._writes += 1
+            if self._writes % self.PURGE_EVERY == 0:
+                self._purge()
+
+    def _purge(self):
+        self._connection.execute(
+            "DELETE FROM conversations WHERE expires <= ?", (time.time(),)
+        )
+        self._connection.execute(
+            "DELETE FROM conversations WHERE chat_id IN ("
+            "SELECT chat_id FROM conversations ORDER BY expires LIMIT max("
+            "(SELECT count(*) FROM conversations) - ?, 0))",
+            (self.maxsize,),
+        )
+
+    def pending(self, chat_id):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM conversations WHERE chat_id = ? AND expires > ?",
+                (chat_id, time.time()),
+            ).fetchone()
+        return row is not None
+
+    def pop(self, chat_id):
+        with self._lock:
+            row = self._connection.execute(
+                "DELETE FROM conversations WHERE chat_id = ? "
+                "RETURNING step, args, expires",
+                (chat_id,),
+            ).fetchone()
+        if row is None or row[2] <= time.time():
+            return None
+        return Step(row[0], json.loads(row[1]), row[2])
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM conversations")
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute(
+                "SELECT count(*) FROM conversations"
+            ).fetchone()[0]
+
+
+# Имя шага -> обработчик; заполняется декоратором step
+handlers = {}
+
+store = ConversationStore()
+
+
+def step(handler):
+    """Регистрирует функцию как шаг диалога, доступный по имени."""
+    handlers[handler.__name__] = handler
+    return handler
+
+
+def configure(maxsize=10000, ttl=900.0, path=None):
+    global store
+    if path:
+        store = SQLiteConversationStore(path, maxsize, ttl)
+    else:
+        store = ConversationStore(maxsize, ttl)
@@ -0,0 +1,197 @@
+"""Подключение к базе: настройка пула соединений и жизненный цикл сессий.
+
+С репликами (``replica_urls`` в секции [database]) сессии, открытые с
+``read_only=True``, читают с реплик по очереди, остальные работают с
+основной базой. Пользователь, только что изменивший данные, ещё
+``sticky_seconds`` читает с основной базы, чтобы не увидеть отставшую
+реплику без своих изменений.
+"""
+
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session as BaseSession
+from sqlalchemy.pool import QueuePool
+
+# Параметры пула по умолчанию; переопределяются секцией [database] в config.ini
+POOL_DEFAULTS = {
+    "pool_size": 5,
+    "max_overflow": 10,
+    "pool_timeout": 30.0,
+    "pool_recycle": 1800,
+    "pool_pre_ping": True,
+}
+REPLICA_DEFAULTS = {"sticky_seconds": 5.0}
+
+
+class PoolStats:
+    """Сколько раз и как долго обработчики ждали свободное соединение."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def record(self, wait_time):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_time_total += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "wait_time_total": self.wait_time_total,
+                "wait_time_max": self.wait_time_max,
+            }
+
+
+pool_stats = PoolStats()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool, замеряющий ожидание соединения при исчерпании пула."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_stats.record(time.perf_counter() - started)
+
+
+def pool_options(config):
+    """Читает параметры пула из секции [database] конфигурации."""
+    section = "database"
+    return {
+        "pool_size": config.getint(
+            section, "pool_size", fallback=POOL_DEFAULTS["pool_size"]
+        ),
+        "max_overflow": config.getint(
+            section, "max_overflow", fallback=POOL_DEFAULTS["max_overflow"]
+        ),
+        "pool_timeout": config.getfloat(
+            section, "pool_timeout", fallback=POOL_DEFAULTS["pool_timeout"]
+        ),
+        "pool_recycle": config.getint(
+            section, "pool_recycle", fallback=POOL_DEFAULTS["pool_recycle"]
+        ),
+        "pool_pre_ping": config.getboolean(
+            section, "pool_pre_ping", fallback=POOL_DEFAULTS["pool_pre_ping"]
+        ),
+    }
+
+
+def build_engine(url, **options):
+    options = {**POOL_DEFAULTS, **options}
+    if make_url(url).get_backend_name() == "sqlite":
+        # У SQLite свой пул, параметры размера к нему неприменимы
+        return create_engine(url, pool_pre_ping=options["pool_pre_ping"])
+    return create_engine(url, poolclass=TimedQueuePool, **options)
+
+
+def replica_options(config):
+    """URL реплик и окно чтения своих записей из секции [database]."""
+    urls = config.get("database", "replica_urls", fallback="")
+    return {
+        "urls": [url.strip() for url in urls.split(",") if url.strip()],
+        "sticky_seconds": config.getfloat(
+            "database", "sticky_seconds", fallback=REPLICA_DEFAULTS["sticky_seconds"]
+        ),
+    }
+
+
+class ReplicaRouter:
+    """Выбирает реплику для чтения с учётом недавних записей пользователя."""
+
+    def __init__(self, engines=(), sticky_seconds=5.0):
+        self.engines = list(engines)
+        self.sticky_seconds = sticky_seconds
+        self._next = itertools.cycle(self.engines)
+        self._lock = threading.Lock()
+        # user_id -> monotonic-время, до которого читаем с основной базы
+        self._sticky = {}
+
+    def engine_for(self, user_id=None):
+        """Реплика для чтения или None, если читать нужно с основной базы."""
+        if not self.engines:
+            return None
+        if user_id is not None:
+            with self._lock:
+                until = self._sticky.get(user_id)
+                if until is not None:
+                    if until > time.monotonic():
+                        return None
+                    del self._sticky[user_id]
+        return next(self._next)
+
+    def mark_write(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            self._sticky[user_id] = now + self.sticky_seconds
+            if len(self._sticky) > 10000:
+                # Истёкшие отметки больше не нужны
+                for key in [k for k, until in self._sticky.items() if until <= now]:
+                    del self._sticky[key]
+
+
+replicas = ReplicaRouter()
+
+
+def configure_replicas(engines, sticky_seconds=5.0):
+    global replicas
+    replicas = ReplicaRouter(engines, sticky_seconds)
+
+
+class RoutingSession(BaseSession):
+    """Сессия, которая читает с реплики, если она открыта только для чтения."""
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        replica = self.info.get("replica")
+        if replica is None:
+            return super().get_bind(mapper, clause=clause, **kw)
+        if self._flushing:
+            raise RuntimeError("read-only session cannot write")
+        return replica
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _remember_write(session, flush_context):
+    session.info["wrote"] = True
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _mark_write(session):
+    user_id = session.info.get("user_id")
+    if session.info.pop("wrote", False) and user_id is not None:
+        replicas.mark_write(user_id)
+
+
+@contextmanager
+def session_scope(session_factory, read_only=False, user_id=None):
+    """Открывает сессию на время блока и всегда возвращает соединение в пул.
+
+    Коммиты остаются за обработчиком; при исключении транзакция откатывается.
+    ``read_only`` направляет чтение на реплику; ``user_id`` — кто действует:
+    после его записи чтение для него какое-то время идёт с основной базы.
+    """
+    session = session_factory()
+    if user_id is not None:
+        session.info["user_id"] = user_id
+    if read_only:
+        replica = replicas.engine_for(user_id)
+        if replica is not None:
+            session.info["replica"] = replica
+    try:
+        yield session
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
@@ -0,0 +1,160 @@
+"""Параллельная обработка обновлений с сохранением порядка внутри чата.
+
+Обновления разных чатов выполняются на ограниченном пуле потоков, а
+обновления одного чата — строго по очереди. Это сохраняет цепочки
+``register_next_step_handler`` (регистрация, пополнение, перевод), даже когда
+соседние чаты ждут медленных запросов к базе.
+"""
+
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def update_chat_id(update):
+    """Ключ очереди для обновления: id чата, иначе пользователя, иначе само обновление."""
+    for name in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        message = getattr(update, name, None)
+        if message is not None:
+            return message.chat.id
+
+    call = getattr(update, "callback_query", None)
+    if call is not None:
+        if call.message is not None:
+            return call.message.chat.id
+        return call.from_user.id
+
+    # Прочие обновления не участвуют в диалогах и могут идти параллельно
+    return ("update", update.update_id)
+
+
+class ChatDispatcher:
+    def __init__(self, bot, workers=8, chat_queue_size=100, max_pending=10000):
+        self.bot = bot
+        self.workers = workers
+        self.chat_queue_size = chat_queue_size
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="dispatcher"
+        )
+        self._condition = threading.Condition()
+        self._chats = {}
+        self._pending = 0
+        self._closed = False
+
+        # Счётчики
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+        # Обработчики выполняются в потоках диспетчера, а не в пуле telebot
+        bot.threaded = False
+
+    def submit(self, update, block=True, timeout=None):
+        """Ставит обновление в очередь его чата.
+
+        Если очередь чата или общий лимит заполнены, ждёт освобождения места
+        (``block=True``) или сразу бросает ``queue.Full``.
+        """
+        key = update_chat_id(update)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("dispatcher is shut down")
+
+            def has_room():
+                chat = self._chats.get(key)
+                return self._pending < self.max_pending and (
+                    chat is None or len(chat) < self.chat_queue_size
+                )
+
+            if not has_room():
+                if not block or not self._condition.wait_for(has_room, timeout):
+                    self.rejected += 1
+                    raise queue.Full
+
+            chat = self._chats.get(key)
+            if chat is None:
+                # Чат не обрабатывается — запускаем для него задачу
+                chat = self._chats[key] = deque()
+                self._executor.submit(self._drain, key)
+            chat.append((time.monotonic(), update))
+            self._pending += 1
+
+    def _drain(self, key):
+        with self._condition:
+            enqueued_at, update = self._chats[key][0]
+
+        wait_time = time.monotonic() - enqueued_at
+        try:
+            self.bot.process_new_updates([update])
+            failed = False
+        except Exception as e:
+            print("update error", e)
+            failed = True
+
+        with self._condition:
+            chat = self._chats[key]
+            chat.popleft()
+            self._pending -= 1
+            self.processed += 1
+            self.failed += failed
+            self.wait_time_total += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+            if chat:
+                # Следующее обновление чата встаёт в конец общего пула,
+                # чтобы один активный чат не занимал поток бесконечно
+                self._executor.submit(self._drain, key)
+            else:
+                del self._chats[key]
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {
+                "workers": self.workers,
+                "chat_queue_size": self.chat_queue_size,
+                "active_chats": len(self._chats),
+                "pending": self._pending,
+                "processed": self.processed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "wait_time_total": self.wait_time_total,
+                "wait_time_avg": (
+                    self.wait_time_total / self.processed if self.processed else 0.0
+                ),
+                "wait_time_max": self.wait_time_max,
+            }
+
+    def join(self, timeout=None):
+        """Ждёт, пока все поставленные обновления будут обработаны."""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._pending == 0, timeout)
+
+    def shutdown(self, timeout=None):
+        """Перестаёт принимать обновления и дорабатывает уже поставленные."""
+        with self._condition:
+            self._closed = True
+        self.join(timeout)
+        self._executor.shutdown(wait=True)
+
+
+def poll_updates(bot, dispatcher, stop_event=None, timeout=20):
+    """Long polling, который отдаёт обновления диспетчеру вместо обработки на месте."""
+    stop_event = stop_event or threading.Event()
+    offset = None
+    while not stop_event.is_set():
+        try:
+            updates = bot.get_updates(
+                offset=offset, timeout=timeout, long_polling_timeout=timeout
+            )
+        except Exception as e:
+            print("polling error", e)
+            stop_event.wait(3)
+            continue
+        for update in updates:
+            dispatcher.submit(update)
+            offset = update.update_id + 1
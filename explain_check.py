@@ -0,0 +1,134 @@
+"""Проверка по EXPLAIN, что горячие запросы обработчиков используют индексы.
+
+На Postgres запросы разбираются с ``enable_seqscan = off``: на маленькой
+таблице планировщик честно выберет полный проход, а нам важно, что индекс
+вообще применим. На SQLite используется EXPLAIN QUERY PLAN.
+
+    python explain_check.py                 # URL из alembic.ini
+    python explain_check.py --url postgresql://...
+"""
+
+import argparse
+import configparser
+import json
+import sys
+
+from sqlalchemy import create_engine, select, text
+
+from history import fetch_history_page_statement
+from models import Base, Card, Client, Loan
+
+# Запрос -> обработчики, которые его выполняют
+HOT_QUERIES = [
+    (
+        "clients by telegram_id",
+        "resolve_client, account, register",
+        select(Client.id, Client.first_name).where(Client.telegram_id == 1),
+    ),
+    (
+        "active loans by client",
+        "account, loan_pay",
+        select(Loan).where(Loan.client_id == 1, Loan.status == "active"),
+    ),
+    (
+        "cards by client",
+        "account, delete_card, top_up, transfer, callback_query_loan_pay",
+        select(Card).where(Card.client_id == 1),
+    ),
+    (
+        "card by number",
+        "process_transfer",
+        select(Card.id).where(Card.card_number == "0000 0000 0000 0000"),
+    ),
+    (
+        "card by id",
+        "callback_query_delete_card, finish_top_up, finish_transfer",
+        select(Card).where(Card.id == 1),
+    ),
+    (
+        "loan by id",
+        "callback_query_loan_pay, callback_query_loan_pay_card",
+        select(Loan).where(Loan.id == 1),
+    ),
+    (
+        "history page",
+        "history, callback_query_history",
+        fetch_history_page_statement(1, before=1000),
+    ),
+]
+
+
+def _postgres_plan(connection, sql):
+    with connection.begin():
+        connection.execute(text("SET LOCAL enable_seqscan = off"))
+        plan = connection.execute(text("EXPLAIN (FORMAT JSON) " + sql)).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    nodes = []
+    stack = [plan[0]["Plan"]]
+    while stack:
+        node = stack.pop()
+        nodes.append(
+            f"{node['Node Type']} {node.get('Index Name') or node.get('Relation Name') or ''}".strip()
+        )
+        stack.extend(node.get("Plans", []))
+    uses_index = any("Index" in node for node in nodes)
+    return uses_index and not any(node.startswith("Seq Scan") for node in nodes), nodes
+
+
+def _sqlite_plan(connection, sql):
+    rows = connection.execute(text("EXPLAIN QUERY PLAN " + sql)).all()
+    nodes = [row[-1] for row in rows]
+    # Проходы по подзапросам (SCAN anon_1) не касаются таблиц
+    uses_index = all(
+        "USING" in node and ("INDEX" in node or "PRIMARY KEY" in node)
+        for node in nodes
+        if node.startswith(("SCAN", "SEARCH"))
+        and node.split()[1] in Base.metadata.tables
+    )
+    return uses_index, nodes
+
+
+def check_indexes(connection):
+    """Возвращает список (запрос, обработчики, индекс используется, узлы плана)."""
+    explain = (
+        _postgres_plan if connection.dialect.name == "postgresql" else _sqlite_plan
+    )
+    results = []
+    for name, handlers, statement in HOT_QUERIES:
+        sql = str(
+            statement.compile(
+                dialect=connection.dialect, compile_kwargs={"literal_binds": True}
+            )
+        )
+        ok, nodes = explain(connection, sql)
+        results.append((name, handlers, ok, nodes))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="URL базы, по умолчанию из alembic.ini")
+    args = parser.parse_args(argv)
+
+    url = args.url
+    if not url:
+        alembic = configparser.ConfigParser()
+        alembic.read("alembic.ini")
+        url = alembic["alembic"]["sqlalchemy.url"]
+
+    engine = create_engine(url)
+    with engine.connect() as connection:
+        results = check_indexes(connection)
+    engine.dispose()
+
+    failed = False
+    for name, handlers, ok, nodes in results:
+        failed |= not ok
+        print(f"{'OK  ' if ok else 'FAIL'} {name} ({handlers}): {'; '.join(nodes)}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""Локальная подмена Bot API для тестов и нагрузочных прогонов.
+
+Сервер принимает запросы telebot (``/bot<token>/<method>``), запоминает их и
+отвечает так же, как Telegram, включая 429 с ``retry_after`` при превышении
+заданных лимитов. Обновления, поставленные ``push_update``, отдаются боту
+через ``getUpdates`` с long polling, ответы бота в чат ждутся
+``wait_for_replies``. Бот направляется на сервер через ``use_fake_api`` или
+``api_url`` в секции [telegram] config.ini.
+
+    python fake_bot_api.py --port 8081 --chat-limit 1 --global-limit 30
+
+С ``certfile`` сервер отвечает по HTTPS. Соединения держатся открытыми
+(HTTP/1.1 keep-alive), ``connections`` считает принятые.
+"""
+
+import argparse
+import json
+import ssl
+import threading
+import time
+from collections import defaultdict, deque
+from itertools import islice
+from contextlib import contextmanager
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from telebot import apihelper
+
+
+class FakeBotApi:
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        global_limit=None,
+        chat_limit=None,
+        retry_after=1,
+        latency=0.0,
+        certfile=None,
+        keyfile=None,
+    ):
+        # Лимиты — число запросов за скользящую секунду; None — без лимита
+        self.global_limit = global_limit
+        self.chat_limit = chat_limit
+        self.retry_after = retry_after
+        self.latency = latency
+        self.calls = []
+        self.rejected = 0
+        self.connections = 0
+        self.polls = 0
+        # chat_id -> [(метод, параметры, message_id)] в порядке вызовов
+        self.replies = defaultdict(list)
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._updates = deque()
+        self._next_update_id = 1
+        self._closed = False
+        self._global_window = deque()
+        self._chat_windows = defaultdict(deque)
+        self._message_ids = defaultdict(int)
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.scheme = "http"
+        if certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True)
+            self.scheme = "https"
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"{self.scheme}://{host}:{port}"
+
+    def start(self):
+        threading.Thread(
+            target=self.httpd.serve_forever, name="fake-bot-api", daemon=True
+        ).start()
+        return self
+
+    def stop(self):
+        with self._condition:
+            # Отпускает висящие getUpdates
+            self._closed = True
+            self._condition.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def push_update(self, update):
+        """Ставит обновление в очередь getUpdates, возвращает его update_id."""
+        with self._condition:
+            update = dict(update, update_id=self._next_update_id)
+            self._next_update_id += 1
+            self._updates.append(update)
+            self._condition.notify_all()
+        return update["update_id"]
+
+    def wait_for_poll(self, timeout=None, after=0):
+        """Ждёт getUpdates сверх первых ``after`` — бот запущен и готов
+        принимать обновления."""
+        with self._condition:
+            return self._condition.wait_for(lambda: self.polls > after, timeout)
+
+    def wait_for_replies(self, chat_id, seen, timeout=None):
+        """Ответы бота в чат после первых ``seen``; пустой список по таймауту."""
+        with self._condition:
+            replies = self.replies[str(chat_id)]
+            self._condition.wait_for(lambda: len(replies) > seen, timeout)
+            return replies[seen:]
+
+    def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        deadline = time.monotonic() + float(params.get("timeout") or 0)
+        with self._condition:
+            self.polls += 1
+            self._condition.notify_all()
+            while True:
+                while self._updates and self._updates[0]["update_id"] < offset:
+                    self._updates.popleft()
+                if self._updates:
+                    return list(islice(self._updates, limit))
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._closed:
+                    return []
+                self._condition.wait(remaining)
+
+    def calls_for(self, method):
+        with self._lock:
+            return [params for name, params in self.calls if name == method]
+
+    def _limited(self, window, limit, now):
+        while window and window[0] <= now - 1:
+            window.popleft()
+        return limit is not None and len(window) >= limit
+
+    def handle(self, method, params):
+        """Ответ на вызов метода: (HTTP-статус, JSON-ответ)."""
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": self._get_updates(params)}
+
+        chat_id = params.get("chat_id")
+        with self._lock:
+            now = time.monotonic()
+            chat_window = self._chat_windows[chat_id]
+            if self._limited(self._global_window, self.global_limit, now) or (
+                chat_id is not None and self._limited(chat_window, self.chat_limit, now)
+            ):
+                self.rejected += 1
+                return 429, {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }
+            self._global_window.append(now)
+            if chat_id is not None:
+                chat_window.append(now)
+            self.calls.append((method, params))
+            if method in ("sendMessage", "sendDocument"):
+                self._message_ids[chat_id] += 1
+                message_id = self._message_ids[chat_id]
+            else:
+                message_id = params.get("message_id")
+            if chat_id is not None:
+                self.replies[str(chat_id)].append((method, params, message_id))
+                self._condition.notify_all()
+
+        if method in ("sendMessage", "sendDocument", "editMessageText"):
+            result = {
+                "message_id": int(message_id or 0),
+                "date": int(time.time()),
+                "chat": {"id": int(chat_id or 0), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        elif method == "getMe":
+            result = {
+                "id": 1,
+                "is_bot": True,
+                "first_name": "Fake",
+                "username": "fake_bot",
+            }
+        else:
+            result = True
+        return 200, {"ok": True, "result": result}
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Заголовки и тело уходят одним пакетом, без задержки ACK
+            wbufsize = 64 * 1024
+
+            def setup(self):
+                super().setup()
+                with api._lock:
+                    api.connections += 1
+
+            def do_POST(self):
+                url = urlsplit(self.path)
+                method = url.path.rsplit("/", 1)[-1]
+                params = dict(parse_qsl(url.query))
+                params.update(self._body_params())
+                if api.latency:
+                    time.sleep(api.latency)
+                status, body = api.handle(method, params)
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST
+
+            def _body_params(self):
+                length = int(self.headers.get("Content-Length", 0))
+                if not length:
+                    return {}
+                body = self.rfile.read(length)
+                content_type = self.headers.get("Content-Type", "")
+                if content_type.startswith("application/json"):
+                    return json.loads(body)
+                if content_type.startswith("multipart/form-data"):
+                    # Файлы не нужны, только поля формы
+                    message = BytesParser(policy=HTTP).parsebytes(
+                        b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body
+                    )
+                    return {
+                        part.get_param("name", header="content-disposition"): (
+                            part.get_content()
+                            if part.get_filename() is None
+                            else part.get_filename()
+                        )
+                        for part in message.iter_parts()
+                    }
+                return dict(parse_qsl(body.decode("utf-8")))
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+@contextmanager
+def use_fake_api(api):
+    """Направляет все запросы telebot на ``api`` на время блока."""
+    previous = apihelper.API_URL
+    apihelper.API_URL = api.url + "/bot{0}/{1}"
+    try:
+        yield api
+    finally:
+        apihelper.API_URL = previous
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--global-limit", type=int)
+    parser.add_argument("--chat-limit", type=int)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args(argv)
+
+    api = FakeBotApi(
+        args.host,
+        args.port,
+        args.global_limit,
+        args.chat_limit,
+        args.retry_after,
+        args.latency,
+    )
+    print(f"Fake Bot API on {api.url}")
+    try:
+        api.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        api.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Постраничная история операций клиента.
+
+Страницы выбираются по ключу ``(client_id, id)`` вместо OFFSET: каждая
+страница — это два коротких прохода по индексам ``(client_id, id)`` и
+``(recipient_id, id)`` от курсора, поэтому время выборки не зависит от того,
+сколько операций у клиента накопилось.
+"""
+
+from sqlalchemy import select, union
+
+from models import Transaction
+
+PAGE_SIZE = 10
+
+TRANSACTION_TITLES = {
+    "top_up": "Пополнение",
+    "transfer": "Перевод",
+    "loan_pay": "Погашение кредита",
+}
+
+
+def fetch_history_page_statement(client_id, before=None, after=None, size=PAGE_SIZE):
+    """Запрос страницы на ``size + 1`` строк; лишняя строка показывает,
+    есть ли следующая страница."""
+    columns = (
+        Transaction.id,
+        Transaction.client_id,
+        Transaction.recipient_id,
+        Transaction.amount,
+        Transaction.transaction_type,
+    )
+    newer = after is not None
+    order = Transaction.id.asc() if newer else Transaction.id.desc()
+
+    def side(column):
+        query = select(*columns).where(column == client_id)
+        if newer:
+            query = query.where(Transaction.id > after)
+        elif before is not None:
+            query = query.where(Transaction.id < before)
+        return select(query.order_by(order).limit(size + 1).subquery())
+
+    # UNION убирает дубли операций, где клиент и отправитель, и получатель
+    page = union(side(Transaction.client_id), side(Transaction.recipient_id)).subquery()
+    return (
+        select(page)
+        .order_by(page.c.id.asc() if newer else page.c.id.desc())
+        .limit(size + 1)
+    )
+
+
+def fetch_history_page(session, client_id, before=None, after=None, size=PAGE_SIZE):
+    """Возвращает (операции от новых к старым, есть ли старее, есть ли новее).
+
+    ``before`` — id, старее которого нужна страница (кнопка «Далее»),
+    ``after`` — id, новее которого нужна страница (кнопка «Назад»).
+    """
+    rows = session.execute(
+        fetch_history_page_statement(client_id, before, after, size)
+    ).all()
+
+    has_more = len(rows) > size
+    rows = rows[:size]
+    if after is not None:
+        # Назад листают со страницы старее, значит, она существует
+        rows.reverse()
+        return rows, True, has_more
+    return rows, has_more, before is not None
+
+
+def render_history_page(client_id, rows):
+    if not rows:
+        return "История операций пуста."
+    lines = ["История операций:"]
+    for row in rows:
+        title = TRANSACTION_TITLES.get(row.transaction_type, row.transaction_type)
+        if row.transaction_type == "transfer":
+            incoming = row.recipient_id == client_id and row.client_id != client_id
+            sign = "+" if incoming else "-"
+        else:
+            sign = "-" if row.transaction_type == "loan_pay" else "+"
+        lines.append(f"#{row.id} {title}: {sign}{row.amount} ₽")
+    return "\n".join(lines)
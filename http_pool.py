@@ -0,0 +1,218 @@
+"""Общий пул HTTP-соединений для запросов бота к Bot API.
+
+По умолчанию telebot держит отдельную ``requests``-сессию в каждом потоке и
+пересоздаёт её раз в 10 минут, так что потоки диспетчера и очереди отправки
+открывают каждый своё TLS-соединение. Здесь все потоки делят один пул
+keep-alive соединений ограниченного размера (поток ждёт свободное
+соединение, а не открывает лишнее), таймауты задаются в конфигурации, а с
+``http2 = true`` запросы идут через httpx по HTTP/2.
+
+Сравнение задержек на локальном HTTPS-сервере:
+
+    python http_pool.py --requests 500 --threads 8
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from telebot import apihelper
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# Параметры по умолчанию; переопределяются секцией [http] в config.ini
+HTTP_DEFAULTS = {
+    "pool_size": 16,
+    "connect_timeout": 5.0,
+    "read_timeout": 30.0,
+    "http2": False,
+}
+
+
+class PooledSender:
+    """Отправитель запросов для ``apihelper.CUSTOM_REQUEST_SENDER``."""
+
+    def __init__(self, pool_size=16, http2=False, verify=True):
+        self.http2 = http2
+        if http2:
+            if httpx is None:
+                raise RuntimeError("httpx[http2] is required for HTTP/2")
+            self.client = httpx.Client(
+                http2=True,
+                verify=verify,
+                limits=httpx.Limits(
+                    max_connections=pool_size, max_keepalive_connections=pool_size
+                ),
+            )
+        else:
+            self.client = requests.Session()
+            self.client.verify = verify
+            adapter = HTTPAdapter(
+                pool_connections=2, pool_maxsize=pool_size, pool_block=True
+            )
+            self.client.mount("https://", adapter)
+            self.client.mount("http://", adapter)
+
+    def __call__(
+        self, method, url, params=None, files=None, timeout=None, proxies=None
+    ):
+        if not self.http2:
+            return self.client.request(
+                method,
+                url,
+                params=params,
+                files=files,
+                timeout=timeout,
+                proxies=proxies,
+            )
+        connect_timeout, read_timeout = timeout
+        response = self.client.request(
+            method,
+            url,
+            params=params,
+            files=files,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        )
+        # apihelper читает reason у ответа requests
+        response.reason = response.reason_phrase
+        return response
+
+    def close(self):
+        self.client.close()
+
+
+def http_options(config):
+    """Читает параметры пула из секции [http] конфигурации."""
+    section = "http"
+    return {
+        "pool_size": config.getint(
+            section, "pool_size", fallback=HTTP_DEFAULTS["pool_size"]
+        ),
+        "connect_timeout": config.getfloat(
+            section, "connect_timeout", fallback=HTTP_DEFAULTS["connect_timeout"]
+        ),
+        "read_timeout": config.getfloat(
+            section, "read_timeout", fallback=HTTP_DEFAULTS["read_timeout"]
+        ),
+        "http2": config.getboolean(section, "http2", fallback=HTTP_DEFAULTS["http2"]),
+    }
+
+
+def install(pool_size=16, connect_timeout=5.0, read_timeout=30.0, http2=False):
+    """Направляет все запросы telebot через общий пул; возвращает отправителя.
+
+    Таймауты задаются через apihelper, чтобы telebot по-прежнему удлинял
+    таймаут чтения для long polling.
+    """
+    apihelper.CONNECT_TIMEOUT = connect_timeout
+    apihelper.READ_TIMEOUT = read_timeout
+    sender = PooledSender(pool_size, http2)
+    apihelper.CUSTOM_REQUEST_SENDER = sender
+    return sender
+
+
+def _self_signed_certificate(directory):
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=127.0.0.1",
+            "-addext",
+            "subjectAltName=IP:127.0.0.1",
+            "-keyout",
+            keyfile,
+            "-out",
+            certfile,
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return certfile, keyfile
+
+
+def benchmark(requests_count=500, threads=8, pool_size=16):
+    """Задержки send_message к локальному HTTPS-серверу в разных режимах.
+
+    Возвращает список (режим, p50 мс, p95 мс, открыто соединений).
+    """
+    import telebot
+
+    from fake_bot_api import FakeBotApi, use_fake_api
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        certfile, keyfile = _self_signed_certificate(directory)
+        # Сессии telebot по умолчанию доверяют сертификату через окружение
+        os.environ["REQUESTS_CA_BUNDLE"] = certfile
+        scenarios = [
+            ("new connection per request", 0, None),
+            ("telebot default (per-thread sessions)", 600, None),
+            ("shared keep-alive pool", 600, PooledSender(pool_size, verify=certfile)),
+        ]
+        for name, session_ttl, sender in scenarios:
+            api = FakeBotApi(certfile=certfile, keyfile=keyfile).start()
+            bot = telebot.TeleBot("123456:TEST", threaded=False)
+            apihelper.SESSION_TIME_TO_LIVE = session_ttl
+            apihelper.CUSTOM_REQUEST_SENDER = sender
+
+            def send(number):
+                started = time.perf_counter()
+                bot.send_message(number % 50, "ping")
+                return time.perf_counter() - started
+
+            try:
+                with use_fake_api(api), ThreadPoolExecutor(threads) as executor:
+                    latencies = sorted(executor.map(send, range(requests_count)))
+            finally:
+                apihelper.CUSTOM_REQUEST_SENDER = None
+                apihelper.SESSION_TIME_TO_LIVE = 600
+                if sender is not None:
+                    sender.close()
+                api.stop()
+            results.append(
+                (
+                    name,
+                    statistics.median(latencies) * 1000,
+                    latencies[int(len(latencies) * 0.95) - 1] * 1000,
+                    api.connections,
+                )
+            )
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Задержки запросов к Bot API")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--pool-size", type=int, default=16)
+    args = parser.parse_args(argv)
+
+    for name, p50, p95, connections in benchmark(
+        args.requests, args.threads, args.pool_size
+    ):
+        print(
+            f"{name:40} p50 {p50:6.2f} ms  p95 {p95:6.2f} ms  "
+            f"{connections} connections"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""Поиск по JSONL-логам бота через индекс смещений.
+
+Индекс лежит рядом с логом (``log_DD.MM.YYYY.jsonl.idx``) и состоит из
+отсортированных блоков записей фиксированной длины ``(вид ключа, ключ,
+смещение)``. Поиск делает бинарный поиск в каждом блоке и читает из лога
+только нужные строки.
+
+Лог текущего дня растёт, поэтому индекс помнит, до какого смещения он
+построен, и перед поиском дописывает блок только для новых строк. Блок
+собирается в памяти не больше чем из ``CHUNK_ENTRIES`` записей; когда блоков
+становится больше ``MAX_RUNS``, они сливаются в один потоково.
+
+    python log_query.py index logs/log_01.01.2025.jsonl
+    python log_query.py query logs/log_01.01.2025.jsonl --user-id 67890
+    python log_query.py query logs/log_01.01.2025.jsonl --chat-id 12345
+"""
+
+import argparse
+import heapq
+import json
+import os
+import struct
+import sys
+
+INDEX_MAGIC = b"QLIDX2\n\0"
+# Проиндексированная часть лога в байтах и число блоков
+HEADER = struct.Struct("<8sqq")
+# Число записей в блоке
+RUN_HEADER = struct.Struct("<q")
+# Вид ключа, ключ, смещение строки в логе
+RECORD = struct.Struct("<bqq")
+
+# Записей в блоке, который сортируется в памяти
+CHUNK_ENTRIES = 200_000
+# Больше блоков сливаются в один, чтобы поиск не обходил их все
+MAX_RUNS = 16
+# Записей, читаемых и записываемых за раз при слиянии
+MERGE_BATCH = 4096
+
+KEY_KINDS = {"user_id": 0, "chat_id": 1}
+
+
+def index_path(log_path):
+    return log_path + ".idx"
+
+
+def _read_header(index):
+    """(проиндексированный размер лога, число блоков) или None."""
+    index.seek(0)
+    try:
+        magic, size, runs = HEADER.unpack(index.read(HEADER.size))
+    except struct.error:
+        return None
+    return (size, runs) if magic == INDEX_MAGIC else None
+
+
+def _runs(index, runs):
+    """(позиция первой записи, число записей) для каждого блока."""
+    layout = []
+    position = HEADER.size
+    for _ in range(runs):
+        index.seek(position)
+        (count,) = RUN_HEADER.unpack(index.read(RUN_HEADER.size))
+        position += RUN_HEADER.size
+        layout.append((position, count))
+        position += count * RECORD.size
+    return layout
+
+
+def _write_run(index, entries):
+    entries.sort()
+    index.write(RUN_HEADER.pack(len(entries)))
+    index.write(b"".join(RECORD.pack(*entry) for entry in entries))
+
+
+def _index_lines(log_path, offset, index, chunk_entries):
+    """Дописывает в ``index`` блоки для строк лога после ``offset``.
+
+    Возвращает (конец последней полной строки, число блоков, число записей).
+    """
+    runs = total = 0
+    entries = []
+    with open(log_path, "rb") as log:
+        log.seek(offset)
+        for line in log:
+            if not line.endswith(b"\n"):
+                # Строка ещё дописывается, её проиндексирует следующий поиск
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Мусор — пропускаем
+                offset += len(line)
+                continue
+            for name, kind in KEY_KINDS.items():
+                if record.get(name) is not None:
+                    entries.append((kind, record[name], offset))
+            offset += len(line)
+            if len(entries) >= chunk_entries:
+                _write_run(index, entries)
+                runs += 1
+                total += len(entries)
+                entries = []
+    if entries:
+        _write_run(index, entries)
+        runs += 1
+        total += len(entries)
+    return offset, runs, total
+
+
+def _read_run(path, position, count):
+    with open(path, "rb") as index:
+        index.seek(position)
+        while count:
+            batch = min(count, MERGE_BATCH)
+            yield from RECORD.iter_unpack(index.read(batch * RECORD.size))
+            count -= batch
+
+
+def _compact(log_path):
+    """Сливает блоки индекса в один, держа в памяти по пачке из каждого."""
+    path = index_path(log_path)
+    with open(path, "rb") as index:
+        size, runs = _read_header(index)
+        layout = _runs(index, runs)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as merged:
+        merged.write(HEADER.pack(INDEX_MAGIC, size, 1))
+        merged.write(RUN_HEADER.pack(sum(count for _, count in layout)))
+        batch = []
+        for entry in heapq.merge(*(_read_run(path, *run) for run in layout)):
+            batch.append(RECORD.pack(*entry))
+            if len(batch) >= MERGE_BATCH:
+                merged.write(b"".join(batch))
+                batch.clear()
+        merged.write(b"".join(batch))
+    os.replace(tmp_path, path)
+
+
+def build_index(log_path, chunk_entries=CHUNK_ENTRIES):
+    """Строит индекс заново по всему логу; возвращает число записей."""
+    path = index_path(log_path)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as index:
+        index.write(HEADER.pack(INDEX_MAGIC, 0, 0))
+        size, runs, total = _index_lines(log_path, 0, index, chunk_entries)
+        index.seek(0)
+        index.write(HEADER.pack(INDEX_MAGIC, size, runs))
+    os.replace(tmp_path, path)
+    if runs > MAX_RUNS:
+        _compact(log_path)
+    return total
+
+
+def update_index(log_path, chunk_entries=CHUNK_ENTRIES):
+    """Дописывает в индекс строки, появившиеся в логе после его построения.
+
+    Возвращает число добавленных записей.
+    """
+    path = index_path(log_path)
+    try:
+        with open(path, "rb") as index:
+            header = _read_header(index)
+    except OSError:
+        header = None
+    log_size = os.path.getsize(log_path)
+    if header is None or header[0] > log_size:
+        # Индекса нет, он старого формата или лог пересоздан
+        return build_index(log_path, chunk_entries)
+    size, runs = header
+    if size == log_size:
+        return 0
+
+    with open(path, "r+b") as index:
+        layout = _runs(index, runs)
+        position, count = layout[-1] if layout else (HEADER.size, 0)
+        # Недописанный прошлым обновлением хвост отбрасывается
+        index.seek(position + count * RECORD.size)
+        index.truncate()
+        size, added, total = _index_lines(log_path, size, index, chunk_entries)
+        index.seek(0)
+        index.write(HEADER.pack(INDEX_MAGIC, size, runs + added))
+    if runs + added > MAX_RUNS:
+        _compact(log_path)
+    return total
+
+
+def _lower_bound(index, start, count, key):
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        index.seek(start + middle * RECORD.size)
+        if RECORD.unpack(index.read(RECORD.size)) < key:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def lookup(log_path, key_name, key):
+    """Возвращает смещения строк лога с данным user_id или chat_id."""
+    update_index(log_path)
+
+    kind = KEY_KINDS[key_name]
+    offsets = []
+    with open(index_path(log_path), "rb") as index:
+        _, runs = _read_header(index)
+        # Блоки идут в порядке лога, так что смещения остаются по возрастанию
+        for start, count in _runs(index, runs):
+            position = _lower_bound(index, start, count, (kind, key, -(2**63)))
+            index.seek(start + position * RECORD.size)
+            while position < count:
+                record_kind, record_key, offset = RECORD.unpack(index.read(RECORD.size))
+                if (record_kind, record_key) != (kind, key):
+                    break
+                offsets.append(offset)
+                position += 1
+    return offsets
+
+
+def query(log_path, key_name, key):
+    """Генерирует записи лога с данным ключом, не читая лог целиком."""
+    with open(log_path, "rb") as log:
+        for offset in lookup(log_path, key_name, key):
+            log.seek(offset)
+            yield json.loads(log.readline())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    index_parser = subparsers.add_parser("index", help="построить индекс")
+    index_parser.add_argument("log")
+
+    query_parser = subparsers.add_parser("query", help="найти записи")
+    query_parser.add_argument("log")
+    key = query_parser.add_mutually_exclusive_group(required=True)
+    key.add_argument("--user-id", type=int)
+    key.add_argument("--chat-id", type=int)
+
+    args = parser.parse_args(argv)
+    if args.command == "index":
+        print(f"{build_index(args.log)} keys indexed")
+        return
+
+    if args.user_id is not None:
+        records = query(args.log, "user_id", args.user_id)
+    else:
+        records = query(args.log, "chat_id", args.chat_id)
+    for record in records:
+        sys.stdout.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,171 @@
+import atexit
+import json
 import os
+import queue
+import threading
+import time
 from datetime import datetime
 
+# Директория для логов
+LOG_DIRECTORY = "logs"
 
-def log_message_info(message):
-    # Директория для логов
-    log_directory = "logs"
 
-    # Создание директории, если она не существует
-    if not os.path.exists(log_directory):
-        os.makedirs(log_directory)
+class LogWriter:
+    """Фоновый писатель логов.
 
-    # Получаем дату для названия файла
-    log_filename = os.path.join(
-        log_directory, f"log_{datetime.now().strftime('%d.%m.%Y')}.log"
-    )
+    Записи складываются в очередь, а отдельный поток пишет их пачками в
+    открытый файл текущего дня. Пачка сбрасывается на диск, когда набралось
+    ``batch_size`` записей или прошло ``flush_interval`` секунд. При смене
+    даты файл переоткрывается, при остановке очередь дописывается до конца.
+    """
 
-    # Информация о пользователе
-    user_data = {
-        "user_id": message.from_user.id,
-        "username": message.from_user.username,
-        "first_name": message.from_user.first_name,
-        "last_name": message.from_user.last_name,
-        "language_code": message.from_user.language_code,
-    }
+    _STOP = object()
 
-    # Информация о чате
-    chat_data = {
-        "chat_id": message.chat.id,
-        "chat_type": message.chat.type,
-        "chat_title": message.chat.title if message.chat.title else "Личный чат",
-    }
+    def __init__(
+        self,
+        directory=LOG_DIRECTORY,
+        batch_size=100,
+        flush_interval=1.0,
+        max_queue_size=10000,
+        extension="log",
+    ):
+        self.directory = directory
+        self.extension = extension
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._file = None
+        self._file_date = None
 
-    # Информация о сообщении
-    message_text = message.text if message.content_type == "text" else None
-    file_id = None
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="log-writer", daemon=True
+                )
+                self._thread.start()
+
+    def write(self, date, entry):
+        """Ставит запись в очередь; ``date`` определяет файл, в который она попадёт."""
+        if self._thread is None:
+            self.start()
+        self._queue.put((date, entry))
+
+    def flush(self):
+        """Блокирует вызывающий поток, пока все поставленные записи не записаны."""
+        if self._thread is not None:
+            self._queue.join()
+
+    def stop(self, timeout=None):
+        """Дописывает очередь, закрывает файл и останавливает поток."""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is None:
+            return
+        self._queue.put(self._STOP)
+        thread.join(timeout)
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                item = None
+
+            if item is self._STOP:
+                try:
+                    self._write_batch(batch)
+                except OSError as e:
+                    print("log error", e)
+                self._queue.task_done()
+                self._close()
+                return
+
+            if item is not None:
+                batch.append(item)
+
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                try:
+                    self._write_batch(batch)
+                except OSError as e:
+                    print("log error", e)
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+
+    def _write_batch(self, batch):
+        if not batch:
+            return
+        try:
+            # Записи группируются по дате, чтобы пачка на стыке суток
+            # разошлась по двум файлам
+            chunk = []
+            for date, entry in batch:
+                if date != self._file_date and chunk:
+                    self._file.write("".join(chunk))
+                    chunk = []
+                if date != self._file_date:
+                    self._open(date)
+                chunk.append(entry)
+            self._file.write("".join(chunk))
+            self._file.flush()
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    def _open(self, date):
+        self._close()
+        # Создание директории, если она не существует
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        log_filename = os.path.join(self.directory, f"log_{date}.{self.extension}")
+        # Запись лога в файл с кодировкой UTF-8
+        self._file = open(log_filename, "a", encoding="utf-8")
+        self._file_date = date
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._file_date = None
+
+
+# Формат лога -> расширение файла
+LOG_FORMATS = {"text": "log", "jsonl": "jsonl"}
+
+_writer = LogWriter()
+_format = "text"
 
+
+def configure(log_format="text", **writer_options):
+    """Выбирает формат лога и параметры писателя.
+
+    ``text`` пишет прежний многострочный блок в ``log_DD.MM.YYYY.log``,
+    ``jsonl`` пишет одну JSON-запись на строку в ``log_DD.MM.YYYY.jsonl``.
+    """
+    global _writer, _format
+    if log_format not in LOG_FORMATS:
+        raise ValueError(f"Unknown log format: {log_format}")
+    _writer.stop()
+    _writer = LogWriter(extension=LOG_FORMATS[log_format], **writer_options)
+    _format = log_format
+
+
+def shutdown():
+    _writer.stop()
+
+
+atexit.register(shutdown)
+
+
+def message_record(message):
+    """Собирает поля сообщения в словарь со стабильной схемой JSONL-лога."""
     # Получаем ID файла, если сообщение содержит медиафайл
+    file_id = None
     if message.content_type == "photo":
         file_id = message.photo[-1].file_id  # Фото с наивысшим разрешением
     elif message.content_type == "document":
@@ -49,23 +179,54 @@ def log_message_info(message):
     elif message.content_type == "sticker":
         file_id = message.sticker.file_id
 
+    return {
+        "ts": datetime.utcnow().isoformat(),
+        # Информация о пользователе
+        "user_id": message.from_user.id,
+        "username": message.from_user.username,
+        "first_name": message.from_user.first_name,
+        "last_name": message.from_user.last_name,
+        "language_code": message.from_user.language_code,
+        # Информация о чате
+        "chat_id": message.chat.id,
+        "chat_type": message.chat.type,
+        "chat_title": message.chat.title,
+        # Информация о сообщении
+        "type": message.content_type,
+        "text": message.text if message.content_type == "text" else None,
+        "file_id": file_id,
+    }
+
+
+def format_text(record):
     # Формируем строку для записи в лог-файл
-    log_entry = (
-        f"Timestamp: {datetime.utcnow().isoformat()}\n"
-        f"User ID: {user_data['user_id']}\n"
-        f"Username: {user_data['username']}\n"
-        f"First Name: {user_data['first_name']}\n"
-        f"Last Name: {user_data['last_name']}\n"
-        f"Language Code: {user_data['language_code']}\n"
-        f"Chat ID: {chat_data['chat_id']}\n"
-        f"Chat Type: {chat_data['chat_type']}\n"
-        f"Chat Title: {chat_data['chat_title']}\n"
-        f"Message Type: {message.content_type}\n"
-        f"Message Text: {message_text if message_text else 'Не текстовое сообщение'}\n"
-        f"File ID: {file_id if file_id else 'Нет файла'}\n"
+    return (
+        f"Timestamp: {record['ts']}\n"
+        f"User ID: {record['user_id']}\n"
+        f"Username: {record['username']}\n"
+        f"First Name: {record['first_name']}\n"
+        f"Last Name: {record['last_name']}\n"
+        f"Language Code: {record['language_code']}\n"
+        f"Chat ID: {record['chat_id']}\n"
+        f"Chat Type: {record['chat_type']}\n"
+        f"Chat Title: {record['chat_title'] if record['chat_title'] else 'Личный чат'}\n"
+        f"Message Type: {record['type']}\n"
+        f"Message Text: {record['text'] if record['text'] else 'Не текстовое сообщение'}\n"
+        f"File ID: {record['file_id'] if record['file_id'] else 'Нет файла'}\n"
         f"{'-'*40}\n"  # Разделитель между записями
     )
 
-    # Запись лога в файл с кодировкой UTF-8
-    with open(log_filename, "a", encoding="utf-8") as file:
-        file.write(log_entry)
+
+def format_jsonl(record):
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+def log_message_info(message):
+    record = message_record(message)
+    if _format == "jsonl":
+        log_entry = format_jsonl(record)
+    else:
+        log_entry = format_text(record)
+
+    # Запись уходит в фоновый поток, дата определяет файл
+    _writer.write(datetime.now().strftime("%d.%m.%Y"), log_entry)
@@ -1,30 +1,69 @@
 import configparser
+import hashlib
+import json
 import telebot
-from telebot import types
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from models import Client, Card, Transaction, Loan
+from telebot import apihelper, types
+from sqlalchemy.orm import joinedload, sessionmaker
+from models import Client, Card, Loan
 import re
+import tempfile
 from datetime import datetime, timedelta
+import cache
+import callbacks
+import card_numbers
+import conversations
+import http_pool
+import logger
+import metrics
+import query_profiler
+import statement
+import transfers
+from cache import remember_client, resolve_client
 from logger import log_message_info
+from history import fetch_history_page, render_history_page
+from db import (
+    RoutingSession,
+    build_engine,
+    configure_replicas,
+    pool_options,
+    replica_options,
+    session_scope,
+)
+from dispatcher import ChatDispatcher, poll_updates
+from outbox import Outbox
+from webhook import WebhookServer
 
-# Config
+# Бот, очередь отправки и фабрика сессий создаются при импорте без сети и
+# чтения конфигурации, чтобы обработчики можно было импортировать в тестах и
+# утилитах. Токен, база и меню команд настраиваются в create_app().
 config = configparser.ConfigParser()
-config.read("config.ini")
-API_TOKEN = config["telegram"]["token"]
-
-# Bot initialization
-bot = telebot.TeleBot(API_TOKEN)
-
-# DB connection
-try:
-    alembic = configparser.ConfigParser()
-    alembic.read("alembic.ini")
-    DATABASE_URL = alembic["alembic"]["sqlalchemy.url"]
-    Session = sessionmaker(bind=create_engine(DATABASE_URL))
-except Exception as e:
-    print("db error", e)
-    exit()
+bot = telebot.TeleBot("", validate_token=False)
+# Исходящие запросы идут через очередь с учётом лимитов Telegram
+outbox = Outbox(bot)
+# Объекты остаются читаемыми после commit без повторного SELECT; сессии
+# только для чтения идут на реплики, если они настроены
+Session = sessionmaker(class_=RoutingSession, expire_on_commit=False)
+engine = None
+# Профилирование запросов: медленные запросы и N+1, выключено по умолчанию
+profiler = None
+
+# callback_data кнопок кодируется роутером, см. callbacks.py
+router = callbacks.CallbackRouter()
+
+# Где хранится хэш последнего отправленного в Telegram меню команд
+COMMANDS_CACHE = "commands.sha256"
+
+# Metrics
+metrics.registry.gauge(
+    "bot_conversations_active",
+    "Незавершённые многошаговые диалоги",
+    lambda: len(conversations.store),
+)
+metrics.registry.gauge(
+    "bot_outbox_queue_depth",
+    "Запросы к Bot API в очереди отправки",
+    lambda: outbox.stats()["queue_depth"],
+)
 
 # Определение команд для меню
 commands = [
@@ -37,10 +76,131 @@ commands = [
     types.BotCommand("loan_pay", "Погасить кредит"),
     types.BotCommand("top_up", "Пополнить карту"),
     types.BotCommand("transfer", "Перевод с карты на карту"),
+    types.BotCommand("history", "История операций"),
+    types.BotCommand("statement", "Выписка за месяц"),
 ]
 
-# Установка команд в меню бота
-bot.set_my_commands(commands)
+
+def create_app(config_path="config.ini", alembic_path="alembic.ini"):
+    """Читает конфигурацию, подключает базу и синхронизирует меню команд.
+
+    Повторный вызов ничего не делает. Возвращает настроенного бота.
+    """
+    global engine, outbox, profiler
+    if engine is not None:
+        return bot
+
+    # Config
+    config.read(config_path)
+    bot.token = config["telegram"]["token"]
+    bot.bot_id = telebot.util.extract_bot_id(bot.token)
+
+    # Logging
+    logger.configure(config.get("logging", "format", fallback="text"))
+
+    # Caches
+    cache.configure(
+        client_cache_size=config.getint("cache", "client_cache_size", fallback=10000),
+        client_cache_ttl=config.getfloat("cache", "client_cache_ttl", fallback=300.0),
+        account_cache_size=config.getint("cache", "account_cache_size", fallback=10000),
+        account_cache_ttl=config.getfloat("cache", "account_cache_ttl", fallback=30.0),
+        keyboard_cache_size=config.getint(
+            "cache", "keyboard_cache_size", fallback=10000
+        ),
+        keyboard_cache_ttl=config.getfloat(
+            "cache", "keyboard_cache_ttl", fallback=30.0
+        ),
+    )
+
+    # Conversation state
+    conversations.configure(
+        maxsize=config.getint("conversations", "max_size", fallback=10000),
+        ttl=config.getfloat("conversations", "ttl", fallback=900.0),
+        path=config.get("conversations", "path", fallback=None),
+    )
+
+    # Bot initialization
+    # Все запросы к Bot API идут через общий пул keep-alive соединений
+    http_pool.install(**http_pool.http_options(config))
+    apihelper.CUSTOM_REQUEST_SENDER = metrics.instrument_sender(
+        apihelper.CUSTOM_REQUEST_SENDER
+    )
+    if config.get("telegram", "api_url", fallback=None):
+        # Свой сервер Bot API или локальная подмена для нагрузочных прогонов
+        apihelper.API_URL = config["telegram"]["api_url"].rstrip("/") + "/bot{0}/{1}"
+
+    outbox = Outbox(
+        bot,
+        global_rate=config.getfloat("outbox", "global_rate", fallback=30.0),
+        chat_rate=config.getfloat("outbox", "chat_rate", fallback=1.0),
+        chat_burst=config.getint("outbox", "chat_burst", fallback=3),
+        workers=config.getint("outbox", "workers", fallback=4),
+        max_retries=config.getint("outbox", "max_retries", fallback=5),
+    )
+
+    # DB connection
+    try:
+        alembic = configparser.ConfigParser()
+        alembic.read(alembic_path)
+        database_url = alembic["alembic"]["sqlalchemy.url"]
+        engine = build_engine(database_url, **pool_options(config))
+        Session.configure(bind=engine)
+        replicas = replica_options(config)
+        replica_engines = [
+            build_engine(url, **pool_options(config)) for url in replicas["urls"]
+        ]
+        configure_replicas(replica_engines, replicas["sticky_seconds"])
+        for instrumented in [engine] + replica_engines:
+            metrics.instrument_engine(instrumented)
+    except Exception as e:
+        print("db error", e)
+        exit()
+
+    if config.getboolean("profiling", "enabled", fallback=False):
+        profiler = query_profiler.QueryProfiler(
+            slow_threshold=config.getfloat("profiling", "slow_query_ms", fallback=100.0)
+            / 1000,
+            n_plus_one_threshold=config.getint("profiling", "n_plus_one", fallback=5),
+        )
+        for profiled in [engine] + replica_engines:
+            profiler.attach(profiled)
+        profiler.instrument_bot(bot, label=metrics.handler_label)
+
+    sync_commands(config.get("telegram", "commands_cache", fallback=COMMANDS_CACHE))
+    return bot
+
+
+def commands_hash():
+    """Хэш меню вместе с ботом и сервером API, которым оно отправлено."""
+    payload = json.dumps(
+        [bot.bot_id, apihelper.API_URL, [command.to_dict() for command in commands]],
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def sync_commands(cache_path=COMMANDS_CACHE):
+    """Устанавливает меню команд, если оно изменилось с прошлого запуска.
+
+    Возвращает True, если меню отправлено в Telegram.
+    """
+    digest = commands_hash()
+    try:
+        with open(cache_path, encoding="utf-8") as file:
+            if file.read().strip() == digest:
+                return False
+    except OSError:
+        pass
+
+    try:
+        bot.set_my_commands(commands)
+    except Exception as e:
+        print("commands error", e)
+        return False
+    with open(cache_path, "w", encoding="utf-8") as file:
+        file.write(digest)
+    return True
 
 
 def escape_markdown(text):
@@ -51,16 +211,36 @@ def escape_markdown(text):
 
 
 def check_client(session, telegram_id) -> bool:
-    client = session.query(Client).filter(Client.telegram_id == telegram_id).first()
-    if not client:
-        return False
-    return True
+    return resolve_client(session, telegram_id) is not None
+
+
+def relabel(name):
+    """Метка обновления в метриках и профиле — настоящий обработчик."""
+    metrics.relabel(name)
+    if profiler is not None:
+        profiler.relabel(name)
+
+
+def register_next_step(message, handler, **kwargs):
+    conversations.store.set(message.chat.id, handler.__name__, **kwargs)
+
+
+# Шаг диалога обрабатывается раньше команд, как и next-step обработчики TeleBot
+@bot.message_handler(
+    func=lambda message: conversations.store.pending(message.chat.id),
+    content_types=["text"],
+)
+def process_next_step(message):
+    step = conversations.store.pop(message.chat.id)
+    if step is not None:
+        relabel(step.name)
+        conversations.handlers[step.name](message, **step.args)
 
 
 @bot.message_handler(commands=["start"])
 def send_welcome(message):
     log_message_info(message)
-    bot.send_message(message.chat.id, "Привет! Я банковский бот.")
+    outbox.send_message(message.chat.id, "Привет! Я банковский бот.")
 
 
 @bot.message_handler(commands=["help"])
@@ -74,517 +254,625 @@ def send_help(message):
         "/create_card - Создать карту\n"
         "/loan_pay - Погасить кредит\n"
         "/top_up - Пополнить карту\n"
-        "/transfer - Перевод с карты на карту"
+        "/transfer - Перевод с карты на карту\n"
+        "/history - История операций\n"
+        "/statement - Выписка за месяц"
     )
-    bot.send_message(message.chat.id, help_text)
+    outbox.send_message(message.chat.id, help_text)
 
 
 @bot.message_handler(commands=["register"])
 def register(message):
     log_message_info(message)
-    session = Session()
-    client = (
-        session.query(Client).filter(Client.telegram_id == message.from_user.id).first()
-    )
+    with session_scope(Session) as session:
+        client = resolve_client(session, message.from_user.id)
     if client:
-        bot.send_message(
+        outbox.send_message(
             message.chat.id, f"{client.first_name}, Вы уже зарегистрированы!"
         )
         return
 
-    bot.send_message(message.chat.id, "Пожалуйста, введите вашу фамилию (last name):")
-    bot.register_next_step_handler(message, process_last_name)
+    outbox.send_message(
+        message.chat.id, "Пожалуйста, введите вашу фамилию (last name):"
+    )
+    register_next_step(message, process_last_name)
 
 
+@conversations.step
 def process_last_name(message):
     log_message_info(message)
     last_name = message.text
-    bot.send_message(message.chat.id, "Введите ваше имя (first name):")
-    bot.register_next_step_handler(message, process_first_name, last_name)
+    outbox.send_message(message.chat.id, "Введите ваше имя (first name):")
+    register_next_step(message, process_first_name, last_name=last_name)
 
 
+@conversations.step
 def process_first_name(message, last_name):
     log_message_info(message)
     first_name = message.text
-    bot.send_message(message.chat.id, "Введите ваше отчество (patronymic, если есть):")
-    bot.register_next_step_handler(message, process_patronymic, last_name, first_name)
+    outbox.send_message(
+        message.chat.id, "Введите ваше отчество (patronymic, если есть):"
+    )
+    register_next_step(
+        message, process_patronymic, last_name=last_name, first_name=first_name
+    )
 
 
-def process_patronymic(message, first_name, last_name):
+@conversations.step
+def process_patronymic(message, last_name, first_name):
     log_message_info(message)
     patronymic = message.text
-    bot.send_message(message.chat.id, "Введите ваш email:")
-    bot.register_next_step_handler(
-        message, process_email, last_name, first_name, patronymic
+    outbox.send_message(message.chat.id, "Введите ваш email:")
+    register_next_step(
+        message,
+        process_email,
+        last_name=last_name,
+        first_name=first_name,
+        patronymic=patronymic,
     )
 
 
+@conversations.step
 def process_email(message, last_name, first_name, patronymic):
     log_message_info(message)
     email = message.text
     # Checking email correctness using a regular expression
     email_regex = r"^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$"
     if not re.match(email_regex, email):
-        bot.send_message(
+        outbox.send_message(
             message.chat.id, "Некорректный email. Пожалуйста, попробуйте еще раз."
         )
-        bot.register_next_step_handler(
-            message, process_email, first_name, last_name, patronymic
+        register_next_step(
+            message,
+            process_email,
+            last_name=last_name,
+            first_name=first_name,
+            patronymic=patronymic,
         )
         return
 
     # Saving data to a database
-    session = Session()
-    new_client = Client(
-        first_name=first_name,
-        last_name=last_name,
-        patronymic=patronymic,
-        email=email,
-        telegram_id=message.from_user.id,
-    )
+    with session_scope(Session, user_id=message.from_user.id) as session:
+        new_client = Client(
+            first_name=first_name,
+            last_name=last_name,
+            patronymic=patronymic,
+            email=email,
+            telegram_id=message.from_user.id,
+        )
+
+        session.add(new_client)
+        session.commit()
+        remember_client(message.from_user.id, new_client.id, new_client.first_name)
 
-    session.add(new_client)
-    session.commit()
-    session.close()
+    outbox.send_message(message.chat.id, "Регистрация завершена! Спасибо!")
 
-    bot.send_message(message.chat.id, "Регистрация завершена! Спасибо!")
+
+def render_account(client):
+    lines = [
+        "Ваш аккаунт:",
+        f"ФИО: {client.last_name} {client.first_name} {client.patronymic}",
+        f"Email: {client.email}",
+        "Кредиты:",
+    ]
+    for number, loan in enumerate(client.loans, 1):
+        lines.append(
+            f"{number}. Сумма: {loan.amount}, Процентная ставка: {loan.interest_rate}%, статус: {loan.status}"
+        )
+    lines.append("Карты:")
+    for number, card in enumerate(client.cards, 1):
+        lines.append(
+            f"{number}. Номер карты: <code>{card.card_number}</code>, Дата окончания: {card.expiration_date}, Баланс: {card.balance} ₽, Статус: {card.status}"
+        )
+    return "\n".join(lines) + "\n"
 
 
 @bot.message_handler(commands=["account"])
 def account(message):
     log_message_info(message)
-    session = Session()
-    if not check_client(session, message.from_user.id):
-        bot.send_message(message.chat.id, "Вы не зарегистрированы!")
-        return
+    # Повторный /account отвечает из кэша, пока карты и кредиты не менялись
+    client = cache.clients.get(message.from_user.id)
+    text = cache.accounts.get(client.id) if client else None
+    if text is None:
+        with session_scope(
+            Session, read_only=True, user_id=message.from_user.id
+        ) as session:
+            # Клиент, его карты и активные кредиты одним запросом
+            client_info = (
+                session.query(Client)
+                .options(
+                    joinedload(Client.cards),
+                    joinedload(Client.loans.and_(Loan.status == "active")),
+                )
+                .filter(Client.telegram_id == message.from_user.id)
+                .first()
+            )
+            if not client_info:
+                outbox.send_message(message.chat.id, "Вы не зарегистрированы!")
+                return
 
-    client_info = (
-        session.query(Client).filter(Client.telegram_id == message.from_user.id).one()
-    )
-    client_loans = (
-        session.query(Loan)
-        .filter(Loan.client_id == client_info.id, Loan.status == "active")
-        .all()
-    )
-    client_cards = session.query(Card).filter(Card.client_id == client_info.id).all()
+            text = render_account(client_info)
+        remember_client(message.from_user.id, client_info.id, client_info.first_name)
+        cache.accounts.set(client_info.id, text)
 
-    bot.send_message(
-        message.chat.id,
-        f"Ваш аккаунт:\n"
-        f"ФИО: {client_info.last_name} {client_info.first_name} {client_info.patronymic}\n"
-        f"Email: {client_info.email}\n"
-        f"Кредиты:\n"
-        + "".join(
-            [
-                f"{loan[0] + 1}. Сумма: {loan[1].amount}, Процентная ставка: {loan[1].interest_rate}%, статус: {loan[1].status}\n"
-                for loan in enumerate(client_loans)
-            ]
-        )
-        + "Карты:\n"
-        + "".join(
-            [
-                f"{card[0] + 1}. Номер карты: <code>{card[1].card_number}</code>, Дата окончания: {card[1].expiration_date}, Баланс: {card[1].balance} ₽, Статус: {card[1].status}\n"
-                for card in enumerate(client_cards)
-            ]
-        ),
-        parse_mode="HTML",
-    )
+    outbox.send_message(message.chat.id, text, parse_mode="HTML")
 
 
 @bot.message_handler(commands=["create_card"])
 def create_card(message):
     log_message_info(message)
-    session = Session()
-    client = (
-        session.query(Client).filter(Client.telegram_id == message.from_user.id).first()
-    )
-    if not check_client(session, message.from_user.id):
-        bot.send_message(message.chat.id, "Вы не зарегистрированы!")
-        return
+    with session_scope(Session, user_id=message.from_user.id) as session:
+        client = resolve_client(session, message.from_user.id)
+        if not client:
+            outbox.send_message(message.chat.id, "Вы не зарегистрированы!")
+            return
 
-    last_card = session.query(Card).order_by(Card.id.desc()).first()
-    if not last_card:
-        last_card = Card(card_number="0000000000000000")
-
-    new_card = Card(
-        client_id=client.id,
-        card_number=" ".join(
-            [
-                ("0000000000000000" + str(last_card.id))[-16:][i * 4 : i * 4 + 4]
-                for i in range(4)
-            ]
-        ),
-        expiration_date=datetime.now() + timedelta(days=365),
-    )
+        new_card = Card(
+            client_id=client.id,
+            card_number=card_numbers.allocator.allocate(session),
+            expiration_date=datetime.now() + timedelta(days=365),
+        )
 
-    session.add(new_card)
-    session.commit()
+        session.add(new_card)
+        session.commit()
+    cache.invalidate_client(client.id)
 
-    bot.send_message(
+    outbox.send_message(
         message.chat.id,
         f"Карта с номером <code>{new_card.card_number}</code> создана!",
         parse_mode="HTML",
     )
-    session.close()
+
+
+def card_balance_label(card):
+    return f"{card.card_number}, {card.balance} ₽"
+
+
+def card_picker(
+    session, client_id, handler, *args, label=card_balance_label, min_balance=None
+):
+    """JSON клавиатуры выбора карты клиента; пустая строка — подходящих карт нет.
+
+    Кнопка карты вызывает ``handler(call, *args, card_id)``. Клавиатура
+    кэшируется до изменения карт клиента, при попадании в кэш ни запроса к
+    базе, ни построения разметки нет.
+    """
+
+    def build():
+        cards = session.query(Card).filter(Card.client_id == client_id).all()
+        markup = types.InlineKeyboardMarkup()
+        for card in cards:
+            if min_balance is None or card.balance >= min_balance:
+                markup.add(router.button(label(card), handler, *args, card.id))
+        return markup.to_json() if markup.keyboard else ""
+
+    picker = (handler.__name__, *args, min_balance)
+    return cache.card_keyboard(client_id, picker, build)
 
 
 @bot.message_handler(commands=["delete_card"])
 def delete_card(message):
     log_message_info(message)
-    session = Session()
-    client = (
-        session.query(Client).filter(Client.telegram_id == message.from_user.id).first()
-    )
-    if not check_client(session, message.from_user.id):
-        bot.send_message(message.chat.id, "Вы не зарегистрированы!")
-        return
+    with session_scope(
+        Session, read_only=True, user_id=message.from_user.id
+    ) as session:
+        client = resolve_client(session, message.from_user.id)
+        if not client:
+            outbox.send_message(message.chat.id, "Вы не зарегистрированы!")
+            return
 
-    cards = session.query(Card).filter(Card.client_id == client.id).all()
+        markup = card_picker(
+            session,
+            client.id,
+            callback_query_delete_card,
+            label=lambda card: card.card_number,
+        )
 
-    if not cards:
-        bot.send_message(message.chat.id, "У вас нет карт!")
+    if not markup:
+        outbox.send_message(message.chat.id, "У вас нет карт!")
         return
 
-    markup = types.InlineKeyboardMarkup()
-    for card in cards:
-        markup.add(
-            types.InlineKeyboardButton(
-                card.card_number, callback_data="delete_card_" + str(card.id)
-            )
-        )
-
-    bot.send_message(
+    outbox.send_message(
         message.chat.id, "Выберите карту для удаления", reply_markup=markup
     )
-    session.close()
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("delete_card_"))
-def callback_query_delete_card(call):
+@router.route(1)
+def callback_query_delete_card(call, card_id):
     log_message_info(call.message)
-    card_id = int(call.data.split("_")[-1])
-    session = Session()
-    card = session.query(Card).filter(Card.id == card_id).first()
-    if card:
+    with session_scope(Session, user_id=call.from_user.id) as session:
+        card = session.query(Card).filter(Card.id == card_id).first()
+        if not card:
+            return
         session.delete(card)
         session.commit()
-        bot.edit_message_text(
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-            text="Карта успешно удалена!",
-        )
-    session.close()
+    cache.invalidate_client(card.client_id)
+
+    outbox.edit_message_text(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text="Карта успешно удалена!",
+    )
 
 
 @bot.message_handler(commands=["loan_pay"])
 def loan_pay(message):
     log_message_info(message)
-    session = Session()
-    client = (
-        session.query(Client).filter(Client.telegram_id == message.from_user.id).first()
-    )
-    if not check_client(session, message.from_user.id):
-        bot.send_message(message.chat.id, "Вы не зарегистрированы!")
-        return
+    with session_scope(
+        Session, read_only=True, user_id=message.from_user.id
+    ) as session:
+        client = resolve_client(session, message.from_user.id)
+        if not client:
+            outbox.send_message(message.chat.id, "Вы не зарегистрированы!")
+            return
 
-    loans = (
-        session.query(Loan)
-        .filter(Loan.client_id == client.id, Loan.status == "active")
-        .all()
-    )
+        loans = (
+            session.query(Loan)
+            .filter(Loan.client_id == client.id, Loan.status == "active")
+            .all()
+        )
 
     if not loans:
-        bot.send_message(message.chat.id, "У вас нет кредитов!")
+        outbox.send_message(message.chat.id, "У вас нет кредитов!")
         return
 
     markup = types.InlineKeyboardMarkup()
     for loan in loans:
         markup.add(
-            types.InlineKeyboardButton(
+            router.button(
                 f"{loan.amount} ₽, {loan.interest_rate}%, до {loan.due_date}",
-                callback_data="loan_pay_" + str(loan.id),
+                callback_query_loan_pay,
+                loan.id,
             )
         )
 
-    bot.send_message(
+    outbox.send_message(
         message.chat.id, "Выберите кредит для погашения кредита", reply_markup=markup
     )
-    session.close()
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("loan_pay_"))
-def callback_query_loan_pay(call):
+@router.route(2)
+def callback_query_loan_pay(call, loan_id):
     log_message_info(call.message)
-    loan_id = int(call.data.split("_")[-1])
-    session = Session()
-    loan = session.query(Loan).filter(Loan.id == loan_id).first()
-    cards = session.query(Card).filter(Card.client_id == loan.client_id).all()
+    with session_scope(Session, read_only=True, user_id=call.from_user.id) as session:
+        loan = session.query(Loan).filter(Loan.id == loan_id).first()
+        markup = card_picker(
+            session,
+            loan.client_id,
+            callback_query_loan_pay_card,
+            loan.id,
+            min_balance=loan.amount,
+        )
 
-    markup = types.InlineKeyboardMarkup()
-    for card in cards:
-        if card.balance >= loan.amount:
-            markup.add(
-                types.InlineKeyboardButton(
-                    f"{card.card_number}, {card.balance} ₽",
-                    callback_data=f"loan_card_{loan.id}_{card.id}",
-                )
-            )
-    if not markup.keyboard:
-        bot.edit_message_text(
+    if not markup:
+        outbox.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             text="У вас нет карт с достаточным балансом для погашения кредита!",
         )
         return
 
-    bot.delete_message(
+    outbox.delete_message(
         chat_id=call.message.chat.id,
         message_id=call.message.message_id,
     )
-    bot.send_message(
+    outbox.send_message(
         call.message.chat.id,
         f"Выберите карту для погашения кредита {loan.amount} ₽, {loan.interest_rate}%, до {loan.due_date}",
         reply_markup=markup,
     )
-    session.close()
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("loan_card_"))
-def callback_query_loan_pay_card(call):
+@router.route(3)
+def callback_query_loan_pay_card(call, loan_id, card_id):
     log_message_info(call.message)
-    loan_id = int(call.data.split("_")[-2])
-    card_id = int(call.data.split("_")[-1])
-    session = Session()
-    loan = session.query(Loan).filter(Loan.id == loan_id).first()
-    card = session.query(Card).filter(Card.id == card_id).first()
-    transaction = Transaction(
-        client_id=card.client_id,
-        amount=loan.amount,
-        transaction_type="loan_pay",
-        recipient_id=card.client_id,
+    try:
+        with session_scope(Session, user_id=call.from_user.id) as session:
+            result = transfers.pay_loan(session, loan_id, card_id)
+    except (transfers.LoanNotFound, transfers.InsufficientFunds):
+        return
+    cache.invalidate_client(result.card_client_id, result.loan_client_id)
+
+    outbox.edit_message_text(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text="Кредит успешно погашен!",
     )
-    if card:
-        if card.balance >= loan.amount:
-            card.balance -= loan.amount
-            loan.amount = 0
-            loan.status = "paid"
-            loan.due_date = datetime.now()
-            session.commit()
-            bot.edit_message_text(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                text="Кредит успешно погашен!",
-            )
-    session.add(transaction)
-    session.commit()
-    session.close()
 
 
 @bot.message_handler(commands=["top_up"])
 def top_up(message):
     log_message_info(message)
-    session = Session()
-    client = (
-        session.query(Client).filter(Client.telegram_id == message.from_user.id).first()
-    )
-    if not check_client(session, message.from_user.id):
-        bot.send_message(message.chat.id, "Вы не зарегистрированы!")
-        return
+    with session_scope(
+        Session, read_only=True, user_id=message.from_user.id
+    ) as session:
+        client = resolve_client(session, message.from_user.id)
+        if not client:
+            outbox.send_message(message.chat.id, "Вы не зарегистрированы!")
+            return
 
-    markup = types.InlineKeyboardMarkup()
-    cards = session.query(Card).filter(Card.client_id == client.id).all()
-    for card in cards:
-        markup.add(
-            types.InlineKeyboardButton(
-                f"{card.card_number}, {card.balance} ₽",
-                callback_data="top_up_" + str(card.id),
-            )
-        )
-    if not markup.keyboard:
-        bot.send_message(message.chat.id, "У вас нет карт!")
+        markup = card_picker(session, client.id, callback_query_top_up)
+
+    if not markup:
+        outbox.send_message(message.chat.id, "У вас нет карт!")
         return
 
-    bot.send_message(
+    outbox.send_message(
         message.chat.id, "Выберите карту для пополнения баланса", reply_markup=markup
     )
-    session.close()
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("top_up_"))
-def callback_query_top_up(call):
+@router.route(4)
+def callback_query_top_up(call, card_id):
     log_message_info(call.message)
-    card_id = int(call.data.split("_")[-1])
-    session = Session()
-    bot.edit_message_text(
+    outbox.edit_message_text(
         chat_id=call.message.chat.id,
         message_id=call.message.message_id,
         text="Введите сумму пополнения баланса:",
     )
-    bot.register_next_step_handler(
-        call.message,
-        finish_top_up,
-        card_id=card_id,
-        session=session,
-    )
+    register_next_step(call.message, finish_top_up, card_id=card_id)
 
 
-def finish_top_up(message, card_id, session):
+@conversations.step
+def finish_top_up(message, card_id):
     log_message_info(message)
     try:
         amount = int(message.text)
     except ValueError:
-        bot.send_message(
+        outbox.send_message(
             message.chat.id,
             "Сумма пополнения должна быть целым числом!",
         )
-        bot.register_next_step_handler(
-            message, finish_top_up, card_id=card_id, session=session
-        )
+        register_next_step(message, finish_top_up, card_id=card_id)
         return
 
-    card = session.query(Card).filter(Card.id == card_id).first()
-    if card:
-        card.balance += amount
-        session.commit()
-        bot.send_message(
-            message.chat.id,
-            f"Баланс карты <code>{card.card_number}</code> пополнен на {amount} ₽, текущий баланс: {card.balance} ₽",
-            parse_mode="HTML",
-        )
+    try:
+        with session_scope(Session, user_id=message.from_user.id) as session:
+            result = transfers.top_up(session, card_id, amount)
+    except transfers.CardNotFound:
+        return
+    cache.invalidate_client(result.client_id)
 
-    transaction = Transaction(
-        client_id=card.client_id,
-        amount=amount,
-        transaction_type="top_up",
-        recipient_id=card.client_id,
+    outbox.send_message(
+        message.chat.id,
+        f"Баланс карты <code>{result.card_number}</code> пополнен на {amount} ₽, текущий баланс: {result.balance} ₽",
+        parse_mode="HTML",
     )
-    session.add(transaction)
-    session.commit()
-    session.close()
 
 
 @bot.message_handler(commands=["transfer"])
 def transfer(message):
     log_message_info(message)
-    session = Session()
-    client = (
-        session.query(Client).filter(Client.telegram_id == message.from_user.id).first()
-    )
+    with session_scope(
+        Session, read_only=True, user_id=message.from_user.id
+    ) as session:
+        client = resolve_client(session, message.from_user.id)
+        if not client:
+            outbox.send_message(message.chat.id, "Вы не зарегистрированы!")
+            return
 
-    if not check_client(session, message.from_user.id):
-        bot.send_message(message.chat.id, "Вы не зарегистрированы!")
-        return
+        markup = card_picker(session, client.id, process_card_from)
 
-    cards_from = session.query(Card).filter(Card.client_id == client.id).all()
-    markup = types.InlineKeyboardMarkup()
-    for card in cards_from:
-        markup.add(
-            types.InlineKeyboardButton(
-                f"{card.card_number}, {card.balance} ₽",
-                callback_data="transfer_" + str(card.id),
-            )
-        )
-    if not markup.keyboard:
-        bot.send_message(message.chat.id, "У вас нет карт!")
+    if not markup:
+        outbox.send_message(message.chat.id, "У вас нет карт!")
         return
 
-    bot.send_message(
+    outbox.send_message(
         message.chat.id,
         "Выберите карту отправителя:",
         reply_markup=markup,
     )
-    session.close()
-    # bot.register_next_step_handler(message, process_card_from)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("transfer_"))
-def process_card_from(call):
+@router.route(5)
+def process_card_from(call, card_id):
     log_message_info(call.message)
-    session = Session()
-    card_from = (
-        session.query(Card).filter(Card.id == int(call.data.split("_")[-1])).first()
-    )
+    with session_scope(Session) as session:
+        card_from = session.query(Card.id).filter(Card.id == card_id).first()
     if not card_from:
-        bot.send_message(call.message.chat.id, "Карта не найдена!")
+        outbox.send_message(call.message.chat.id, "Карта не найдена!")
         return
 
-    bot.send_message(call.message.chat.id, "Введите номер карты получателя:")
-    bot.register_next_step_handler(
-        call.message, process_transfer, session=session, card_from=card_from
-    )
+    outbox.send_message(call.message.chat.id, "Введите номер карты получателя:")
+    register_next_step(call.message, process_transfer, card_from_id=card_from.id)
 
 
-def process_transfer(message, session, card_from):
+@conversations.step
+def process_transfer(message, card_from_id):
     log_message_info(message)
     card_number = message.text
 
-    card_to = session.query(Card).filter(Card.card_number == card_number).first()
+    with session_scope(Session) as session:
+        card_to = session.query(Card.id).filter(Card.card_number == card_number).first()
     if not card_to:
-        bot.send_message(message.chat.id, "Карта не найдена!")
+        outbox.send_message(message.chat.id, "Карта не найдена!")
         return
 
-    bot.send_message(message.chat.id, "Введите сумму перевода:")
-    bot.register_next_step_handler(
-        message, finish_transfer, card_to=card_to, session=session, card_from=card_from
+    outbox.send_message(message.chat.id, "Введите сумму перевода:")
+    register_next_step(
+        message, finish_transfer, card_from_id=card_from_id, card_to_id=card_to.id
     )
 
 
-def finish_transfer(message, card_to, session, card_from):
+@conversations.step
+def finish_transfer(message, card_from_id, card_to_id):
     log_message_info(message)
     try:
         amount = float(message.text)
-        if amount <= 0:
-            bot.send_message(
-                message.chat.id,
-                "Сумма перевода должна быть больше нуля!",
-            )
-            bot.register_next_step_handler(
-                message,
-                finish_transfer,
-                card_to=card_to,
-                session=session,
-                card_from=card_from,
-            )
-            return
-        if amount > card_from.balance:
-            bot.send_message(
-                message.chat.id,
-                "Недостаточно средств!",
-            )
-            bot.register_next_step_handler(
-                message,
-                finish_transfer,
-                card_to=card_to,
-                session=session,
-                card_from=card_from,
-            )
-            return
     except ValueError:
-        bot.send_message(
+        outbox.send_message(
             message.chat.id,
             "Сумма перевода должна быть целым числом!",
         )
-        bot.register_next_step_handler(
-            message, finish_transfer, card_to, session, card_from
+        register_next_step(
+            message, finish_transfer, card_from_id=card_from_id, card_to_id=card_to_id
         )
+        return
+    if amount <= 0:
+        outbox.send_message(
+            message.chat.id,
+            "Сумма перевода должна быть больше нуля!",
+        )
+        register_next_step(
+            message, finish_transfer, card_from_id=card_from_id, card_to_id=card_to_id
+        )
+        return
 
-    card_from.balance -= amount
-    card_to.balance += amount
-    transaction = Transaction(
-        client_id=card_from.client_id,
-        amount=amount,
-        transaction_type="transfer",
-        recipient_id=card_to.client_id,
-    )
-    session.add(transaction)
-    session.commit()
-    bot.send_message(
+    try:
+        with session_scope(Session, user_id=message.from_user.id) as session:
+            result = transfers.transfer(session, card_from_id, card_to_id, amount)
+    except transfers.InsufficientFunds:
+        outbox.send_message(
+            message.chat.id,
+            "Недостаточно средств!",
+        )
+        register_next_step(
+            message,
+            finish_transfer,
+            card_from_id=card_from_id,
+            card_to_id=card_to_id,
+        )
+        return
+    except transfers.CardNotFound:
+        outbox.send_message(
+            message.chat.id,
+            "Карта не найдена!",
+        )
+        return
+    cache.invalidate_client(result.from_client_id, result.to_client_id)
+
+    outbox.send_message(
         message.chat.id,
-        f"Перевод с карты <code>{card_from.card_number}</code> на карту <code>{card_to.card_number}</code> выполнен, текущий баланс: {card_from.balance} ₽",
+        f"Перевод с карты <code>{result.card_from_number}</code> на карту <code>{result.card_to_number}</code> выполнен, текущий баланс: {result.balance} ₽",
         parse_mode="HTML",
     )
 
 
+# Направление листания истории в кнопке
+HISTORY_NEWER = 0
+HISTORY_OLDER = 1
+
+
+def history_markup(rows, has_older, has_newer):
+    buttons = []
+    if has_newer:
+        buttons.append(
+            router.button("← Назад", callback_query_history, HISTORY_NEWER, rows[0].id)
+        )
+    if has_older:
+        buttons.append(
+            router.button("Далее →", callback_query_history, HISTORY_OLDER, rows[-1].id)
+        )
+    markup = types.InlineKeyboardMarkup()
+    if buttons:
+        markup.row(*buttons)
+    return markup
+
+
+@bot.message_handler(commands=["history"])
+def history(message):
+    log_message_info(message)
+    with session_scope(
+        Session, read_only=True, user_id=message.from_user.id
+    ) as session:
+        client = resolve_client(session, message.from_user.id)
+        if not client:
+            outbox.send_message(message.chat.id, "Вы не зарегистрированы!")
+            return
+
+        rows, has_older, has_newer = fetch_history_page(session, client.id)
+
+    outbox.send_message(
+        message.chat.id,
+        render_history_page(client.id, rows),
+        reply_markup=history_markup(rows, has_older, has_newer),
+    )
+
+
+@router.route(6)
+def callback_query_history(call, direction, cursor):
+    log_message_info(call.message)
+    with session_scope(Session, read_only=True, user_id=call.from_user.id) as session:
+        # Клиент определяется по нажавшему кнопку, а не по данным кнопки
+        client = resolve_client(session, call.from_user.id)
+        if not client:
+            return
+
+        if direction == HISTORY_OLDER:
+            page = fetch_history_page(session, client.id, before=cursor)
+        else:
+            page = fetch_history_page(session, client.id, after=cursor)
+    rows, has_older, has_newer = page
+    if not rows:
+        return
+
+    outbox.edit_message_text(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text=render_history_page(client.id, rows),
+        reply_markup=history_markup(rows, has_older, has_newer),
+    )
+
+
+# Все callback-запросы проходят через роутер: обработчик по коду действия
+@bot.callback_query_handler(func=lambda call: True)
+def route_callback(call):
+    route = router.resolve(call.data or "")
+    if route is None:
+        # Кнопка из старой версии бота
+        outbox.call(
+            "answer_callback_query",
+            call.message.chat.id if call.message else call.from_user.id,
+            call.id,
+            text="Кнопка устарела, повторите команду.",
+        )
+        return
+    handler, args = route
+    relabel(handler.__name__)
+    handler(call, *args)
+
+
+@bot.message_handler(commands=["statement"])
+def monthly_statement(message):
+    log_message_info(message)
+    arguments = message.text.split()[1:]
+    try:
+        month = (
+            datetime.strptime(arguments[0], "%Y-%m").date()
+            if arguments
+            else datetime.now().date()
+        )
+    except ValueError:
+        outbox.send_message(
+            message.chat.id,
+            "Укажите месяц в формате ГГГГ-ММ, например: /statement 2024-10",
+        )
+        return
+
+    # Выписка пишется во временный файл порциями, не собираясь в памяти
+    with tempfile.TemporaryFile() as output:
+        with session_scope(
+            Session, read_only=True, user_id=message.from_user.id
+        ) as session:
+            client = resolve_client(session, message.from_user.id)
+            if not client:
+                outbox.send_message(message.chat.id, "Вы не зарегистрированы!")
+                return
+            count = statement.export(session, output, "csv", client.id, month)
+
+        if not count:
+            outbox.send_message(message.chat.id, f"За {month:%m.%Y} операций нет.")
+            return
+        output.seek(0)
+        # Файл удаляется при выходе из блока, поэтому ждём отправки
+        outbox.send_document(
+            message.chat.id,
+            output,
+            caption=f"Выписка за {month:%m.%Y}",
+            visible_file_name=f"statement_{month:%Y-%m}.csv",
+        ).result()
+
+
 @bot.message_handler(
     content_types=[
         "text",
@@ -605,14 +893,75 @@ def finish_transfer(message, card_to, session, card_from):
 )
 def handle_unmatched_message(message):
     if message.content_type == "text":
-        bot.send_message(message.chat.id, "Я вас не понимаю, попробуйте ещё раз.")
+        outbox.send_message(message.chat.id, "Я вас не понимаю, попробуйте ещё раз.")
     else:
-        bot.send_message(
+        outbox.send_message(
             message.chat.id,
             "Я пока не могу обработать этот тип сообщения, попробуйте ещё раз.",
         )
     log_message_info(message)
 
 
+# Метрики на всех обработчиках; регистрируются после них
+metrics.instrument_bot(bot)
+
+
+def make_dispatcher():
+    return ChatDispatcher(
+        bot,
+        workers=config.getint("dispatcher", "workers", fallback=8),
+        chat_queue_size=config.getint("dispatcher", "chat_queue_size", fallback=100),
+        max_pending=config.getint("dispatcher", "max_pending", fallback=10000),
+    )
+
+
+def run_webhook(dispatcher):
+    webhook_config = config["webhook"]
+    server = WebhookServer(
+        bot,
+        dispatcher,
+        host=webhook_config.get("host", "0.0.0.0"),
+        port=webhook_config.getint("port", 8000),
+        path=webhook_config.get("path", "/webhook"),
+        secret_token=webhook_config.get("secret_token"),
+        metrics_registry=(
+            metrics.registry
+            if config.getboolean("metrics", "enabled", fallback=True)
+            else None
+        ),
+    )
+    bot.remove_webhook()
+    bot.set_webhook(
+        url=webhook_config["url"], secret_token=webhook_config.get("secret_token")
+    )
+    server.serve_forever()
+
+
+def run_polling(dispatcher):
+    bot.remove_webhook()
+    if config.getboolean("metrics", "enabled", fallback=True):
+        try:
+            metrics.MetricsServer(
+                host=config.get("metrics", "host", fallback="0.0.0.0"),
+                port=config.getint("metrics", "port", fallback=8000),
+            ).start()
+        except OSError as e:
+            print("metrics error", e)
+    try:
+        poll_updates(bot, dispatcher)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        dispatcher.shutdown()
+
+
 if __name__ == "__main__":
-    bot.polling()
+    create_app()
+    outbox.start()
+    try:
+        if config.getboolean("webhook", "enabled", fallback=False):
+            run_webhook(make_dispatcher())
+        else:
+            run_polling(make_dispatcher())
+    finally:
+        outbox.stop()
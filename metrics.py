@@ -0,0 +1,338 @@
+"""Метрики обработчиков бота в текстовом формате Prometheus.
+
+Каждый обработчик сообщений и callback-запросов оборачивается счётчиком
+вызовов и гистограммой задержки с меткой команды (``/account``) или имени
+обработчика (``callback_query_top_up``, шаги диалогов — по имени шага). События
+движка SQLAlchemy считают запросы и время в базе на одно обновление,
+отправитель запросов telebot — вызовы Bot API и ошибки по методам.
+
+Запись — пара ``perf_counter`` и одна блокировка на обновление, поэтому
+метрики включены всегда. Отдаются на ``GET /metrics``: при long polling
+отдельным HTTP-сервером (порт 8000 из docker-compose), при вебхуке — тем же
+сервером, что принимает обновления.
+"""
+
+import bisect
+import functools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sqlalchemy import event
+
+# Границы корзин гистограмм
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # Последняя корзина — +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _format_labels(labels, extra=()):
+    pairs = tuple(labels) + tuple(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Registry:
+    """Счётчики, гистограммы и вычисляемые gauge с метками."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # имя -> (тип, описание)
+        self._meta = {}
+        # имя -> {метки: значение}
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    def describe(self, name, kind, help_text):
+        self._meta[name] = (kind, help_text)
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            self.inc_locked(name, labels, value)
+
+    def inc_locked(self, name, labels=(), value=1):
+        series = self._counters.setdefault(name, {})
+        series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name, labels, value, buckets):
+        with self.lock:
+            self.observe_locked(name, labels, value, buckets)
+
+    def observe_locked(self, name, labels, value, buckets):
+        series = self._histograms.setdefault(name, {})
+        histogram = series.get(labels)
+        if histogram is None:
+            histogram = series[labels] = Histogram(buckets)
+        histogram.observe(value)
+
+    def gauge(self, name, help_text, function):
+        """Gauge, значение которого вычисляется ``function()`` при чтении."""
+        self.describe(name, "gauge", help_text)
+        self._gauges[name] = function
+
+    def value(self, name, labels=()):
+        """Текущее значение счётчика или число наблюдений гистограммы."""
+        with self.lock:
+            if name in self._histograms:
+                histogram = self._histograms[name].get(labels)
+                return histogram.count if histogram else 0
+            return self._counters.get(name, {}).get(labels, 0)
+
+    def clear(self):
+        with self.lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self):
+        lines = []
+
+        def header(name, default_kind):
+            kind, help_text = self._meta.get(name, (default_kind, name))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self.lock:
+            for name, series in sorted(self._counters.items()):
+                header(name, "counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+            for name, series in sorted(self._histograms.items()):
+                header(name, "histogram")
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(
+                        histogram.buckets + ("+Inf",), histogram.counts
+                    ):
+                        cumulative += count
+                        lines.append(
+                            f"{name}_bucket"
+                            f"{_format_labels(labels, (('le', bound),))} {cumulative}"
+                        )
+                    lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                    lines.append(
+                        f"{name}_count{_format_labels(labels)} {histogram.count}"
+                    )
+        for name, function in sorted(self._gauges.items()):
+            try:
+                value = function()
+            except Exception as e:
+                print("metrics error", e)
+                continue
+            header(name, "gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+registry.describe(
+    "bot_updates_total", "counter", "Обновления, обработанные обработчиком"
+)
+registry.describe(
+    "bot_update_errors_total", "counter", "Обновления, завершившиеся исключением"
+)
+registry.describe(
+    "bot_update_duration_seconds", "histogram", "Время обработки обновления"
+)
+registry.describe(
+    "bot_update_db_queries", "histogram", "Запросы к базе за одно обновление"
+)
+registry.describe(
+    "bot_update_db_seconds", "histogram", "Время в базе за одно обновление"
+)
+registry.describe("db_queries_total", "counter", "Все запросы к базе")
+registry.describe("db_seconds_total", "counter", "Суммарное время запросов к базе")
+registry.describe("bot_api_calls_total", "counter", "Вызовы Bot API по методам")
+registry.describe(
+    "bot_api_errors_total", "counter", "Ошибки Bot API по методам и кодам ответа"
+)
+
+
+class _Update:
+    """Счётчики текущего обновления в потоке обработчика."""
+
+    __slots__ = ("label", "queries", "db_time")
+
+    def __init__(self, label):
+        self.label = label
+        self.queries = 0
+        self.db_time = 0.0
+
+
+_local = threading.local()
+
+
+def relabel(label):
+    """Меняет метку текущего обновления, например на имя шага диалога."""
+    update = getattr(_local, "update", None)
+    if update is not None:
+        update.label = label
+
+
+def instrument_handler(function, label):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        update = _local.update = _Update(label)
+        started = time.perf_counter()
+        failed = False
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            _local.update = None
+            labels = (("handler", update.label),)
+            with registry.lock:
+                registry.inc_locked("bot_updates_total", labels)
+                if failed:
+                    registry.inc_locked("bot_update_errors_total", labels)
+                registry.observe_locked(
+                    "bot_update_duration_seconds", labels, duration, LATENCY_BUCKETS
+                )
+                registry.observe_locked(
+                    "bot_update_db_queries", labels, update.queries, QUERY_BUCKETS
+                )
+                registry.observe_locked(
+                    "bot_update_db_seconds", labels, update.db_time, DB_TIME_BUCKETS
+                )
+
+    wrapper.metrics_label = label
+    return wrapper
+
+
+def handler_label(handler):
+    """Метка обработчика: первая команда фильтра или имя функции."""
+    commands = handler["filters"].get("commands")
+    if commands:
+        return "/" + commands[0]
+    return handler["function"].__name__
+
+
+def instrument_bot(bot):
+    """Оборачивает все зарегистрированные обработчики сообщений и callback."""
+    for handlers in (bot.message_handlers, bot.callback_query_handlers):
+        for handler in handlers:
+            if not hasattr(handler["function"], "metrics_label"):
+                handler["function"] = instrument_handler(
+                    handler["function"], handler_label(handler)
+                )
+
+
+def instrument_engine(engine):
+    """Считает запросы и время в базе, в том числе на текущее обновление."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        elapsed = time.perf_counter() - conn.info["metrics_started"].pop()
+        update = getattr(_local, "update", None)
+        if update is not None:
+            update.queries += 1
+            update.db_time += elapsed
+        with registry.lock:
+            registry.inc_locked("db_queries_total")
+            registry.inc_locked("db_seconds_total", value=elapsed)
+
+
+def instrument_sender(sender):
+    """Оборачивает ``apihelper.CUSTOM_REQUEST_SENDER`` счётчиками Bot API."""
+
+    @functools.wraps(sender)
+    def send(method, url, *args, **kwargs):
+        labels = (("method", url.rsplit("/", 1)[-1]),)
+        try:
+            response = sender(method, url, *args, **kwargs)
+        except Exception:
+            with registry.lock:
+                registry.inc_locked("bot_api_calls_total", labels)
+                registry.inc_locked(
+                    "bot_api_errors_total", labels + (("code", "exception"),)
+                )
+            raise
+        with registry.lock:
+            registry.inc_locked("bot_api_calls_total", labels)
+            if response.status_code >= 400:
+                registry.inc_locked(
+                    "bot_api_errors_total",
+                    labels + (("code", str(response.status_code)),),
+                )
+        return response
+
+    return send
+
+
+class MetricsServer:
+    def __init__(self, registry=registry, host="0.0.0.0", port=8000, path="/metrics"):
+        self.registry = registry
+        self.path = path
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def start(self):
+        threading.Thread(
+            target=self.httpd.serve_forever, name="metrics-http", daemon=True
+        ).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != server.path:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                write_metrics(self, server.registry)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def write_metrics(handler, registry=registry):
+    """Отвечает на запрос ``handler`` текущими метриками."""
+    payload = registry.render().encode("utf-8")
+    handler.send_response(200)
+    handler.send_header("Content-Type", CONTENT_TYPE)
+    handler.send_header("Content-Length", str(len(payload)))
+    handler.end_headers()
+    handler.wfile.write(payload)
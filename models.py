@@ -1,8 +1,25 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, Date
+from sqlalchemy import (
+    Column,
+    Integer,
+    String,
+    Float,
+    ForeignKey,
+    Date,
+    DateTime,
+    Index,
+    Sequence,
+    text,
+)
 from sqlalchemy.orm import relationship, declarative_base
+from datetime import date, datetime
 
 Base = declarative_base()
 
+# Источник номеров карт; каждый nextval резервирует блок из 100 номеров
+CARD_NUMBER_SEQUENCE = Sequence(
+    "card_number_seq", start=1, increment=100, metadata=Base.metadata
+)
+
 
 class Client(Base):
     __tablename__ = "clients"
@@ -30,6 +47,11 @@ class Client(Base):
 
 class Transaction(Base):
     __tablename__ = "transactions"
+    __table_args__ = (
+        # Ключи постраничной истории: операции клиента по убыванию id
+        Index("ix_transactions_client_id_id", "client_id", "id"),
+        Index("ix_transactions_recipient_id_id", "recipient_id", "id"),
+    )
 
     id = Column(Integer, primary_key=True)
     client_id = Column(Integer, ForeignKey("clients.id"), nullable=False)
@@ -38,6 +60,7 @@ class Transaction(Base):
         String, nullable=False
     )  # 'deposit', 'withdraw', 'transfer'
     recipient_id = Column(Integer, ForeignKey("clients.id"))
+    created_at = Column(DateTime, default=datetime.now)
 
     client = relationship(
         "Client", back_populates="transactions", foreign_keys=[client_id]
@@ -49,6 +72,15 @@ class Transaction(Base):
 
 class Loan(Base):
     __tablename__ = "loans"
+    __table_args__ = (
+        # Обработчики читают только активные кредиты клиента
+        Index(
+            "ix_loans_client_id_active",
+            "client_id",
+            postgresql_where=text("status = 'active'"),
+            sqlite_where=text("status = 'active'"),
+        ),
+    )
 
     id = Column(Integer, primary_key=True)
     client_id = Column(Integer, ForeignKey("clients.id"), nullable=False)
@@ -56,6 +88,8 @@ class Loan(Base):
     interest_rate = Column(Float, nullable=False)
     status = Column(String, default="active")  # 'active', 'paid'
     due_date = Column(Date, default=None)
+    # Дата, по которую начислены проценты (см. accrual.py)
+    accrued_on = Column(Date, default=date.today)
 
     client = relationship("Client", back_populates="loans", foreign_keys=[client_id])
 
@@ -67,7 +101,7 @@ class Card(Base):
     __tablename__ = "cards"
 
     id = Column(Integer, primary_key=True)
-    client_id = Column(Integer, ForeignKey("clients.id"), nullable=False)
+    client_id = Column(Integer, ForeignKey("clients.id"), nullable=False, index=True)
     card_number = Column(String, unique=True, nullable=False)
     expiration_date = Column(Date, nullable=False)  # YYYY-MM-DD
     status = Column(String, default="active")  # 'active', 'frozen', 'blocked'
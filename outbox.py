@@ -0,0 +1,359 @@
+"""Очередь исходящих запросов к Bot API с учётом лимитов Telegram.
+
+Обработчики не ждут сети: вызовы ``send_message``, ``edit_message_text`` и
+прочих методов ставятся в очередь с приоритетом (ответы пользователю раньше
+уведомлений) и отправляются фоновыми потоками. Отправку сдерживают общий
+token bucket (~30 сообщений в секунду на бота) и bucket каждого чата
+(~1 в секунду). На ответ 429 запрос повторяется через ``retry_after``, не
+теряя места в очереди.
+
+У каждого чата своя очередь. Чаты, которым можно отправлять, лежат в куче по
+приоритету и порядку их первого вызова, а ждущие лимита — в куче по времени,
+когда станет можно. Выбор следующего вызова стоит O(log n) при любой длине
+очереди.
+
+Пока очередь не запущена (тесты, скрипты), вызовы выполняются сразу.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+from telebot.apihelper import ApiTelegramException
+
+INTERACTIVE = 0
+NOTIFICATION = 1
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Через сколько секунд будет доступен токен."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Job:
+    __slots__ = (
+        "priority",
+        "sequence",
+        "chat_id",
+        "method",
+        "args",
+        "kwargs",
+        "future",
+        "enqueued_at",
+        "attempts",
+    )
+
+    def __init__(self, priority, sequence, chat_id, method, args, kwargs):
+        self.priority = priority
+        self.sequence = sequence
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+
+def _chat_id(args, kwargs):
+    return kwargs["chat_id"] if "chat_id" in kwargs else args[0]
+
+
+class Outbox:
+    def __init__(
+        self,
+        bot,
+        global_rate=30.0,
+        chat_rate=1.0,
+        chat_burst=3,
+        workers=4,
+        max_retries=5,
+    ):
+        self.bot = bot
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.max_retries = max_retries
+        self._condition = threading.Condition()
+        # chat_id -> куча (приоритет, номер, вызов) этого чата
+        self._pending = {}
+        self._queued = 0
+        # Куча (приоритет, номер, chat_id) чатов, готовых к отправке; запись
+        # действительна, пока совпадает с _ready_keys[chat_id]
+        self._ready = []
+        self._ready_keys = {}
+        # Куча (monotonic-время, chat_id) чатов, ждущих лимита
+        self._waiting = []
+        self._waiting_chats = set()
+        self._sequence = itertools.count()
+        self._global = TokenBucket(global_rate, global_rate, time.monotonic())
+        self._chats = {}
+        # chat_id -> monotonic-время, до которого Telegram просил подождать
+        self._blocked = {}
+        self._in_flight = set()
+        self._threads = []
+        self._closed = False
+
+        # Счётчики
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.send_time_total = 0.0
+
+    @property
+    def started(self):
+        return bool(self._threads)
+
+    def start(self):
+        self._closed = False
+        for number in range(self.workers):
+            thread = threading.Thread(
+                target=self._run, name=f"outbox-{number}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def call(self, method, chat_id, /, *args, priority=INTERACTIVE, **kwargs):
+        """Ставит вызов ``bot.<method>(*args, **kwargs)`` в очередь.
+
+        Возвращает Future с результатом вызова. Сообщения одного чата с
+        одинаковым приоритетом уходят в порядке постановки.
+        """
+        if not self.started:
+            future = Future()
+            future.set_result(getattr(self.bot, method)(*args, **kwargs))
+            return future
+
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("outbox is stopped")
+            job = _Job(priority, next(self._sequence), chat_id, method, args, kwargs)
+            self._push(job)
+            self._condition.notify()
+        return job.future
+
+    def send_message(self, *args, priority=INTERACTIVE, **kwargs):
+        return self.call(
+            "send_message", _chat_id(args, kwargs), *args, priority=priority, **kwargs
+        )
+
+    def edit_message_text(self, *args, priority=INTERACTIVE, **kwargs):
+        # Первый позиционный аргумент — текст, чат передаётся по имени
+        return self.call(
+            "edit_message_text",
+            kwargs.get("chat_id"),
+            *args,
+            priority=priority,
+            **kwargs,
+        )
+
+    def delete_message(self, *args, priority=INTERACTIVE, **kwargs):
+        return self.call(
+            "delete_message", _chat_id(args, kwargs), *args, priority=priority, **kwargs
+        )
+
+    def send_document(self, *args, priority=INTERACTIVE, **kwargs):
+        return self.call(
+            "send_document", _chat_id(args, kwargs), *args, priority=priority, **kwargs
+        )
+
+    def _push(self, job):
+        pending = self._pending.setdefault(job.chat_id, [])
+        heapq.heappush(pending, (job.priority, job.sequence, job))
+        self._queued += 1
+        key = (job.priority, job.sequence)
+        if job.chat_id in self._ready_keys:
+            if key < self._ready_keys[job.chat_id]:
+                # Новый вызов встал в начало очереди чата
+                self._ready_keys[job.chat_id] = key
+                heapq.heappush(self._ready, key + (job.chat_id,))
+        elif (
+            job.chat_id not in self._in_flight
+            and job.chat_id not in self._waiting_chats
+        ):
+            self._schedule(job.chat_id, time.monotonic())
+
+    def _schedule(self, chat_id, now):
+        """Кладёт чат с непустой очередью в кучу готовых или ждущих."""
+        delay = self._blocked.get(chat_id, 0.0) - now
+        if delay <= 0:
+            bucket = self._chats.get(chat_id)
+            delay = bucket.delay(now) if bucket else 0.0
+        if delay > 0:
+            heapq.heappush(self._waiting, (now + delay, chat_id))
+            self._waiting_chats.add(chat_id)
+            return
+        priority, sequence, _ = self._pending[chat_id][0]
+        self._ready_keys[chat_id] = (priority, sequence)
+        heapq.heappush(self._ready, (priority, sequence, chat_id))
+
+    def _release(self, chat_id, now):
+        """Чат освободился после отправки: в очередь готовых, если есть что слать."""
+        self._in_flight.discard(chat_id)
+        if self._pending.get(chat_id):
+            self._schedule(chat_id, now)
+        else:
+            self._pending.pop(chat_id, None)
+
+    def _next_job(self):
+        """Первый по приоритету вызов, который можно отправить сейчас, или
+        (None, сколько ждать)."""
+        now = time.monotonic()
+        while self._waiting and self._waiting[0][0] <= now:
+            _, chat_id = heapq.heappop(self._waiting)
+            self._waiting_chats.discard(chat_id)
+            self._schedule(chat_id, now)
+        # Записи чатов, у которых сменилось начало очереди, отбрасываются
+        while self._ready and (
+            self._ready_keys.get(self._ready[0][2]) != self._ready[0][:2]
+        ):
+            heapq.heappop(self._ready)
+
+        if not self._ready:
+            return None, (self._waiting[0][0] - now if self._waiting else None)
+        delay = self._global.delay(now)
+        if delay > 0:
+            return None, delay
+
+        chat_id = heapq.heappop(self._ready)[2]
+        del self._ready_keys[chat_id]
+        found = heapq.heappop(self._pending[chat_id])[2]
+        self._queued -= 1
+
+        self._global.take(now)
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(
+                self.chat_rate, self.chat_burst, now
+            )
+        bucket.take(now)
+        self._blocked.pop(chat_id, None)
+        self._in_flight.add(chat_id)
+        return found, None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._closed and not self._queued and not self._in_flight:
+                        return
+                    job, wait = self._next_job()
+                    if job is not None:
+                        break
+                    self._condition.wait(wait)
+            self._send(job)
+
+    def _send(self, job):
+        started = time.monotonic()
+        retry_after = None
+        try:
+            result = getattr(self.bot, job.method)(*job.args, **job.kwargs)
+            error = None
+        except ApiTelegramException as e:
+            error = e
+            if e.error_code == 429 and job.attempts < self.max_retries:
+                retry_after = (e.result_json.get("parameters") or {}).get(
+                    "retry_after", 1
+                )
+        except Exception as e:
+            error = e
+        finished = time.monotonic()
+
+        with self._condition:
+            self.send_time_total += finished - started
+            if retry_after is not None:
+                job.attempts += 1
+                self.retried += 1
+                self._blocked[job.chat_id] = finished + retry_after
+                # Повтор сохраняет исходное место в очереди
+                heapq.heappush(
+                    self._pending[job.chat_id], (job.priority, job.sequence, job)
+                )
+                self._queued += 1
+            else:
+                latency = finished - job.enqueued_at
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+                if error is None:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                self._prune(finished)
+            self._release(job.chat_id, finished)
+            self._condition.notify_all()
+
+        if retry_after is not None:
+            return
+        if error is None:
+            job.future.set_result(result)
+        else:
+            print("outbox error", error)
+            job.future.set_exception(error)
+
+    def _prune(self, now):
+        # Bucket, восстановившийся полностью, не отличается от нового
+        if self.sent % 1000 == 0 and len(self._chats) > 1000:
+            for chat_id in [
+                chat_id
+                for chat_id, bucket in self._chats.items()
+                if chat_id not in self._in_flight and bucket.full(now)
+            ]:
+                del self._chats[chat_id]
+
+    def stats(self):
+        with self._condition:
+            done = self.sent + self.failed
+            attempts = done + self.retried
+            return {
+                "queue_depth": self._queued,
+                "in_flight": len(self._in_flight),
+                "sent": self.sent,
+                "failed": self.failed,
+                "retried": self.retried,
+                "latency_avg": self.latency_total / done if done else 0.0,
+                "latency_max": self.latency_max,
+                "send_time_avg": (self.send_time_total / attempts if attempts else 0.0),
+            }
+
+    def join(self, timeout=None):
+        """Ждёт отправки всего, что стоит в очереди."""
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not self._queued and not self._in_flight, timeout
+            )
+
+    def stop(self, timeout=None):
+        """Перестаёт принимать вызовы и отправляет уже поставленные."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
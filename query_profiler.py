@@ -0,0 +1,160 @@
+"""Профилирование запросов SQLAlchemy: медленные запросы и N+1.
+
+Включается секцией [profiling] в config.ini. События движка замеряют каждый
+запрос и сводят его к нормализованному виду (литералы и списки параметров
+заменены на ``?``), так что запросы одной формы попадают в одну строку
+статистики. Запросы дольше порога печатаются сразу. Для каждого обновления
+считается число запросов; если одна и та же форма запроса выполнилась
+больше ``n_plus_one_threshold`` раз, печатается предупреждение о вероятном
+N+1.
+
+    [profiling]
+    enabled = true
+    slow_query_ms = 100
+    n_plus_one = 5
+
+В тестах ``track`` ограничивает число запросов обработчика, см. фикстуру
+``max_queries`` в test_bot.py.
+"""
+
+import functools
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+_LITERALS = re.compile(
+    r"'(?:[^']|'')*'"  # строки
+    r"|\b\d+(?:\.\d+)?\b"  # числа
+    r"|%\(\w+\)s|:\w+|\$\d+|%s"  # именованные и позиционные параметры
+)
+# Развёрнутые списки IN (?, ?, ?) и пачки VALUES
+_LISTS = re.compile(r"\?(?:\s*,\s*\?)+")
+_SPACES = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=2048)
+def normalize(statement):
+    """Форма запроса без литералов и с одним ``?`` вместо списков."""
+    statement = _LITERALS.sub("?", statement)
+    statement = _LISTS.sub("?", statement)
+    return _SPACES.sub(" ", statement).strip()
+
+
+class UpdateProfile:
+    """Запросы, выполненные за одно обновление."""
+
+    __slots__ = ("label", "queries", "db_time", "statements")
+
+    def __init__(self, label):
+        self.label = label
+        self.queries = 0
+        self.db_time = 0.0
+        # нормализованный запрос -> сколько раз выполнен
+        self.statements = Counter()
+
+    def repeated(self, threshold):
+        """Формы запросов, выполненные больше ``threshold`` раз."""
+        return [
+            (statement, count)
+            for statement, count in self.statements.most_common()
+            if count > threshold
+        ]
+
+
+class QueryProfiler:
+    def __init__(self, slow_threshold=0.1, n_plus_one_threshold=5):
+        self.slow_threshold = slow_threshold
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._engines = []
+        # нормализованный запрос -> [число, суммарное время, максимум]
+        self.stats = {}
+        self.slow_queries = 0
+        self.n_plus_one = 0
+
+    def attach(self, engine):
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+        self._engines.append(engine)
+        return self
+
+    def detach(self):
+        for engine in self._engines:
+            event.remove(engine, "before_cursor_execute", self._before)
+            event.remove(engine, "after_cursor_execute", self._after)
+        self._engines = []
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("profiler_started", []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["profiler_started"].pop()
+        shape = normalize(statement)
+        with self._lock:
+            entry = self.stats.get(shape)
+            if entry is None:
+                entry = self.stats[shape] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+            if elapsed >= self.slow_threshold:
+                self.slow_queries += 1
+
+        update = getattr(self._local, "update", None)
+        if update is not None:
+            update.queries += 1
+            update.db_time += elapsed
+            update.statements[shape] += 1
+        if elapsed >= self.slow_threshold:
+            label = update.label if update is not None else "-"
+            print(f"slow query {elapsed * 1000:.1f} ms in {label}: {shape}")
+
+    @contextmanager
+    def track(self, label):
+        """Собирает запросы блока в UpdateProfile и проверяет его на N+1."""
+        previous = getattr(self._local, "update", None)
+        update = self._local.update = UpdateProfile(label)
+        try:
+            yield update
+        finally:
+            self._local.update = previous
+            repeated = update.repeated(self.n_plus_one_threshold)
+            if repeated:
+                with self._lock:
+                    self.n_plus_one += 1
+                for statement, count in repeated:
+                    print(f"possible N+1 in {update.label}: {count} x {statement}")
+
+    def instrument_handler(self, function, label):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with self.track(label):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    def instrument_bot(self, bot, label=None):
+        """Оборачивает обработчики бота; ``label(handler)`` задаёт метку."""
+        for handlers in (bot.message_handlers, bot.callback_query_handlers):
+            for handler in handlers:
+                handler["function"] = self.instrument_handler(
+                    handler["function"],
+                    label(handler) if label else handler["function"].__name__,
+                )
+
+    def relabel(self, label):
+        update = getattr(self._local, "update", None)
+        if update is not None:
+            update.label = label
+
+    def report(self, limit=20):
+        """Самые затратные формы запросов: (запрос, число, всего с, максимум с)."""
+        with self._lock:
+            rows = [(shape, *entry) for shape, entry in self.stats.items()]
+        rows.sort(key=lambda row: row[2], reverse=True)
+        return rows[:limit]
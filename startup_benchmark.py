@@ -0,0 +1,121 @@
+"""Замер времени запуска бота.
+
+- ``import main`` в новом процессе без config.ini и без сети;
+- холодный старт: от запуска main.py до первого getUpdates на локальной
+  подмене Bot API. Первый запуск отправляет меню команд, следующие находят
+  его хэш в ``commands.sha256`` и пропускают setMyCommands.
+
+    python startup_benchmark.py --runs 5
+"""
+
+import argparse
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_bot_api import FakeBotApi
+from loadtest import ROOT, write_config
+
+IMPORT_SNIPPET = (
+    "import time; started = time.perf_counter(); import main; "
+    "print(time.perf_counter() - started)"
+)
+
+
+def time_import(directory):
+    """Время ``import main`` внутри процесса и всего процесса, секунды."""
+    started = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET],
+        cwd=directory,
+        env={**os.environ, "PYTHONPATH": ROOT},
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+    return float(output.strip().splitlines()[-1]), time.perf_counter() - started
+
+
+def time_start(directory, api, timeout=60):
+    """Секунды от запуска main.py до первого getUpdates."""
+    polls = api.polls
+    started = time.perf_counter()
+    bot = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "main.py")],
+        cwd=directory,
+        env={**os.environ, "PYTHONPATH": ROOT},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        if not api.wait_for_poll(timeout, after=polls):
+            raise RuntimeError("bot did not start")
+        return time.perf_counter() - started
+    finally:
+        bot.send_signal(signal.SIGINT)
+        try:
+            bot.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+
+
+def benchmark(runs=5):
+    """Возвращает список (замер, медиана мс, минимум мс, вызовов setMyCommands)."""
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        empty = os.path.join(directory, "empty")
+        os.mkdir(empty)
+        imports = [time_import(empty) for _ in range(runs)]
+        for name, values in (
+            ("import main (in process)", [inside for inside, _ in imports]),
+            ("import main (whole process)", [whole for _, whole in imports]),
+        ):
+            results.append(
+                (name, statistics.median(values) * 1000, min(values) * 1000, 0)
+            )
+
+        api = FakeBotApi().start()
+        try:
+            write_config(
+                directory,
+                api.url,
+                "sqlite:///" + os.path.join(directory, "bot.db"),
+                telegram_limits=False,
+            )
+            first = time_start(directory, api)
+            synced = len(api.calls_for("setMyCommands"))
+            results.append(
+                ("cold start, menu sync", first * 1000, first * 1000, synced)
+            )
+            starts = [time_start(directory, api) for _ in range(runs)]
+            results.append(
+                (
+                    "cold start, cached menu",
+                    statistics.median(starts) * 1000,
+                    min(starts) * 1000,
+                    len(api.calls_for("setMyCommands")) - synced,
+                )
+            )
+        finally:
+            api.stop()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Время запуска бота")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    for name, median, minimum, synced in benchmark(args.runs):
+        print(
+            f"{name:30} median {median:7.1f} ms  min {minimum:7.1f} ms  "
+            f"setMyCommands {synced}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""Выгрузка операций в CSV, Parquet или Arrow IPC.
+
+Строки читаются серверным курсором порциями по ``BATCH_SIZE`` и сразу
+пишутся в файл, поэтому память не зависит от размера выгрузки. Для Parquet и
+Arrow нужен pyarrow.
+
+    python statement.py ledger.csv                         # весь журнал
+    python statement.py out.parquet --client-id 1 --month 2024-10
+    python statement.py out.arrow --format arrow --url postgresql://...
+"""
+
+import argparse
+import configparser
+import csv
+import io
+from datetime import date, datetime
+
+from sqlalchemy import create_engine, or_, select
+from sqlalchemy.orm import aliased
+
+from models import Client, Transaction
+
+BATCH_SIZE = 5000
+FORMATS = ("csv", "parquet", "arrow")
+
+HEADER = [
+    "id",
+    "created_at",
+    "transaction_type",
+    "amount",
+    "client_id",
+    "client_name",
+    "recipient_id",
+    "recipient_name",
+]
+
+
+def month_range(month):
+    """Первый день месяца ``month`` (date) и первый день следующего."""
+    start = month.replace(day=1)
+    if start.month == 12:
+        return start, start.replace(year=start.year + 1, month=1)
+    return start, start.replace(month=start.month + 1)
+
+
+def statement_query(client_id=None, month=None):
+    """Операции клиента (или все) за месяц (или за всё время) по порядку id."""
+    sender = aliased(Client)
+    recipient = aliased(Client)
+    query = (
+        select(
+            Transaction.id,
+            Transaction.created_at,
+            Transaction.transaction_type,
+            Transaction.amount,
+            Transaction.client_id,
+            (sender.first_name + " " + sender.last_name).label("client_name"),
+            Transaction.recipient_id,
+            (recipient.first_name + " " + recipient.last_name).label("recipient_name"),
+        )
+        .join(sender, sender.id == Transaction.client_id)
+        .outerjoin(recipient, recipient.id == Transaction.recipient_id)
+        .order_by(Transaction.id)
+    )
+    if client_id is not None:
+        query = query.where(
+            or_(
+                Transaction.client_id == client_id,
+                Transaction.recipient_id == client_id,
+            )
+        )
+    if month is not None:
+        start, end = month_range(month)
+        query = query.where(
+            Transaction.created_at >= datetime.combine(start, datetime.min.time()),
+            Transaction.created_at < datetime.combine(end, datetime.min.time()),
+        )
+    return query
+
+
+def stream_rows(executor, query, batch_size=BATCH_SIZE):
+    """Порции строк запроса; ``executor`` — Session или Connection."""
+    result = executor.execute(query, execution_options={"yield_per": batch_size})
+    yield from result.partitions()
+
+
+def write_csv(batches, file):
+    """Пишет порции в текстовый файл, возвращает число строк."""
+    writer = csv.writer(file)
+    writer.writerow(HEADER)
+    count = 0
+    for rows in batches:
+        writer.writerows(rows)
+        count += len(rows)
+    return count
+
+
+def _import_pyarrow(file_format):
+    # pyarrow тяжёлый, а боту нужен только CSV: импорт при первой
+    # колоночной выгрузке, а не при импорте модуля
+    try:
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError(f"pyarrow is required for {file_format} export")
+    return pyarrow
+
+
+def _arrow_schema(pyarrow):
+    return pyarrow.schema(
+        [
+            ("id", pyarrow.int64()),
+            ("created_at", pyarrow.timestamp("us")),
+            ("transaction_type", pyarrow.string()),
+            ("amount", pyarrow.float64()),
+            ("client_id", pyarrow.int64()),
+            ("client_name", pyarrow.string()),
+            ("recipient_id", pyarrow.int64()),
+            ("recipient_name", pyarrow.string()),
+        ]
+    )
+
+
+def write_columnar(batches, sink, file_format="parquet"):
+    """Пишет порции в Parquet или Arrow IPC, по группе строк на порцию."""
+    pyarrow = _import_pyarrow(file_format)
+    schema = _arrow_schema(pyarrow)
+    if file_format == "parquet":
+        writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    else:
+        writer = pyarrow.ipc.new_file(sink, schema)
+    count = 0
+    try:
+        for rows in batches:
+            columns = list(zip(*rows))
+            writer.write_batch(
+                pyarrow.record_batch(
+                    [
+                        pyarrow.array(values, type=field.type)
+                        for values, field in zip(columns, schema)
+                    ],
+                    schema=schema,
+                )
+            )
+            count += len(rows)
+    finally:
+        writer.close()
+    return count
+
+
+def export(executor, output, file_format="csv", client_id=None, month=None):
+    """Выгружает операции в двоичный файл ``output``, возвращает число строк."""
+    batches = stream_rows(executor, statement_query(client_id, month))
+    if file_format != "csv":
+        return write_columnar(batches, output, file_format)
+    text = io.TextIOWrapper(output, encoding="utf-8", newline="")
+    try:
+        return write_csv(batches, text)
+    finally:
+        text.flush()
+        text.detach()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("output")
+    parser.add_argument("--format", choices=FORMATS, help="по расширению файла")
+    parser.add_argument("--client-id", type=int)
+    parser.add_argument(
+        "--month",
+        type=lambda value: date.fromisoformat(value + "-01"),
+        help="месяц в виде ГГГГ-ММ",
+    )
+    parser.add_argument("--url", help="URL базы, по умолчанию из alembic.ini")
+    args = parser.parse_args(argv)
+
+    file_format = args.format or args.output.rsplit(".", 1)[-1]
+    if file_format not in FORMATS:
+        parser.error(f"unknown format {file_format!r}, use --format")
+
+    url = args.url
+    if not url:
+        alembic = configparser.ConfigParser()
+        alembic.read("alembic.ini")
+        url = alembic["alembic"]["sqlalchemy.url"]
+
+    engine = create_engine(url)
+    with engine.connect() as connection, open(args.output, "wb") as output:
+        count = export(connection, output, file_format, args.client_id, args.month)
+    engine.dispose()
+    print(f"{count} transactions written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""Несколько процессов-обработчиков с распределением чатов по chat_id.
+
+Один процесс упирается в GIL задолго до Postgres. Супервизор запускает N
+процессов с обработчиками main.py, а сам получает обновления (long polling
+или вебхук, как main.py) и отправляет каждое в процесс ``chat_id % N``. Все
+обновления чата попадают в один процесс, поэтому шаги диалогов и порядок
+обработки внутри чата сохраняются без общего хранилища.
+
+Упавший процесс перезапускается с той же очередью. По SIGINT/SIGTERM
+супервизор перестаёт получать обновления, а процессы дорабатывают свои
+очереди, отправляют исходящие сообщения и завершаются.
+
+    python supervisor.py --workers 4
+
+Кэши у каждого процесса свои. Сброс кэша клиента после записи (например,
+перевода клиенту другого процесса) процесс рассылает остальным через
+отдельные неограниченные управляющие очереди. Их читает свой поток, поэтому
+сброс не ждёт за обновлениями в очереди процесса, а отправитель не
+блокируется на переполненной очереди соседа.
+Метрики процесс i отдаёт на порту ``[metrics] port + 1 + i``.
+
+Выигрыш даёт Postgres и больше одного ядра: SQLite блокирует файл базы на
+запись, и процессы ждут друг друга. Замер: ``python loadtest.py --workers N``.
+"""
+
+import argparse
+import multiprocessing
+import os
+import signal
+import threading
+
+from dispatcher import update_chat_id
+
+
+def shard_for(update, workers):
+    """Номер процесса для обновления; обновления без чата — по update_id."""
+    key = update_chat_id(update)
+    if isinstance(key, tuple):
+        key = update.update_id
+    return key % workers
+
+
+def publisher(index, controls):
+    """Рассылает сброс кэшей клиентов процесса ``index`` остальным процессам."""
+
+    def publish(client_ids):
+        for other, control in enumerate(controls):
+            if other != index:
+                control.put_nowait(tuple(client_ids))
+
+    return publish
+
+
+def apply_invalidations(control):
+    """Поток процесса: сбрасывает кэши клиентов, изменённых другими процессами."""
+    import cache
+
+    while True:
+        client_ids = control.get()
+        if client_ids is None:
+            return
+        cache.invalidate_local(*client_ids)
+
+
+def run_worker(index, queues, controls, config_path, ready=None):
+    """Процесс-обработчик: обновления из очереди в ChatDispatcher main.py."""
+    # Остановкой управляет супервизор, Ctrl+C из терминала процесс не прерывает
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    import cache
+    import card_numbers
+    import main
+    import metrics
+
+    main.create_app(config_path)
+    # Без последовательности в базе (SQLite) номера карт из max(card_number)
+    # совпали бы у процессов, поэтому каждый берёт только свои блоки
+    card_numbers.allocator.partition(index, len(queues))
+    cache.set_publisher(publisher(index, controls))
+    for other, control in enumerate(controls):
+        if other != index:
+            # Выход не ждёт, пока остановившийся процесс прочитает сброс кэша
+            control.cancel_join_thread()
+    threading.Thread(
+        target=apply_invalidations,
+        args=(controls[index],),
+        name="invalidations",
+        daemon=True,
+    ).start()
+    if main.config.getboolean("metrics", "enabled", fallback=True):
+        port = main.config.getint("metrics", "port", fallback=8000)
+        try:
+            metrics.MetricsServer(
+                host=main.config.get("metrics", "host", fallback="0.0.0.0"),
+                port=port + 1 + index if port else 0,
+            ).start()
+        except OSError as e:
+            print("metrics error", e)
+
+    main.outbox.start()
+    dispatcher = main.make_dispatcher()
+    if ready is not None:
+        ready.set()
+    try:
+        updates = queues[index]
+        while True:
+            update = updates.get()
+            if update is None:
+                break
+            dispatcher.submit(update)
+    finally:
+        dispatcher.shutdown()
+        main.outbox.stop()
+
+
+class Supervisor:
+    """Заменяет ChatDispatcher для run_polling и вебхука: ``submit`` отдаёт
+    обновление процессу его чата, ``shutdown`` дожидается их завершения."""
+
+    def __init__(
+        self, workers=None, queue_size=1000, config_path="config.ini", restart=True
+    ):
+        self.workers = workers or os.cpu_count() or 1
+        self.config_path = config_path
+        self.restart = restart
+        # spawn: процессы не наследуют потоки и соединения супервизора
+        self._context = multiprocessing.get_context("spawn")
+        self._queues = [self._context.Queue(queue_size) for _ in range(self.workers)]
+        # Сброс кэшей между процессами, без ограничения размера
+        self._controls = [self._context.Queue() for _ in range(self.workers)]
+        self._processes = [None] * self.workers
+        self._ready = [None] * self.workers
+        self._closed = threading.Event()
+        self._monitor = None
+        self.restarts = 0
+
+    def _spawn(self, index):
+        ready = self._ready[index] = self._context.Event()
+        process = self._context.Process(
+            target=run_worker,
+            args=(index, self._queues, self._controls, self.config_path, ready),
+            name=f"worker-{index}",
+        )
+        process.start()
+        self._processes[index] = process
+
+    def start(self, timeout=60):
+        """Запускает процессы и ждёт, пока каждый создаст приложение: иначе
+        первые обновления ждали бы в очередях импорта и подключения к базе."""
+        for index in range(self.workers):
+            self._spawn(index)
+        for index, ready in enumerate(self._ready):
+            if not ready.wait(timeout):
+                print("worker error", f"worker-{index}", "did not start")
+        self._monitor = threading.Thread(
+            target=self._watch, name="supervisor", daemon=True
+        )
+        self._monitor.start()
+        return self
+
+    def _watch(self):
+        while not self._closed.wait(0.5):
+            for index, process in enumerate(self._processes):
+                if process.is_alive() or self._closed.is_set():
+                    continue
+                print("worker error", process.name, process.exitcode)
+                if self.restart:
+                    self.restarts += 1
+                    self._spawn(index)
+
+    def submit(self, update, block=True, timeout=None):
+        """Ставит обновление в очередь процесса; ``queue.Full`` при переполнении."""
+        if self._closed.is_set():
+            raise RuntimeError("supervisor is shut down")
+        self._queues[shard_for(update, self.workers)].put(update, block, timeout)
+
+    def shutdown(self, timeout=None):
+        """Дорабатывает поставленные обновления и останавливает процессы."""
+        self._closed.set()
+        if self._monitor is not None:
+            self._monitor.join()
+        for updates in self._queues:
+            updates.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                print("worker error", process.name, "did not stop, terminating")
+                process.terminate()
+                process.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бот в нескольких процессах")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--config", default="config.ini")
+    args = parser.parse_args(argv)
+
+    import main as bot_app
+
+    # Меню команд синхронизирует супервизор, процессы найдут его хэш
+    bot_app.create_app(args.config)
+    supervisor = Supervisor(
+        workers=args.workers
+        or bot_app.config.getint("supervisor", "workers", fallback=os.cpu_count()),
+        queue_size=bot_app.config.getint("supervisor", "queue_size", fallback=1000),
+        config_path=args.config,
+    ).start()
+    # SIGTERM (docker stop) останавливает так же, как Ctrl+C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if bot_app.config.getboolean("webhook", "enabled", fallback=False):
+        bot_app.run_webhook(supervisor)
+    else:
+        bot_app.run_polling(supervisor)
+
+
+if __name__ == "__main__":
+    main()
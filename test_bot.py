@@ -1,7 +1,12 @@
 import pytest
-from unittest.mock import Mock, patch
+from unittest.mock import MagicMock, Mock, patch
 import os
+import json
+import queue
 import shutil
+import time
+import threading
+import urllib.error
 from main import (
     # bot,
     escape_markdown,
@@ -11,7 +16,16 @@ from main import (
     account,
     create_card,
 )
+from dispatcher import ChatDispatcher
+import cache
+import card_numbers
+import conversations
+import db
+import explain_check
+import logger
+import log_query
 from logger import log_message_info
+from webhook import WebhookServer, post_update
 
 
 @pytest.fixture
@@ -30,6 +44,15 @@ def mock_message():
     )
 
 
+@pytest.fixture(autouse=True)
+def clear_caches():
+    cache.clear()
+    conversations.store.clear()
+    yield
+    cache.clear()
+    conversations.store.clear()
+
+
 @pytest.fixture
 def mock_session():
     session = Mock()
@@ -37,9 +60,79 @@ def mock_session():
     return session
 
 
+@pytest.fixture
+def sqlite_session():
+    """Подменяет main.Session сессиями поверх SQLite в памяти."""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from sqlalchemy.pool import StaticPool
+    from models import Base
+
+    engine = create_engine(
+        "sqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    Base.metadata.create_all(engine)
+    session_factory = sessionmaker(
+        class_=db.RoutingSession, bind=engine, expire_on_commit=False
+    )
+    with patch("main.Session", session_factory):
+        yield session_factory
+    engine.dispose()
+
+
+@pytest.fixture
+def max_queries(sqlite_session):
+    """``with max_queries(n):`` падает, если блок выполнил больше n запросов."""
+    from contextlib import contextmanager
+    from query_profiler import QueryProfiler
+
+    profiler = QueryProfiler().attach(sqlite_session.kw["bind"])
+
+    @contextmanager
+    def check(limit):
+        with profiler.track("test") as update:
+            yield update
+        assert update.queries <= limit, "\n".join(
+            f"{count} x {statement}" for statement, count in update.statements.items()
+        )
+
+    yield check
+    profiler.detach()
+
+
 # ------------------------ Unit-тесты ------------------------
 
 
+def test_conversation_store_expires_and_caps(tmp_path):
+    store = conversations.ConversationStore(maxsize=2, ttl=60)
+    store.set(1, "finish_top_up", card_id=10)
+    store.set(2, "process_email", last_name="Doe")
+    store.set(3, "finish_top_up", card_id=30)
+    assert len(store) == 2 and not store.pending(1)
+    assert store.pop(3).args == {"card_id": 30}
+    assert store.pop(3) is None
+
+    store.ttl = 0
+    store.set(4, "finish_top_up", card_id=40)
+    assert not store.pending(4) and store.pop(4) is None
+
+    # Второй экземпляр с тем же файлом — перезапущенный или соседний процесс
+    path = str(tmp_path / "conversations.db")
+    conversations.SQLiteConversationStore(path).set(
+        5, "finish_transfer", card_from_id=1, card_to_id=2
+    )
+    restarted = conversations.SQLiteConversationStore(path)
+    assert restarted.pending(5)
+    step = restarted.pop(5)
+    assert (step.name, step.args) == (
+        "finish_transfer",
+        {"card_from_id": 1, "card_to_id": 2},
+    )
+    assert not restarted.pending(5)
+
+
 def test_escape_markdown():
     text = "Hello *world*! _Markdown_ test."
     escaped = escape_markdown(text)
@@ -56,6 +149,29 @@ def test_check_client_not_found(mock_session):
     assert check_client(mock_session, 12345) is False
 
 
+def test_resolve_client_uses_cache(mock_session):
+    mock_session.query().filter().first.return_value = Mock(id=7, first_name="Test")
+    mock_session.query.reset_mock()
+
+    assert cache.resolve_client(mock_session, 12345) == (7, "Test")
+    assert cache.resolve_client(mock_session, 12345) == (7, "Test")
+    assert mock_session.query.call_count == 1
+
+
+def test_ttl_cache_evicts_expired_and_least_recent():
+    ttl_cache = cache.TTLCache(maxsize=2, ttl=60)
+    ttl_cache.set("a", 1)
+    ttl_cache.set("b", 2)
+    ttl_cache.get("a")
+    ttl_cache.set("c", 3)
+    assert ttl_cache.get("b") is None
+    assert ttl_cache.get("a") == 1
+
+    expired = cache.TTLCache(ttl=0)
+    expired.set("a", 1)
+    assert expired.get("a") is None
+
+
 @patch("logger.os.makedirs")
 @patch("logger.open", create=True)
 def test_log_message_info(mock_open, mock_makedirs, mock_message):
@@ -63,8 +179,11 @@ def test_log_message_info(mock_open, mock_makedirs, mock_message):
     if os.path.exists("logs"):
         shutil.rmtree("logs")  # Рекурсивное удаление директории с содержимым
 
-    # Вызов функции, которая должна создать директорию
-    log_message_info(mock_message)
+    # Свежий писатель, чтобы файл дня гарантированно открывался заново
+    with patch("logger._writer", logger.LogWriter()) as writer:
+        # Вызов функции, которая должна создать директорию
+        log_message_info(mock_message)
+        writer.stop()
 
     # Проверка, что директория была создана
     mock_makedirs.assert_called_once_with(
@@ -72,6 +191,215 @@ def test_log_message_info(mock_open, mock_makedirs, mock_message):
     )  # Убедитесь, что директория 'logs' была создана
 
 
+def test_log_writer_batches_and_rolls_over(tmp_path):
+    writer = logger.LogWriter(
+        directory=str(tmp_path), batch_size=2, flush_interval=0.05
+    )
+    writer.write("01.01.2025", "first\n")
+    writer.write("01.01.2025", "second\n")
+    writer.write("02.01.2025", "third\n")
+    writer.flush()
+
+    # Файл дня остаётся открытым между пачками
+    assert writer._file is not None
+    writer.stop()
+
+    assert (tmp_path / "log_01.01.2025.log").read_text(
+        encoding="utf-8"
+    ) == "first\nsecond\n"
+    assert (tmp_path / "log_02.01.2025.log").read_text(encoding="utf-8") == "third\n"
+    assert writer._file is None
+
+
+def test_jsonl_log_and_index_query(tmp_path, mock_message):
+    mock_message.chat.type = "private"
+    mock_message.chat.title = None
+    other_message = Mock(
+        chat=Mock(id=-100, type="group", title="Group"),
+        from_user=Mock(
+            id=11111,
+            username="other",
+            first_name="Other",
+            last_name=None,
+            language_code="ru",
+        ),
+        text="привет",
+        content_type="text",
+    )
+
+    writer = logger.LogWriter(directory=str(tmp_path), extension="jsonl")
+    with patch("logger._writer", writer), patch("logger._format", "jsonl"):
+        for message in (mock_message, other_message, mock_message):
+            log_message_info(message)
+        writer.stop()
+
+    (log_path,) = tmp_path.glob("*.jsonl")
+    lines = log_path.read_text(encoding="utf-8").splitlines()
+    assert len(lines) == 3
+    assert json.loads(lines[1])["chat_title"] == "Group"
+
+    records = list(log_query.query(str(log_path), "user_id", 67890))
+    assert [record["text"] for record in records] == ["test text", "test text"]
+    assert os.path.exists(log_query.index_path(str(log_path)))
+    assert [r["user_id"] for r in log_query.query(str(log_path), "chat_id", -100)] == [
+        11111
+    ]
+    assert list(log_query.query(str(log_path), "user_id", 1)) == []
+
+
+def test_log_query_index_grows_with_log(tmp_path):
+    log_path = str(tmp_path / "log_01.01.2025.jsonl")
+
+    def append(user_ids, tail=b""):
+        with open(log_path, "ab") as log:
+            for user_id in user_ids:
+                log.write(json.dumps({"user_id": user_id, "chat_id": 1}).encode())
+                log.write(b"\n")
+            log.write(tail)
+
+    append([1, 2, 1, 3, 1], tail=b'{"user_id": 1, "cha')
+    # Блоки по 4 записи: индекс не держит в памяти весь лог
+    assert log_query.build_index(log_path, chunk_entries=4) == 10
+    assert len(log_query.lookup(log_path, "user_id", 1)) == 3
+
+    # Дописанная строка и новые записи индексируются без перечитывания лога
+    with patch("log_query.build_index") as build_index:
+        append([], tail=b't_id": 1}\n')
+        append([2, 1])
+        offsets = log_query.lookup(log_path, "user_id", 1)
+        build_index.assert_not_called()
+    assert offsets == sorted(offsets)
+    assert [r["user_id"] for r in log_query.query(log_path, "user_id", 1)] == [1] * 5
+
+    with patch("log_query.MAX_RUNS", 1):
+        append([1])
+        assert log_query.update_index(log_path) == 2
+    with open(log_query.index_path(log_path), "rb") as index:
+        assert log_query._read_header(index) == (os.path.getsize(log_path), 1)
+    assert len(log_query.lookup(log_path, "chat_id", 1)) == 9
+
+
+def test_webhook_server_enqueues_verified_updates():
+    processed = threading.Event()
+    fake_bot = Mock()
+    fake_bot.process_new_updates.side_effect = lambda updates: processed.set()
+    server = WebhookServer(fake_bot, host="127.0.0.1", port=0, secret_token="s3cret")
+    server.start()
+    url = f"http://127.0.0.1:{server.port}/webhook"
+    update = {
+        "update_id": 1,
+        "message": {
+            "message_id": 10,
+            "date": 0,
+            "chat": {"id": 12345, "type": "private"},
+            "from": {"id": 67890, "is_bot": False, "first_name": "Test"},
+            "text": "/start",
+        },
+    }
+    try:
+        with pytest.raises(urllib.error.HTTPError) as error:
+            post_update(url, update, "wrong")
+        assert error.value.code == 403
+
+        assert post_update(url, update, "s3cret") == 200
+        assert processed.wait(5)
+    finally:
+        server.stop()
+
+    (updates,) = fake_bot.process_new_updates.call_args.args
+    assert updates[0].message.text == "/start"
+    assert fake_bot.threaded is False
+
+
+def test_chat_dispatcher_keeps_per_chat_order():
+    seen = []
+    running = set()
+    overlaps = []
+    lock = threading.Lock()
+
+    def process(updates):
+        chat_id = updates[0].message.chat.id
+        with lock:
+            if chat_id in running:
+                overlaps.append(chat_id)
+            running.add(chat_id)
+        time.sleep(0.005)
+        with lock:
+            running.discard(chat_id)
+            seen.append((chat_id, updates[0].update_id))
+
+    fake_bot = Mock()
+    fake_bot.process_new_updates.side_effect = process
+    dispatcher = ChatDispatcher(fake_bot, workers=4)
+    for update_id in range(30):
+        dispatcher.submit(
+            Mock(update_id=update_id, message=Mock(chat=Mock(id=update_id % 3)))
+        )
+    dispatcher.shutdown()
+
+    assert overlaps == []
+    for chat_id in range(3):
+        ids = [update_id for chat, update_id in seen if chat == chat_id]
+        assert ids == sorted(ids) and len(ids) == 10
+    stats = dispatcher.stats()
+    assert stats["processed"] == 30 and stats["pending"] == 0
+    assert stats["wait_time_max"] >= stats["wait_time_avg"] > 0
+
+
+def test_chat_dispatcher_rejects_when_chat_queue_full():
+    release = threading.Event()
+    fake_bot = Mock()
+    fake_bot.process_new_updates.side_effect = lambda updates: release.wait(5)
+    dispatcher = ChatDispatcher(fake_bot, workers=2, chat_queue_size=2)
+    update = Mock(update_id=1, message=Mock(chat=Mock(id=1)))
+    dispatcher.submit(update)
+    dispatcher.submit(update)
+    with pytest.raises(queue.Full):
+        dispatcher.submit(update, block=False)
+    release.set()
+    dispatcher.shutdown()
+    assert dispatcher.stats()["rejected"] == 1
+
+
+def test_session_scope_closes_and_rolls_back():
+    session = Mock()
+    with pytest.raises(RuntimeError):
+        with db.session_scope(lambda: session):
+            raise RuntimeError
+    session.rollback.assert_called_once()
+    session.close.assert_called_once()
+
+
+def test_timed_pool_records_checkout_wait(tmp_path):
+    from sqlalchemy import create_engine
+
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'pool.db'}",
+        poolclass=db.TimedQueuePool,
+        pool_size=1,
+        max_overflow=0,
+    )
+    before = db.pool_stats.snapshot()["checkouts"]
+    with engine.connect():
+        pass
+    assert db.pool_stats.snapshot()["checkouts"] == before + 1
+    engine.dispose()
+
+
+def test_hot_queries_use_indexes():
+    from sqlalchemy import create_engine
+    from models import Base
+
+    url = os.environ.get("TEST_DATABASE_URL", "sqlite://")
+    engine = create_engine(url)
+    Base.metadata.create_all(engine)
+    with engine.connect() as connection:
+        results = explain_check.check_indexes(connection)
+    engine.dispose()
+
+    assert [name for name, handlers, ok, nodes in results if not ok] == []
+
+
 # -------------------- Интеграционные тесты --------------------
 
 
@@ -96,6 +424,7 @@ def test_register_existing_client(mock_send_message, mock_session, mock_message)
     mock_send_message.assert_called_once_with(
         mock_message.chat.id, "Test, Вы уже зарегистрированы!"
     )
+    mock_session.return_value.close.assert_called_once()
 
 
 @patch("main.Session")
@@ -133,11 +462,11 @@ def test_account(mock_send_message, mock_session, mock_message):
         )
     ]
 
-    mock_session.return_value.query().filter.return_value.one.return_value = mock_client
-    mock_session.return_value.query().filter.return_value.all.side_effect = [
-        mock_loans,
-        mock_cards,
-    ]
+    # Карты и активные кредиты загружаются вместе с клиентом
+    mock_client.loans = mock_loans
+    mock_client.cards = mock_cards
+    query = mock_session.return_value.query.return_value
+    query.options.return_value.filter.return_value.first.return_value = mock_client
 
     account(mock_message)
 
@@ -158,23 +487,1172 @@ def test_account(mock_send_message, mock_session, mock_message):
         parse_mode="HTML",
     )
 
+    # Повторный вызов отвечает из кэша без обращения к базе
+    mock_session.reset_mock()
+    account(mock_message)
+    mock_session.assert_not_called()
+    mock_send_message.assert_called_with(
+        mock_message.chat.id, expected_message, parse_mode="HTML"
+    )
+
 
+@patch("main.card_numbers.allocator.allocate")
 @patch("main.Session")
 @patch("main.bot.send_message")
-def test_create_card(mock_send_message, mock_session, mock_message):
-    # Мокаем клиента и последнюю карту
+def test_create_card(mock_send_message, mock_session, mock_allocate, mock_message):
+    # Мокаем клиента и выданный номер карты
     mock_client = Mock(id=1)
-    mock_last_card = Mock(id=9999, card_number="0000 0000 0000 9999")
+    mock_allocate.return_value = "0000 0000 0000 9995"
 
     mock_session.return_value.query().filter.return_value.first.return_value = (
         mock_client
     )
-    mock_session.return_value.query().order_by().first.return_value = mock_last_card
 
     create_card(mock_message)
 
+    # Номер не выводится из последней строки таблицы cards
+    mock_session.return_value.query().order_by.assert_not_called()
+    mock_allocate.assert_called_once_with(mock_session.return_value)
     mock_send_message.assert_called_once_with(
         mock_message.chat.id,
-        "Карта с номером <code>0000 0000 0000 9999</code> создана!",
+        "Карта с номером <code>0000 0000 0000 9995</code> создана!",
         parse_mode="HTML",
     )
+
+
+def test_async_register_and_account_flow(mock_message):
+    pytest.importorskip("aiohttp")
+    pytest.importorskip("aiosqlite")
+    import asyncio
+    import datetime
+    from unittest.mock import AsyncMock
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+    from sqlalchemy import select
+    import async_main
+    from models import Base, Card, Loan
+
+    async def scenario():
+        engine = create_async_engine("sqlite+aiosqlite://")
+        async with engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        session_factory = async_sessionmaker(engine, expire_on_commit=False)
+
+        send_message = AsyncMock()
+        with patch("async_main.Session", session_factory), patch(
+            "async_main.bot.send_message", send_message
+        ), patch("async_main.log_message_info"), patch(
+            "card_numbers.allocator", card_numbers.CardNumberAllocator()
+        ):
+            await async_main.register(mock_message)
+            for text in ("Doe", "John", "Ivanovich", "john@example.com"):
+                mock_message.text = text
+                await async_main.process_next_step(mock_message)
+            await async_main.account(mock_message)
+
+            # Старая карта с номером "... None" и обычная карта
+            async with session_factory() as session:
+                client = await async_main.get_client(session, mock_message.from_user.id)
+                for number in (
+                    "0000 0000 0000 None",
+                    card_numbers.format_card_number(500),
+                ):
+                    session.add(
+                        Card(
+                            client_id=client.id,
+                            card_number=number,
+                            expiration_date=datetime.date(2030, 1, 1),
+                        )
+                    )
+                await session.commit()
+            await async_main.create_card(mock_message)
+
+            # Пополнение новой карты через кнопку CallbackRouter и шаг диалога
+            await async_main.top_up(mock_message)
+            markup = send_message.call_args.kwargs["reply_markup"]
+            call = Mock(
+                data=markup.keyboard[-1][0].callback_data,
+                message=mock_message,
+                from_user=mock_message.from_user,
+            )
+            with patch("async_main.bot.edit_message_text", AsyncMock()):
+                await async_main.route_callback(call)
+            mock_message.text = "70"
+            await async_main.process_next_step(mock_message)
+
+            # Погашение кредита с пополненной карты
+            async with session_factory() as session:
+                loan = Loan(client_id=client.id, amount=50.0, interest_rate=10.0)
+                session.add(loan)
+                await session.commit()
+                card = (
+                    await session.execute(
+                        select(Card).where(
+                            Card.card_number == card_numbers.format_card_number(501)
+                        )
+                    )
+                ).scalar_one()
+            with patch("async_main.bot.edit_message_text", AsyncMock()):
+                await async_main.callback_query_loan_pay_card(call, loan.id, card.id)
+                await async_main.callback_query_loan_pay_card(call, loan.id, card.id)
+            async with session_factory() as session:
+                paid = (await session.get(Loan, loan.id)).status, (
+                    await session.get(Card, card.id)
+                ).balance
+        await engine.dispose()
+        return send_message, paid
+
+    send_message, paid = asyncio.run(scenario())
+    assert paid == ("paid", 20.0)
+
+    assert not conversations.store.pending(mock_message.chat.id)
+    texts = [call.args[1] for call in send_message.call_args_list]
+    assert texts[-5] == "Регистрация завершена! Спасибо!"
+    assert texts[-4].startswith(
+        "Ваш аккаунт:\nФИО: Doe John Ivanovich\nEmail: john@example.com\n"
+    )
+    new_card = card_numbers.format_card_number(501)
+    assert texts[-3] == f"Карта с номером <code>{new_card}</code> создана!"
+    assert texts[-1] == (
+        f"Баланс карты <code>{new_card}</code> пополнен на 70 ₽, "
+        "текущий баланс: 70.0 ₽"
+    )
+
+
+def test_card_number_format_and_luhn():
+    assert card_numbers.format_card_number(7992739871) == "0000 0799 2739 8713"
+    assert card_numbers.is_valid_card_number("4539 1488 0343 6467")
+    assert not card_numbers.is_valid_card_number("4539 1488 0343 6468")
+
+
+def test_card_number_allocator_takes_blocks_from_sequence():
+    session = Mock()
+    session.get_bind.return_value.dialect.supports_sequences = True
+    session.execute.return_value.scalar.side_effect = [501, 601]
+    allocator = card_numbers.CardNumberAllocator()
+
+    numbers = [allocator.allocate(session) for _ in range(allocator.block_size + 1)]
+
+    assert session.execute.call_count == 2
+    assert numbers[0].startswith("0000 0000 0000 501")
+    assert len(set(numbers)) == len(numbers)
+    assert all(card_numbers.is_valid_card_number(number) for number in numbers)
+
+
+def test_card_number_allocator_is_unique_across_threads():
+    session = Mock()
+    session.get_bind.return_value.dialect.supports_sequences = True
+    blocks = iter(range(1, 10**6, 100))
+    session.execute.return_value.scalar.side_effect = lambda: next(blocks)
+    allocator = card_numbers.CardNumberAllocator()
+    numbers = []
+
+    def worker():
+        for _ in range(250):
+            numbers.append(allocator.allocate(session))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(numbers)) == 2000
+
+
+def test_card_number_fallback_partitions_do_not_overlap():
+    # Процессы супервизора без последовательности видят разный max(card_number)
+    numbers = set()
+    for index, last in enumerate(
+        [None, card_numbers.format_card_number(250), card_numbers.format_card_number(7)]
+    ):
+        session = MagicMock()
+        session.get_bind.return_value.dialect.supports_sequences = False
+        session.scalars.return_value.__iter__ = lambda self: iter(
+            [last] if last else []
+        )
+        allocator = card_numbers.CardNumberAllocator()
+        allocator.partition(index, 3)
+        allocated = [allocator.allocate(session) for _ in range(250)]
+        numbers.update(allocated)
+        assert session.scalars.call_count == 1
+
+    assert len(numbers) == 750
+    assert min(numbers) > card_numbers.format_card_number(250)
+
+
+def test_card_number_fallback_skips_legacy_numbers(sqlite_session):
+    import datetime
+    from models import Card, Client
+
+    with sqlite_session() as session:
+        client = Client(
+            first_name="John", last_name="Doe", email="john@example.com", telegram_id=1
+        )
+        session.add(client)
+        session.flush()
+        # Первую карту прежний create_card сохранял с id=None в номере
+        for number in ("0000 0000 0000 None", card_numbers.format_card_number(42)):
+            session.add(
+                Card(
+                    client_id=client.id,
+                    card_number=number,
+                    expiration_date=datetime.date(2030, 1, 1),
+                )
+            )
+        session.commit()
+
+        number = card_numbers.CardNumberAllocator().allocate(session)
+
+    assert number == card_numbers.format_card_number(43)
+
+
+def test_supervisor_broadcasts_cache_invalidation():
+    import supervisor
+
+    controls = [queue.Queue() for _ in range(3)]
+    cache.accounts.set(7, "stale")
+    with patch("cache._publish", supervisor.publisher(1, controls)):
+        cache.invalidate_client(5, 7)
+    assert cache.accounts.get(7) is None
+    assert controls[1].empty()
+    for control in (controls[0], controls[2]):
+        assert control.get_nowait() == (5, 7)
+
+    # Поток получателя сбрасывает свой кэш и не рассылает сброс дальше
+    cache.accounts.set(7, "stale")
+    version = cache.card_version(7)
+    controls[0].put((7,))
+    controls[0].put(None)
+    with patch("cache._publish") as publish:
+        supervisor.apply_invalidations(controls[0])
+    publish.assert_not_called()
+    assert cache.accounts.get(7) is None
+    assert cache.card_version(7) != version
+
+
+def test_supervisor_shards_by_chat():
+    from telebot import types
+    import supervisor
+
+    def update(update_id, chat_id=None):
+        payload = {"update_id": update_id}
+        if chat_id is not None:
+            payload["message"] = {
+                "message_id": 1,
+                "date": 0,
+                "chat": {"id": chat_id, "type": "private"},
+                "text": "/account",
+            }
+        return types.Update.de_json(payload)
+
+    assert supervisor.shard_for(update(1, chat_id=42), 4) == 2
+    assert supervisor.shard_for(update(2, chat_id=42), 4) == 2
+    assert supervisor.shard_for(update(7), 4) == 3
+
+
+@patch("main.bot.send_message")
+def test_account_single_round_trip_and_invalidation(
+    mock_send_message, sqlite_session, mock_message
+):
+    from sqlalchemy import event
+    from models import Client, Card, Loan
+    import datetime
+    import main
+
+    with sqlite_session() as session:
+        client = Client(
+            first_name="John",
+            last_name="Doe",
+            patronymic="",
+            email="john@example.com",
+            telegram_id=mock_message.from_user.id,
+        )
+        session.add(client)
+        session.flush()
+        session.add_all(
+            [
+                Card(
+                    client_id=client.id,
+                    card_number="0000 0000 0000 0018",
+                    expiration_date=datetime.date(2030, 1, 1),
+                    balance=100.0,
+                ),
+                Card(
+                    client_id=client.id,
+                    card_number="0000 0000 0000 0026",
+                    expiration_date=datetime.date(2030, 1, 1),
+                    balance=5.0,
+                ),
+                Loan(client_id=client.id, amount=50.0, interest_rate=5.0),
+                Loan(client_id=client.id, amount=0, interest_rate=5.0, status="paid"),
+            ]
+        )
+        session.commit()
+        client_id = client.id
+
+    statements = []
+    engine = sqlite_session.kw["bind"]
+    listener = lambda *args: statements.append(args[2])  # noqa: E731
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        main.account(mock_message)
+        assert len(statements) == 1
+        text = mock_send_message.call_args.args[1]
+        assert text.count("Номер карты") == 2 and text.count("Сумма") == 1
+
+        main.account(mock_message)
+        assert len(statements) == 1
+
+        cache.invalidate_client(client_id)
+        main.account(mock_message)
+        assert len(statements) == 2
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+
+
+def test_history_keyset_pages(sqlite_session):
+    from models import Transaction
+    from history import fetch_history_page, render_history_page
+
+    with sqlite_session() as session:
+        for number in range(25):
+            session.add(
+                Transaction(
+                    client_id=1 if number % 2 else 2,
+                    recipient_id=1 if number % 3 else 2,
+                    amount=number,
+                    transaction_type="transfer",
+                )
+            )
+        # Пополнение: клиент и отправитель, и получатель
+        session.add(
+            Transaction(
+                client_id=1, recipient_id=1, amount=5, transaction_type="top_up"
+            )
+        )
+        session.commit()
+
+        expected = [
+            row.id
+            for row in session.query(Transaction.id)
+            .filter((Transaction.client_id == 1) | (Transaction.recipient_id == 1))
+            .order_by(Transaction.id.desc())
+        ]
+
+        first, has_older, has_newer = fetch_history_page(session, 1, size=10)
+        assert [row.id for row in first] == expected[:10]
+        assert has_older and not has_newer
+
+        second, has_older, has_newer = fetch_history_page(
+            session, 1, before=first[-1].id, size=10
+        )
+        assert [row.id for row in second] == expected[10:20]
+        assert has_newer
+
+        back, has_older, has_newer = fetch_history_page(
+            session, 1, after=second[0].id, size=10
+        )
+        assert [row.id for row in back] == expected[:10]
+        assert has_older and not has_newer
+
+    text = render_history_page(1, first)
+    assert text.startswith("История операций:\n")
+    assert "Пополнение: +5.0 ₽" in text
+
+
+@patch("main.bot.send_message")
+def test_finish_transfer_is_atomic(mock_send_message, sqlite_session, mock_message):
+    from models import Client, Card, Transaction
+    import datetime
+    import main
+
+    with sqlite_session() as session:
+        client = Client(
+            first_name="John",
+            last_name="Doe",
+            email="john@example.com",
+            telegram_id=mock_message.from_user.id,
+        )
+        session.add(client)
+        session.flush()
+        cards = [
+            Card(
+                client_id=client.id,
+                card_number=number,
+                expiration_date=datetime.date(2030, 1, 1),
+                balance=100.0,
+            )
+            for number in ("0000 0000 0000 0018", "0000 0000 0000 0026")
+        ]
+        session.add_all(cards)
+        session.commit()
+        card_from, card_to = (card.id for card in cards)
+
+    mock_message.text = "150"
+    main.finish_transfer(mock_message, card_from, card_to)
+    assert mock_send_message.call_args.args[1] == "Недостаточно средств!"
+    step = conversations.store.pop(mock_message.chat.id)
+    assert step.name == "finish_transfer"
+    assert step.args == {"card_from_id": card_from, "card_to_id": card_to}
+
+    mock_message.text = "60"
+    main.finish_transfer(mock_message, card_from, card_to)
+    assert "текущий баланс: 40.0 ₽" in mock_send_message.call_args.args[1]
+
+    with sqlite_session() as session:
+        balances = [
+            session.get(Card, card_id).balance for card_id in (card_from, card_to)
+        ]
+        assert balances == [40.0, 160.0]
+        assert session.query(Transaction).count() == 1
+
+
+def test_transfers_conserve_money_under_contention(tmp_path):
+    import transfers
+
+    from sqlalchemy import create_engine, func, select
+    from models import Card, Client, Transaction
+
+    url = f"sqlite:///{tmp_path / 'transfers.db'}"
+    with pytest.raises(RuntimeError, match="alembic upgrade head"):
+        transfers.stress(url, threads=4, transfers=50, cards=4)
+    ok, insufficient, _ = transfers.stress(
+        url, threads=4, transfers=50, cards=4, create_schema=True
+    )
+    assert ok + insufficient == 200
+    assert ok > 0
+
+    # Проверка не оставляет за собой данных
+    engine = create_engine(url)
+    with engine.connect() as connection:
+        for model in (Client, Card, Transaction):
+            assert connection.scalar(select(func.count()).select_from(model)) == 0
+    engine.dispose()
+
+    # Ошибка в потоке выходит наружу, а не превращается в расхождение сумм
+    with patch("transfers.transfer", side_effect=RuntimeError("deadlock detected")):
+        with pytest.raises(RuntimeError, match="deadlock detected"):
+            transfers.stress(url, threads=2, transfers=5, cards=2)
+
+
+def test_top_up_and_loan_payment_race_transfers(tmp_path):
+    import datetime
+    import random
+    from sqlalchemy import create_engine, func, select
+    from sqlalchemy.orm import sessionmaker
+    from models import Base, Card, Client, Loan, Transaction
+    import transfers
+
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'race.db'}", connect_args={"timeout": 30}
+    )
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine, expire_on_commit=False)
+    with Session() as session:
+        client = Client(
+            first_name="John", last_name="Doe", email="john@example.com", telegram_id=1
+        )
+        session.add(client)
+        session.flush()
+        for number in range(4):
+            session.add(
+                Card(
+                    client_id=client.id,
+                    card_number=card_numbers.format_card_number(number + 1),
+                    expiration_date=datetime.date(2030, 1, 1),
+                    balance=1000.0,
+                )
+            )
+        for _ in range(10):
+            session.add(Loan(client_id=client.id, amount=50.0, interest_rate=10.0))
+        session.commit()
+        card_ids = session.scalars(select(Card.id)).all()
+        loan_ids = session.scalars(select(Loan.id)).all()
+
+    paid = []
+    errors = []
+
+    def run(action):
+        try:
+            with Session() as session:
+                action(session)
+        except Exception as e:
+            errors.append(e)
+
+    def transfer_money(session):
+        rnd = random.Random(1)
+        for _ in range(40):
+            try:
+                transfers.transfer(session, *rnd.sample(card_ids, 2), 30)
+            except transfers.InsufficientFunds:
+                pass
+
+    def top_up(session):
+        for number in range(40):
+            transfers.top_up(session, card_ids[number % 4], 10)
+
+    def pay_loans(session):
+        # Каждый кредит пытаются погасить два потока
+        for loan_id in loan_ids:
+            try:
+                paid.append(transfers.pay_loan(session, loan_id, card_ids[0]).amount)
+            except transfers.LoanNotFound:
+                pass
+
+    threads = [
+        threading.Thread(target=run, args=(action,))
+        for action in (
+            transfer_money,
+            transfer_money,
+            top_up,
+            top_up,
+            pay_loans,
+            pay_loans,
+        )
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert paid == [50.0] * 10
+    with Session() as session:
+        total = session.scalar(select(func.sum(Card.balance)))
+        assert total == 4000.0 + 2 * 40 * 10 - 10 * 50.0
+        assert set(session.scalars(select(Loan.status))) == {"paid"}
+        assert (
+            session.scalar(
+                select(func.count()).where(Transaction.transaction_type == "loan_pay")
+            )
+            == 10
+        )
+    engine.dispose()
+
+
+@patch("main.bot.edit_message_text")
+def test_loan_pay_card_debits_once(mock_edit_message_text, sqlite_session):
+    import datetime
+    from models import Card, Client, Loan
+    import main
+
+    with sqlite_session() as session:
+        client = Client(
+            first_name="John", last_name="Doe", email="john@example.com", telegram_id=1
+        )
+        session.add(client)
+        session.flush()
+        card = Card(
+            client_id=client.id,
+            card_number=card_numbers.format_card_number(1),
+            expiration_date=datetime.date(2030, 1, 1),
+            balance=100.0,
+        )
+        loan = Loan(client_id=client.id, amount=60.0, interest_rate=10.0)
+        session.add_all([card, loan])
+        session.commit()
+        card_id, loan_id = card.id, loan.id
+
+    call = Mock(from_user=Mock(id=1))
+    main.callback_query_loan_pay_card(call, loan_id, card_id)
+    main.callback_query_loan_pay_card(call, loan_id, card_id)
+
+    mock_edit_message_text.assert_called_once_with(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text="Кредит успешно погашен!",
+    )
+    with sqlite_session() as session:
+        assert session.get(Card, card_id).balance == 40.0
+        assert session.get(Loan, loan_id).status == "paid"
+
+
+def test_accrual_compounds_daily_and_resumes(tmp_path):
+    import datetime
+    from sqlalchemy import create_engine, select
+    from models import Base, Loan
+    import accrual
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'loans.db'}")
+    Base.metadata.create_all(engine)
+    start = datetime.date(2024, 1, 1)
+    today = datetime.date(2024, 1, 31)
+    overdue = datetime.date(2024, 1, 21)
+    with engine.begin() as connection:
+        connection.execute(
+            Loan.__table__.insert(),
+            [
+                dict(
+                    client_id=1,
+                    amount=100.0,
+                    interest_rate=10.0,
+                    status=status,
+                    accrued_on=accrued_on,
+                    due_date=due_date,
+                )
+                for status, accrued_on, due_date in [
+                    ("active", start, None),  # за контрольной точкой
+                    ("active", start, None),
+                    ("active", start, overdue),  # просрочен последние 10 дней
+                    ("paid", start, None),
+                    ("active", None, None),
+                ]
+            ],
+        )
+
+    checkpoint = tmp_path / "accrual.json"
+    accrual.write_checkpoint(str(checkpoint), today, 1)
+    processed = accrual.run(
+        engine, today=today, chunk_size=2, checkpoint_path=str(checkpoint)
+    )
+    assert processed == 3
+    assert not checkpoint.exists()
+    with engine.connect() as connection:
+        assert connection.scalar(select(Loan.amount).where(Loan.id == 1)) == 100.0
+    # Без контрольной точки пропущенный кредит догоняется, остальные — нет
+    assert accrual.run(engine, today=today, checkpoint_path=str(checkpoint)) == 1
+    assert accrual.run(engine, today=today, checkpoint_path=str(checkpoint)) == 0
+
+    daily = 0.10 / 365
+    penalty = accrual.PENALTY_RATE / 100 / 365
+    with engine.connect() as connection:
+        amounts = connection.execute(select(Loan.amount).order_by(Loan.id)).scalars()
+        assert list(amounts) == [
+            round(100 * (1 + daily) ** 30, 2),
+            round(100 * (1 + daily) ** 30, 2),
+            round(100 * (1 + daily) ** 20 * (1 + daily + penalty) ** 10, 2),
+            100.0,
+            100.0,
+        ]
+
+
+def test_accrual_skips_loan_paid_during_chunk(tmp_path):
+    import datetime
+    from sqlalchemy import create_engine, select, update
+    from models import Base, Loan
+    import accrual
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'loans.db'}")
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(
+            Loan.__table__.insert(),
+            [
+                dict(
+                    client_id=1,
+                    amount=100.0,
+                    interest_rate=10.0,
+                    status="active",
+                    accrued_on=datetime.date(2024, 1, 1),
+                )
+                for _ in range(2)
+            ],
+        )
+    fetch_chunk = accrual.fetch_chunk
+
+    def fetch_then_pay(connection, *args):
+        rows = fetch_chunk(connection, *args)
+        if rows:
+            # Как callback_query_loan_pay_card между чтением и записью блока
+            connection.execute(
+                update(Loan).where(Loan.id == 1).values(amount=0, status="paid")
+            )
+        return rows
+
+    with patch("accrual.fetch_chunk", fetch_then_pay):
+        accrual.run(engine, today=datetime.date(2024, 1, 31), checkpoint_path=None)
+
+    with engine.connect() as connection:
+        loans = connection.execute(
+            select(Loan.amount, Loan.status).order_by(Loan.id)
+        ).all()
+    assert loans[0] == (0, "paid")
+    assert loans[1] == (round(100 * (1 + 0.10 / 365) ** 30, 2), "active")
+
+
+@patch("main.bot.send_document")
+def test_monthly_statement_streams_csv(
+    mock_send_document, sqlite_session, mock_message
+):
+    from models import Client, Transaction
+    import datetime
+    import main
+
+    with sqlite_session() as session:
+        client = Client(
+            first_name="John",
+            last_name="Doe",
+            email="john@example.com",
+            telegram_id=mock_message.from_user.id,
+        )
+        other = Client(
+            first_name="Jane", last_name="Roe", email="jane@example.com", telegram_id=2
+        )
+        session.add_all([client, other])
+        session.flush()
+        for day, recipient in ((1, client), (15, other), (40, client)):
+            session.add(
+                Transaction(
+                    client_id=client.id,
+                    recipient_id=recipient.id,
+                    amount=day,
+                    transaction_type="transfer",
+                    created_at=datetime.datetime(2024, 10, 1)
+                    + datetime.timedelta(days=day - 1),
+                )
+            )
+        session.commit()
+
+    documents = []
+    mock_send_document.side_effect = lambda chat_id, document, **kwargs: (
+        documents.append((document.read().decode(), kwargs))
+    )
+    mock_message.text = "/statement 2024-10"
+    main.monthly_statement(mock_message)
+
+    text, kwargs = documents[0]
+    assert kwargs["visible_file_name"] == "statement_2024-10.csv"
+    lines = text.splitlines()
+    assert lines[0].startswith("id,created_at,transaction_type,amount")
+    assert len(lines) == 3
+    assert lines[2].endswith("Jane Roe")
+
+
+def test_statement_parquet_export(tmp_path, sqlite_session):
+    pyarrow_parquet = pytest.importorskip("pyarrow.parquet")
+    from models import Client, Transaction
+    import statement
+
+    with sqlite_session() as session:
+        session.add(
+            Client(
+                id=1, first_name="John", last_name="Doe", email="j@e.com", telegram_id=1
+            )
+        )
+        session.add_all(
+            Transaction(client_id=1, amount=number, transaction_type="top_up")
+            for number in range(7)
+        )
+        session.commit()
+        path = tmp_path / "ledger.parquet"
+        with open(path, "wb") as output:
+            assert statement.export(session, output, "parquet") == 7
+
+    table = pyarrow_parquet.read_table(path)
+    assert table.column("amount").to_pylist() == list(range(7))
+    assert table.column("client_name").to_pylist() == ["John Doe"] * 7
+
+
+@patch("main.bot.send_message")
+def test_registration_flow_resumes_from_store(
+    mock_send_message, sqlite_session, mock_message
+):
+    from models import Client
+    import main
+
+    register(mock_message)
+    assert conversations.store.pending(mock_message.chat.id)
+
+    for text in ("Doe", "John", "", "not-an-email", "john@example.com"):
+        mock_message.text = text
+        main.process_next_step(mock_message)
+
+    assert not conversations.store.pending(mock_message.chat.id)
+    with sqlite_session() as session:
+        client = session.query(Client).one()
+        assert (client.last_name, client.first_name) == ("Doe", "John")
+        assert client.email == "john@example.com"
+
+
+def test_outbox_retries_after_429_in_order():
+    import telebot
+    from fake_bot_api import FakeBotApi, use_fake_api
+    from outbox import Outbox
+
+    api = FakeBotApi(chat_limit=5, retry_after=1).start()
+    bot = telebot.TeleBot("123456:TEST", threaded=False)
+    outbox = Outbox(bot, global_rate=100, chat_rate=100, chat_burst=100)
+    try:
+        with use_fake_api(api):
+            outbox.start()
+            futures = [outbox.send_message(1, f"m{number}") for number in range(8)]
+            outbox.edit_message_text(text="edited", chat_id=2, message_id=7)
+            assert futures[-1].result(timeout=10).text == "m7"
+            assert outbox.join(timeout=10)
+            outbox.stop(timeout=5)
+    finally:
+        api.stop()
+
+    assert [params["text"] for params in api.calls_for("sendMessage")] == [
+        f"m{number}" for number in range(8)
+    ]
+    assert api.calls_for("editMessageText")[0]["message_id"] == "7"
+    stats = outbox.stats()
+    assert stats["sent"] == 9 and stats["failed"] == 0
+    assert stats["retried"] == api.rejected >= 1
+    assert stats["latency_max"] >= 1
+
+
+def test_outbox_sends_interactive_before_notifications():
+    from outbox import NOTIFICATION, Outbox
+
+    bot = Mock()
+    sent = []
+    bot.send_message.side_effect = lambda chat_id, text: sent.append(text)
+    outbox = Outbox(bot, workers=1, chat_rate=100, chat_burst=100)
+
+    # Без запуска вызовы выполняются сразу
+    outbox.send_message(1, "direct")
+    assert sent == ["direct"]
+
+    outbox.start()
+    with outbox._condition:
+        # Очередь заполняется, пока отправитель ждёт блокировку
+        for chat_id in range(2, 5):
+            outbox.send_message(chat_id, "notification", priority=NOTIFICATION)
+        outbox.send_message(5, "reply")
+    outbox.stop(timeout=5)
+    assert sent == ["direct", "reply"] + ["notification"] * 3
+
+
+def test_outbox_schedules_chats_not_jobs():
+    from outbox import NOTIFICATION, Outbox
+
+    bot = Mock()
+    sent = []
+    bot.send_message.side_effect = lambda chat_id, text: sent.append((chat_id, text))
+    outbox = Outbox(bot, workers=1, chat_rate=1000, chat_burst=1000)
+    outbox.start()
+    with outbox._condition:
+        for number in range(200):
+            outbox.send_message(1, number, priority=NOTIFICATION)
+        outbox.send_message(2, "reply")
+        # В кучах по записи на чат, а не на вызов
+        assert outbox.stats()["queue_depth"] == 201
+        assert len(outbox._ready) == 2
+    outbox.stop(timeout=10)
+
+    assert sent[0] == (2, "reply")
+    assert sent[1:] == [(1, number) for number in range(200)]
+
+
+def test_http_pool_shares_connections_between_threads():
+    from concurrent.futures import ThreadPoolExecutor
+    import telebot
+    from telebot import apihelper
+    from fake_bot_api import FakeBotApi, use_fake_api
+    import http_pool
+
+    api = FakeBotApi().start()
+    bot = telebot.TeleBot("123456:TEST", threaded=False)
+    previous = apihelper.CUSTOM_REQUEST_SENDER
+    sender = http_pool.install(pool_size=2)
+    try:
+        with use_fake_api(api), ThreadPoolExecutor(6) as executor:
+            list(executor.map(lambda n: bot.send_message(n, "ping"), range(30)))
+    finally:
+        apihelper.CUSTOM_REQUEST_SENDER = previous
+        sender.close()
+        api.stop()
+
+    assert len(api.calls_for("sendMessage")) == 30
+    assert api.connections <= 2
+
+
+def test_loadtest_drives_bot_through_fake_api():
+    import loadtest
+
+    result = loadtest.run(users=3, rounds=2)
+
+    commands = {row[0]: row for row in result["commands"]}
+    assert {"register", "create_card", "top_up"} <= set(commands)
+    assert result["updates"] >= 3 * (5 + 2 + 3 + 2)
+    assert all(failed == 0 for _, _, failed, *_ in result["commands"])
+
+
+def test_metrics_count_updates_queries_and_serve_prometheus_text():
+    import urllib.request
+    from sqlalchemy import create_engine, text
+    import main
+    import metrics
+
+    assert all(
+        hasattr(handler["function"], "metrics_label")
+        for handler in main.bot.message_handlers + main.bot.callback_query_handlers
+    )
+
+    engine = create_engine("sqlite://")
+    metrics.instrument_engine(engine)
+    metrics.registry.clear()
+
+    def handler(message):
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+            connection.execute(text("SELECT 2"))
+        metrics.relabel("process_email")
+
+    wrapped = metrics.instrument_handler(handler, "process_next_step")
+    wrapped(Mock())
+    wrapped(Mock())
+    labels = (("handler", "process_email"),)
+    assert metrics.registry.value("bot_updates_total", labels) == 2
+    assert metrics.registry.value("bot_update_db_queries", labels) == 2
+
+    server = metrics.MetricsServer(host="127.0.0.1", port=0).start()
+    try:
+        url = f"http://127.0.0.1:{server.port}/metrics"
+        with urllib.request.urlopen(url) as response:
+            body = response.read().decode("utf-8")
+    finally:
+        server.stop()
+    assert 'bot_updates_total{handler="process_email"} 2' in body
+    assert 'bot_update_db_queries_bucket{handler="process_email",le="2"} 2' in body
+    assert "bot_conversations_active 0" in body
+
+
+def test_query_profiler_normalizes_and_flags_n_plus_one(capsys):
+    from sqlalchemy import create_engine, text
+    from query_profiler import QueryProfiler, normalize
+
+    assert normalize("SELECT * FROM cards WHERE id IN (1, 2,  3) AND s = 'a'") == (
+        "SELECT * FROM cards WHERE id IN (?) AND s = ?"
+    )
+
+    engine = create_engine("sqlite://")
+    profiler = QueryProfiler(slow_threshold=10.0, n_plus_one_threshold=3).attach(engine)
+    with engine.connect() as connection:
+        with profiler.track("callback_query_loan_pay") as update:
+            for number in range(5):
+                connection.execute(text(f"SELECT {number}"))
+        connection.execute(text("SELECT 'outside'"))
+    profiler.detach()
+
+    assert update.queries == 5
+    assert update.repeated(3) == [("SELECT ?", 5)]
+    assert profiler.n_plus_one == 1
+    assert profiler.report()[0][:2] == ("SELECT ?", 6)
+    assert "possible N+1 in callback_query_loan_pay: 5 x SELECT ?" in (
+        capsys.readouterr().out
+    )
+
+
+@patch("main.bot.send_message")
+def test_card_pickers_query_budget(
+    mock_send_message, sqlite_session, max_queries, mock_message
+):
+    from models import Client, Card, Loan
+    import datetime
+    import main
+
+    with sqlite_session() as session:
+        client = Client(
+            first_name="John",
+            last_name="Doe",
+            email="john@example.com",
+            telegram_id=mock_message.from_user.id,
+        )
+        session.add(client)
+        session.flush()
+        session.add_all(
+            [
+                Card(
+                    client_id=client.id,
+                    card_number=f"0000 0000 0000 00{number}",
+                    expiration_date=datetime.date(2030, 1, 1),
+                    balance=100.0,
+                )
+                for number in range(10, 20)
+            ]
+            + [Loan(client_id=client.id, amount=50.0, interest_rate=5.0)]
+        )
+        session.commit()
+
+    # Клиент по telegram_id и его карты или кредиты — без запроса на строку
+    for handler in (main.delete_card, main.top_up, main.transfer, main.loan_pay):
+        cache.clear()
+        with max_queries(2):
+            handler(mock_message)
+    # Повторно клиент и клавиатура берутся из кэша
+    main.top_up(mock_message)
+    with max_queries(0):
+        main.top_up(mock_message)
+    with max_queries(0):
+        main.register(mock_message)
+
+
+def test_import_main_needs_no_config_or_network(tmp_path):
+    import subprocess
+    import sys
+
+    result = subprocess.run(
+        [sys.executable, "-c", "import main; assert main.engine is None"],
+        cwd=tmp_path,
+        env={**os.environ, "PYTHONPATH": os.path.dirname(os.path.abspath(__file__))},
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+
+
+@patch("main.bot.set_my_commands")
+def test_command_menu_synced_only_when_changed(mock_set_my_commands, tmp_path):
+    from telebot import types
+    import main
+
+    cache_path = str(tmp_path / "commands.sha256")
+    assert main.sync_commands(cache_path) is True
+    assert main.sync_commands(cache_path) is False
+    assert mock_set_my_commands.call_count == 1
+
+    with patch.object(
+        main, "commands", main.commands + [types.BotCommand("new", "Новая")]
+    ):
+        assert main.sync_commands(cache_path) is True
+    assert mock_set_my_commands.call_count == 2
+
+
+def test_callback_router_round_trip_and_stale_buttons():
+    from callbacks import CallbackRouter
+
+    router = CallbackRouter(version=2)
+
+    @router.route(3)
+    def pay(call, loan_id, card_id):
+        pass
+
+    big = 2**63 - 1
+    data = router.encode(pay, big, 7)
+    assert len(data) <= 64
+    assert router.resolve(data) == (pay, [big, 7])
+    assert len(router.encode(pay, big, big)) <= 64
+
+    # Старые строковые кнопки, другая версия, лишние аргументы
+    assert router.resolve("loan_card_1_2") is None
+    assert CallbackRouter(version=1).resolve(data) is None
+    assert router.resolve(router.encode(pay, 1, 2, 3)) is None
+    assert router.stale == 2
+    with pytest.raises(ValueError):
+        router.route(3)(pay)
+
+
+@patch("main.outbox.call")
+@patch("main.outbox.edit_message_text")
+def test_route_callback_dispatches_by_action_code(mock_edit, mock_call):
+    import main
+
+    call = Mock(id="cb", message=Mock(chat=Mock(id=1), message_id=5))
+    call.data = main.router.encode(main.callback_query_top_up, 42)
+    main.route_callback(call)
+    assert conversations.store.pop(1).args == {"card_id": 42}
+
+    call.data = "top_up_42"
+    main.route_callback(call)
+    assert mock_call.call_args.args[:3] == ("answer_callback_query", 1, "cb")
+
+
+@patch("main.bot.send_message")
+def test_card_picker_cached_until_cards_change(
+    mock_send_message, sqlite_session, max_queries, mock_message
+):
+    from models import Client, Card
+    import datetime
+    import main
+
+    with sqlite_session() as session:
+        client = Client(
+            first_name="John",
+            last_name="Doe",
+            email="john@example.com",
+            telegram_id=mock_message.from_user.id,
+        )
+        session.add(client)
+        session.flush()
+        card = Card(
+            client_id=client.id,
+            card_number="0000 0000 0000 0018",
+            expiration_date=datetime.date(2030, 1, 1),
+            balance=100.0,
+        )
+        session.add(card)
+        session.commit()
+        card_id = card.id
+
+    def keyboard():
+        markup = json.loads(mock_send_message.call_args.kwargs["reply_markup"])
+        return [row[0]["text"] for row in markup["inline_keyboard"]]
+
+    main.transfer(mock_message)
+    assert keyboard() == ["0000 0000 0000 0018, 100.0 ₽"]
+    with max_queries(0):
+        main.transfer(mock_message)
+
+    mock_message.text = "50"
+    main.finish_top_up(mock_message, card_id)
+    with max_queries(1):
+        main.transfer(mock_message)
+    assert keyboard() == ["0000 0000 0000 0018, 150.0 ₽"]
+
+
+@patch("main.bot.send_message")
+def test_read_handlers_use_replica_until_own_write(
+    mock_send_message, tmp_path, mock_message
+):
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from models import Base, Client, Card
+    import datetime
+    import main
+
+    primary, replica = (
+        create_engine(f"sqlite:///{tmp_path / name}.db")
+        for name in ("primary", "replica")
+    )
+    for engine in (primary, replica):
+        Base.metadata.create_all(engine)
+        with sessionmaker(bind=engine)() as session:
+            client = Client(
+                first_name="John",
+                last_name="Doe",
+                email="john@example.com",
+                telegram_id=mock_message.from_user.id,
+            )
+            session.add(client)
+            session.flush()
+            session.add(
+                Card(
+                    client_id=client.id,
+                    card_number="0000 0000 0000 0018",
+                    expiration_date=datetime.date(2030, 1, 1),
+                    balance=100.0,
+                )
+            )
+            session.commit()
+            card_id = session.query(Card.id).scalar()
+
+    session_factory = sessionmaker(
+        class_=db.RoutingSession, bind=primary, expire_on_commit=False
+    )
+    db.configure_replicas([replica], sticky_seconds=60)
+    try:
+        with patch("main.Session", session_factory):
+            # Пополнение пишет в основную базу, реплика «отстала»
+            mock_message.text = "50"
+            main.finish_top_up(mock_message, card_id)
+            main.account(mock_message)
+            assert "Баланс: 150.0 ₽" in mock_send_message.call_args.args[1]
+
+            # Окно своих записей закончилось — чтение с реплики
+            db.replicas.sticky_seconds = 0
+            main.finish_top_up(mock_message, card_id)
+            cache.clear()
+            main.account(mock_message)
+            assert "Баланс: 100.0 ₽" in mock_send_message.call_args.args[1]
+
+            with pytest.raises(RuntimeError):
+                with db.session_scope(session_factory, read_only=True) as session:
+                    session.add(Card(client_id=1, card_number="x", balance=0))
+                    session.flush()
+    finally:
+        db.configure_replicas([])
+        primary.dispose()
+        replica.dispose()
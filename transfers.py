@@ -0,0 +1,423 @@
+"""Перевод между картами одной короткой транзакцией.
+
+Обе карты блокируются ``SELECT ... FOR UPDATE`` в порядке возрастания id,
+поэтому встречные переводы A→B и B→A не взаимоблокируются. Списание — это
+``UPDATE ... WHERE balance >= amount``: баланс проверяется и уменьшается
+атомарно самой базой, а не по значению, прочитанному шагами раньше.
+Пополнение карты и погашение кредита меняют баланс теми же запросами.
+
+Нагрузочная проверка (временный SQLite-файл по умолчанию или любая
+мигрированная база):
+
+    python transfers.py --url postgresql://... --threads 16 --transfers 500
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from datetime import date, datetime
+
+from sqlalchemy import create_engine, delete, func, inspect, select, update
+from sqlalchemy.orm import sessionmaker
+
+import card_numbers
+from models import Base, Card, Client, Loan, Transaction
+
+
+class TransferError(Exception):
+    pass
+
+
+class CardNotFound(TransferError):
+    pass
+
+
+class InsufficientFunds(TransferError):
+    pass
+
+
+class LoanNotFound(TransferError):
+    pass
+
+
+TransferResult = namedtuple(
+    "TransferResult",
+    ["card_from_number", "card_to_number", "balance", "from_client_id", "to_client_id"],
+)
+TopUpResult = namedtuple("TopUpResult", ["card_number", "balance", "client_id"])
+LoanPaymentResult = namedtuple(
+    "LoanPaymentResult", ["amount", "balance", "card_client_id", "loan_client_id"]
+)
+
+
+def _lock_cards(card_from_id, card_to_id):
+    return (
+        select(Card.id, Card.client_id, Card.card_number)
+        .where(Card.id.in_({card_from_id, card_to_id}))
+        .order_by(Card.id)
+        .with_for_update()
+    )
+
+
+def _debit(card_id, amount):
+    return (
+        update(Card)
+        .where(Card.id == card_id, Card.balance >= amount)
+        .values(balance=Card.balance - amount)
+        .returning(Card.balance)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _credit(card_id, amount):
+    return (
+        update(Card)
+        .where(Card.id == card_id)
+        .values(balance=Card.balance + amount)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _lock_loan(loan_id):
+    return (
+        select(Loan.amount, Loan.client_id)
+        .where(Loan.id == loan_id, Loan.status == "active")
+        .with_for_update()
+    )
+
+
+def _close_loan(loan_id, amount):
+    # Без FOR UPDATE (SQLite) кредит мог быть погашен или пересчитан после
+    # чтения: тогда запрос ничего не изменит
+    return (
+        update(Loan)
+        .where(Loan.id == loan_id, Loan.status == "active", Loan.amount == amount)
+        .values(amount=0, status="paid", due_date=datetime.now())
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _result(cards, card_from_id, card_to_id, amount, balance):
+    card_from, card_to = cards[card_from_id], cards[card_to_id]
+    if card_from_id == card_to_id:
+        balance += amount
+    return TransferResult(
+        card_from.card_number,
+        card_to.card_number,
+        # SQLite отдаёт в RETURNING значение без приведения к типу колонки
+        float(balance),
+        card_from.client_id,
+        card_to.client_id,
+    )
+
+
+def _record(result, amount):
+    return Transaction(
+        client_id=result.from_client_id,
+        amount=amount,
+        transaction_type="transfer",
+        recipient_id=result.to_client_id,
+    )
+
+
+def _record_top_up(card, amount):
+    return Transaction(
+        client_id=card.client_id,
+        amount=amount,
+        transaction_type="top_up",
+        recipient_id=card.client_id,
+    )
+
+
+def _record_loan_payment(card, loan):
+    return Transaction(
+        client_id=card.client_id,
+        amount=loan.amount,
+        transaction_type="loan_pay",
+        recipient_id=card.client_id,
+    )
+
+
+def transfer(session, card_from_id, card_to_id, amount):
+    """Переводит ``amount`` с карты на карту и записывает операцию.
+
+    Коммитит транзакцию сам; при ошибке откатывает её и бросает
+    CardNotFound или InsufficientFunds.
+    """
+    try:
+        cards = {
+            card.id: card
+            for card in session.execute(_lock_cards(card_from_id, card_to_id))
+        }
+        if card_from_id not in cards or card_to_id not in cards:
+            raise CardNotFound
+        balance = session.execute(_debit(card_from_id, amount)).scalar()
+        if balance is None:
+            raise InsufficientFunds
+        session.execute(_credit(card_to_id, amount))
+        result = _result(cards, card_from_id, card_to_id, amount, balance)
+        session.add(_record(result, amount))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return result
+
+
+async def transfer_async(session, card_from_id, card_to_id, amount):
+    """То же, что transfer, для AsyncSession."""
+    try:
+        cards = {
+            card.id: card
+            for card in await session.execute(_lock_cards(card_from_id, card_to_id))
+        }
+        if card_from_id not in cards or card_to_id not in cards:
+            raise CardNotFound
+        balance = (await session.execute(_debit(card_from_id, amount))).scalar()
+        if balance is None:
+            raise InsufficientFunds
+        await session.execute(_credit(card_to_id, amount))
+        result = _result(cards, card_from_id, card_to_id, amount, balance)
+        session.add(_record(result, amount))
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+    return result
+
+
+def top_up(session, card_id, amount):
+    """Пополняет карту на ``amount`` и записывает операцию.
+
+    Коммитит транзакцию сам; бросает CardNotFound, если карты нет.
+    """
+    try:
+        card = session.execute(
+            _credit(card_id, amount).returning(
+                Card.card_number, Card.balance, Card.client_id
+            )
+        ).one_or_none()
+        if card is None:
+            raise CardNotFound
+        session.add(_record_top_up(card, amount))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return TopUpResult(card.card_number, float(card.balance), card.client_id)
+
+
+async def top_up_async(session, card_id, amount):
+    """То же, что top_up, для AsyncSession."""
+    try:
+        card = (
+            await session.execute(
+                _credit(card_id, amount).returning(
+                    Card.card_number, Card.balance, Card.client_id
+                )
+            )
+        ).one_or_none()
+        if card is None:
+            raise CardNotFound
+        session.add(_record_top_up(card, amount))
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+    return TopUpResult(card.card_number, float(card.balance), card.client_id)
+
+
+def pay_loan(session, loan_id, card_id):
+    """Гасит кредит с карты и записывает операцию.
+
+    Кредит закрывается условным UPDATE до списания и остаётся
+    заблокированным до коммита, поэтому его не погасить дважды и начисление
+    процентов не перезапишет погашенный кредит. Коммитит транзакцию сам;
+    бросает LoanNotFound, если активного кредита нет, и InsufficientFunds,
+    если карты нет или на ней не хватает денег.
+    """
+    try:
+        loan = session.execute(_lock_loan(loan_id)).one_or_none()
+        if (
+            loan is None
+            or not session.execute(_close_loan(loan_id, loan.amount)).rowcount
+        ):
+            raise LoanNotFound
+        card = session.execute(
+            _debit(card_id, loan.amount).returning(Card.client_id)
+        ).one_or_none()
+        if card is None:
+            raise InsufficientFunds
+        session.add(_record_loan_payment(card, loan))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return LoanPaymentResult(
+        loan.amount, float(card.balance), card.client_id, loan.client_id
+    )
+
+
+async def pay_loan_async(session, loan_id, card_id):
+    """То же, что pay_loan, для AsyncSession."""
+    try:
+        loan = (await session.execute(_lock_loan(loan_id))).one_or_none()
+        if (
+            loan is None
+            or not (await session.execute(_close_loan(loan_id, loan.amount))).rowcount
+        ):
+            raise LoanNotFound
+        card = (
+            await session.execute(
+                _debit(card_id, loan.amount).returning(Card.client_id)
+            )
+        ).one_or_none()
+        if card is None:
+            raise InsufficientFunds
+        session.add(_record_loan_payment(card, loan))
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+    return LoanPaymentResult(
+        loan.amount, float(card.balance), card.client_id, loan.client_id
+    )
+
+
+def stress(
+    url, threads=8, transfers=200, cards=20, balance=1000.0, create_schema=False
+):
+    """Гоняет случайные переводы из нескольких потоков и проверяет, что деньги
+    не потерялись. Возвращает (успешных переводов, отказов, переводов в секунду).
+
+    Схему создаёт только ``create_schema`` (временная база); любую другую базу
+    сначала нужно мигрировать ``alembic upgrade head``. Тестовый клиент, его
+    карты и операции удаляются по завершении.
+    """
+    engine = create_engine(url, connect_args={"timeout": 30} if "sqlite" in url else {})
+    if create_schema:
+        Base.metadata.create_all(engine)
+    elif not inspect(engine).has_table(Card.__tablename__):
+        engine.dispose()
+        raise RuntimeError(f"no cards table in {url}, run alembic upgrade head")
+    Session = sessionmaker(bind=engine, expire_on_commit=False)
+    client_id = None
+
+    try:
+        with Session() as session:
+            client = Client(
+                first_name="Stress",
+                last_name="Test",
+                email=f"stress{time.time_ns()}@example.com",
+                telegram_id=time.time_ns() % 2**31,
+            )
+            session.add(client)
+            session.commit()
+            client_id = client.id
+
+            card_ids = []
+            for _ in range(cards):
+                card = Card(
+                    client_id=client_id,
+                    card_number=card_numbers.allocator.allocate(session),
+                    expiration_date=date.today(),
+                    balance=balance,
+                )
+                session.add(card)
+                session.flush()
+                card_ids.append(card.id)
+            session.commit()
+
+        counters = {"ok": 0, "insufficient": 0}
+        errors = []
+        lock = threading.Lock()
+
+        def worker(seed):
+            rnd = random.Random(seed)
+            try:
+                with Session() as session:
+                    for _ in range(transfers):
+                        card_from, card_to = rnd.sample(card_ids, 2)
+                        try:
+                            transfer(
+                                session,
+                                card_from,
+                                card_to,
+                                rnd.randint(1, int(balance // 2)),
+                            )
+                            outcome = "ok"
+                        except InsufficientFunds:
+                            outcome = "insufficient"
+                        with lock:
+                            counters[outcome] += 1
+            except Exception as e:
+                # Взаимоблокировка или сбой сериализации, а не потеря денег
+                errors.append(e)
+
+        workers = [
+            threading.Thread(target=worker, args=(seed,)) for seed in range(threads)
+        ]
+        started = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        if errors:
+            raise errors[0]
+
+        with Session() as session:
+            total, lowest = session.execute(
+                select(func.sum(Card.balance), func.min(Card.balance)).where(
+                    Card.id.in_(card_ids)
+                )
+            ).one()
+            recorded = session.scalar(
+                select(func.count(Transaction.id)).where(
+                    Transaction.client_id == client_id
+                )
+            )
+    finally:
+        if client_id is not None:
+            with Session.begin() as session:
+                session.execute(
+                    delete(Transaction).where(Transaction.client_id == client_id)
+                )
+                session.execute(delete(Card).where(Card.client_id == client_id))
+                session.execute(delete(Client).where(Client.id == client_id))
+        engine.dispose()
+
+    if total != balance * cards:
+        raise RuntimeError(f"money lost: {total} != {balance * cards}")
+    if lowest < 0:
+        raise RuntimeError(f"negative balance: {lowest}")
+    if recorded != counters["ok"]:
+        raise RuntimeError(f"{recorded} transactions for {counters['ok']} transfers")
+    return counters["ok"], counters["insufficient"], counters["ok"] / elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочная проверка переводов")
+    parser.add_argument("--url")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--transfers", type=int, default=200)
+    parser.add_argument("--cards", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    url = args.url
+    if not url:
+        url = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "transfers.db")
+    ok, insufficient, rate = stress(
+        url, args.threads, args.transfers, args.cards, create_schema=not args.url
+    )
+    print(
+        f"{ok} transfers, {insufficient} rejected, {rate:.0f} transfers/s, no money lost"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""Приём обновлений Telegram через вебхук.
+
+HTTP-приёмник проверяет секретный токен, отдаёт обновление диспетчеру и сразу
+отвечает 200, а диспетчер передаёт обновления в обработчики бота. С
+``metrics_registry`` тот же сервер отдаёт метрики на ``GET /metrics``.
+
+Для локальной проверки можно отправить записанные обновления в приёмник:
+
+    python webhook.py replay updates.json --url http://localhost:8000/webhook \\
+        --secret <secret_token>
+"""
+
+import argparse
+import hmac
+import json
+import queue
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot import types
+
+import metrics
+from dispatcher import ChatDispatcher
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    def __init__(
+        self,
+        bot,
+        dispatcher=None,
+        host="0.0.0.0",
+        port=8000,
+        path="/webhook",
+        secret_token=None,
+        metrics_registry=None,
+    ):
+        self.bot = bot
+        self.metrics_registry = metrics_registry
+        self.dispatcher = dispatcher or ChatDispatcher(bot)
+        self.path = path
+        self.secret_token = secret_token
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def start(self):
+        threading.Thread(
+            target=self.httpd.serve_forever, name="webhook-http", daemon=True
+        ).start()
+
+    def serve_forever(self):
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.httpd.server_close()
+            self.dispatcher.shutdown()
+
+    def stop(self):
+        """Перестаёт принимать запросы и дожидается обработки очереди."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.dispatcher.shutdown()
+
+    def enqueue(self, update):
+        self.dispatcher.submit(update, block=False)
+
+    def _check_secret(self, value):
+        if not self.secret_token:
+            return True
+        return hmac.compare_digest(value or "", self.secret_token)
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.path:
+                    self._reply(404)
+                    return
+                if not server._check_secret(self.headers.get(SECRET_HEADER)):
+                    self._reply(403)
+                    return
+
+                length = int(self.headers.get("Content-Length", 0))
+                try:
+                    update = types.Update.de_json(
+                        self.rfile.read(length).decode("utf-8")
+                    )
+                except (ValueError, KeyError):
+                    self._reply(400)
+                    return
+
+                try:
+                    server.enqueue(update)
+                except queue.Full:
+                    # Telegram повторит доставку позже
+                    self._reply(503)
+                    return
+                self._reply(200)
+
+            def do_GET(self):
+                if server.metrics_registry is None or self.path != "/metrics":
+                    self._reply(404)
+                    return
+                metrics.write_metrics(self, server.metrics_registry)
+
+            def _reply(self, status):
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def post_update(url, update, secret_token=None):
+    """Отправляет одно обновление в приёмник так же, как это делает Telegram."""
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(update).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    if secret_token:
+        request.add_header(SECRET_HEADER, secret_token)
+    with urllib.request.urlopen(request) as response:
+        return response.status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Отправка записанных обновлений")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    replay = subparsers.add_parser("replay", help="отправить обновления из файла")
+    replay.add_argument("file", help="JSON-объект обновления или список обновлений")
+    replay.add_argument("--url", default="http://localhost:8000/webhook")
+    replay.add_argument("--secret")
+
+    args = parser.parse_args(argv)
+    with open(args.file, encoding="utf-8") as file:
+        updates = json.load(file)
+    if isinstance(updates, dict):
+        updates = [updates]
+    for update in updates:
+        print(update.get("update_id"), post_update(args.url, update, args.secret))
+
+
+if __name__ == "__main__":
+    main()